@@ -0,0 +1,384 @@
+import os
+import gzip
+import json
+import bisect
+import tarfile
+import multiprocessing
+import compress
+import encrypt
+import incremental
+import governor
+import fileio
+
+# Indexed archive of the site folder
+#
+# The tar stream of WP_PATH is compressed in blocks of BLOCK_SIZE bytes of clear data, each block
+# being a complete gzip member, zstd frame or lz4 frame (see compress.get_block_compressor).
+# The media files (see compress.classify) are written after all the other members, in blocks
+# stored with the fastest setting of the codec : a restore reads them like the others.
+# The archive is still a single compressed stream for tar and for the sequential restore, but
+# decompression can start at the beginning of any block.
+# A sidecar index (wordpress.site.index.gz) lists the name, offset and length of every member of the
+# tar stream and, on its last line, the clear and compressed size of every block.
+# The encrypted container is made of segments of a fixed size (see encrypt.py), so the place of a member
+# in the encrypted archive is known without reading it :
+#
+#   member offset -> block -> compressed offset -> encrypted segment
+#
+# restore-wp.py --path only reads the segments holding the requested members (ranges fetched with REST
+# from the FTP server), and a full restore extracts groups of members in parallel processes.
+
+INDEX = "wordpress.site.index.gz"
+INDEX_VERSION = 1
+BLOCK_SIZE = 4 * 1024 * 1024
+GROUP_SIZE = 64 * 1024 * 1024
+
+
+class IndexWriter:
+    """Write the index of a tar stream, members are added in the order of the stream"""
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path + ".tmp", "wt")
+        self.file.write(json.dumps({"version": INDEX_VERSION}) + "\n")
+        self.last = None
+
+    def _write(self, end):
+        if self.last is not None:
+            name, offset, kind = self.last
+            self.file.write(json.dumps([name, offset, end - offset, kind]) + "\n")
+            self.last = None
+
+    def member(self, tarinfo, offset):
+        """Record the member tarinfo starting at offset in the tar stream"""
+        self._write(offset)
+        if tarinfo.isdir():
+            kind = "d"
+        elif tarinfo.islnk():
+            kind = "h"
+        else:
+            kind = "f"
+        self.last = (tarinfo.name, offset, kind)
+
+    def end(self, offset):
+        """Record the end of the last member"""
+        self._write(offset)
+
+    def close(self, blocks):
+        """Write the sizes of the compressed blocks, see compress.get_block_compressor"""
+        self.file.write(json.dumps({"blocks": blocks}) + "\n")
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + ".tmp")
+
+
+class _Position:
+    """Buffered file-like object counting the bytes written to fileobj, tarfile needs tell()"""
+    def __init__(self, fileobj, buffer_size=compress.BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if self.buffer:
+            self.fileobj.write(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def _source(path, name):
+    """Return the path on the disk of the member name of the tar stream of path"""
+    return os.sep + name if os.path.isabs(path) else name
+
+
+def write_tar(path, fileobj, index, raw=None):
+    """Write the tar stream of path into fileobj and record its members in index
+       - raw: optional, called between the text and the media files of the site, see compress.classify :
+         the media files are then written at the end of the stream, ie to store them without compression
+       return the number of files of each class, all the files are text without raw
+    """
+    # The files read from the disk are limited by the governor of the process, see governor.py
+    writer = _Position(governor.Throttled(fileobj, "disk"))
+    tar = tarfile.open(fileobj=writer, mode="w")
+    files = {name: 0 for name in compress.CLASSES}
+    media = []
+    def record(tarinfo):
+        index.member(tarinfo, tar.offset)
+        return tarinfo
+    def select(tarinfo):
+        if raw is not None and tarinfo.isreg():
+            source = _source(path, tarinfo.name)
+            # A file with several links stays in place, its other links refer to its first member
+            if compress.classify(source, tarinfo.size) == "media" and os.lstat(source).st_nlink == 1:
+                media.append((source, tarinfo.name))
+                return None
+        if tarinfo.isreg():
+            files["text"] += 1
+        return record(tarinfo)
+    tar.add(path, filter=select)
+    if raw is not None:
+        writer.flush()
+        raw()
+        for source, name in media:
+            tar.add(source, arcname=name, recursive=False, filter=record)
+        files["media"] = len(media)
+    index.end(tar.offset)
+    tar.close()
+    writer.flush()
+    return files
+
+
+def class_stats(files, compressor):
+    """Return the files, bytes and seconds of compression of each class
+       - files: number of files of each class, see write_tar
+       - compressor: compress.ClassCompressor
+    """
+    return {name: dict(compressor.stats[name], files=files[name]) for name in compress.CLASSES}
+
+
+def write_archive(path, archive_path, index_path, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, workers=0, media=False):
+    """Write the compressed tar archive of path in blocks and its index
+       - path: folder to archive
+       - archive_path: compressed archive to write
+       - index_path: index to write
+       - codec, level, workers: compression parameters, see compress.get_compressor
+       - media: True to compress the media files like the others, they are stored at the end of
+         the archive with the fastest setting of the codec by default, see compress.classify
+       return a dict with the size of the tar stream (bytes_in) and of the archive (bytes_out),
+       and the stats of each class (classes)
+    """
+    compressor = compress.ClassCompressor(compress.get_block_compressor(codec, level, workers, BLOCK_SIZE))
+    index = IndexWriter(index_path)
+    try:
+        with open(archive_path, "wb") as f:
+            writer = compress.CompressWriter(f, compressor=compressor)
+            files = write_tar(path, writer, index, None if media else writer.raw)
+            writer.close()
+    except BaseException:
+        index.discard()
+        raise
+    index.close(compressor.blocks)
+    return {"bytes_in": sum(clear for clear, compressed in compressor.blocks), "bytes_out": sum(compressed for clear, compressed in compressor.blocks),
+            "classes": class_stats(files, compressor)}
+
+
+class Index:
+    """Index of an archive
+       - path: clear index
+       blocks is set once all the members have been read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.blocks = None
+
+    def members(self):
+        """Yield the members as [name, offset, length, kind], kind is d (directory), h (hard link) or f"""
+        with gzip.open(self.path, "rt") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != INDEX_VERSION:
+                raise ValueError("Unsupported archive index version")
+            for line in f:
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    self.blocks = entry["blocks"]
+                else:
+                    yield entry
+
+
+def plan(index, paths=None, group_size=GROUP_SIZE):
+    """Split the members to restore in groups extracted independently
+       - index: Index of the archive
+       - paths: names of the members to restore with everything below them, None for all
+       - group_size: clear size above which a new group is started
+       return (groups, links, directories) : groups and links are lists of [start, end] offsets
+       in the tar stream, links are the hard links, extracted after their targets, and directories
+       the names of the directories restored
+       The target of a hard link may not be restored, the link is then extracted as a copy of it, see _extract_link.
+    """
+    groups = []
+    links = []
+    directories = []
+    for name, offset, length, kind in index.members():
+        if not incremental.selected(name, paths):
+            continue
+        if kind == "h":
+            links.append([offset, offset + length])
+            continue
+        if kind == "d":
+            directories.append(name)
+        if groups and groups[-1][1] == offset and groups[-1][1] - groups[-1][0] < group_size:
+            groups[-1][1] = offset + length
+        else:
+            groups.append([offset, offset + length])
+    return groups, links, directories
+
+
+class Layout:
+    """Offsets of the compressed blocks of an archive
+       - blocks: sizes of the blocks, see Index.blocks
+       - segment_size: size of the segments of the encrypted archive
+    """
+    def __init__(self, blocks, segment_size=encrypt.SEGMENT_SIZE):
+        self.clear = [0]
+        self.compressed = [0]
+        for clear_size, compressed_size in blocks:
+            self.clear.append(self.clear[-1] + clear_size)
+            self.compressed.append(self.compressed[-1] + compressed_size)
+        self.segment_size = segment_size
+
+    def locate(self, start, end):
+        """Return the blocks holding the tar stream from start to end
+           as (clear offset, compressed offset, compressed end) of the first block
+        """
+        first = bisect.bisect_right(self.clear, start) - 1
+        last = bisect.bisect_left(self.clear, end)
+        return self.clear[first], self.compressed[first], self.compressed[last]
+
+    def encrypted_range(self, start, end):
+        """Return the (offset, length) of the encrypted archive holding the tar stream from start to end"""
+        clear, compressed, compressed_end = self.locate(start, end)
+        first = encrypt.segment_offset(compressed // self.segment_size, self.segment_size)
+        last = encrypt.segment_offset((compressed_end - 1) // self.segment_size + 1, self.segment_size)
+        return first, last - first
+
+
+def encrypted_ranges(layout, groups, size):
+    """Return the sorted and merged (offset, length) of the encrypted archive holding groups
+       - size: size of the encrypted archive, the last segment is shorter than the others
+    """
+    ranges = sorted(layout.encrypted_range(start, end) for start, end in groups)
+    merged = [[0, encrypt.HEADER.size]]
+    for offset, length in ranges:
+        end = min(offset + length, size)
+        if offset <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([offset, end])
+    return [(start, end - start) for start, end in merged]
+
+
+class _Slice:
+    """File-like object returning length bytes of fileobj after skipping skip bytes"""
+    def __init__(self, fileobj, skip, length):
+        self.fileobj = fileobj
+        self.skip = skip
+        self.left = length
+
+    def read(self, size=-1):
+        while self.skip:
+            data = self.fileobj.read(min(self.skip, compress.READ_SIZE))
+            if not data:
+                raise ValueError("Archive is truncated")
+            self.skip -= len(data)
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.fileobj.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def open_range(fileobj, key, header, layout, start, end):
+    """Return a file-like object reading the tar stream from start to end in the encrypted archive fileobj"""
+    clear, compressed, compressed_end = layout.locate(start, end)
+    segment = compressed // layout.segment_size
+    fileobj.seek(encrypt.segment_offset(segment, layout.segment_size))
+    decrypted = encrypt.DecryptReader(fileobj, key, header, segment)
+    blocks = _Slice(decrypted, compressed - segment * layout.segment_size, compressed_end - compressed)
+    return _Slice(compress.DecompressReader(blocks), start - clear, end - start)
+
+
+def _set_metadata(path, directory):
+    name, mode, uid, gid, mtime = directory
+    if os.geteuid() == 0:
+        os.lchown(path, uid, gid)
+    os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+
+def _extract_group(archive_path, key, header, layout, start, end, paths, dest):
+    """Extract the members of the group, return the metadata of its directories, set at the end of the restore"""
+    directories = []
+    # The segments of the group are decrypted from a memory map of the archive, see fileio.py
+    with fileio.open_mapped(archive_path) as f:
+        tar = tarfile.open(fileobj=open_range(f, key, header, layout, start, end), mode="r|")
+        for member in tar:
+            if not incremental.selected(member.name, paths):
+                continue
+            if member.isdir():
+                directories.append((member.name, member.mode, member.uid, member.gid, member.mtime))
+                tar.extract(member, dest, set_attrs=False)
+            else:
+                tar.extract(member, dest)
+        tar.close()
+    return directories
+
+
+def _extract_link(archive_path, key, header, layout, start, end, paths, dest, members):
+    """Extract the hard link at start, as a regular file with the content of its target when the target is not restored
+       - members: dict name -> (offset, length) of the members of the archive, see Index.members
+    """
+    with fileio.open_mapped(archive_path) as f:
+        tar = tarfile.open(fileobj=open_range(f, key, header, layout, start, end), mode="r|")
+        link = tar.next()
+        if incremental.selected(link.linkname, paths):
+            tar.extract(link, dest)
+            tar.close()
+            return
+        tar.close()
+        offset, length = members[link.linkname]
+        tar = tarfile.open(fileobj=open_range(f, key, header, layout, offset, offset + length), mode="r|")
+        target = tar.next()
+        target.name = link.name
+        tar.extract(target, dest)
+        tar.close()
+
+
+def extract(archive_path, key, index_path, dest="/", paths=None, jobs=0):
+    """Extract an indexed archive
+       - archive_path: encrypted archive, only the segments holding the members to restore are read,
+         see encrypted_ranges to download only them
+       - key: AES key used for encryption
+       - index_path: clear index of the archive
+       - dest: folder where the members are extracted
+       - paths: names of the members to restore with everything below them, None for all
+       - jobs: number of worker processes, 0 means one per core
+       return the number of groups extracted
+    """
+    index = Index(index_path)
+    groups, links, directories = plan(index, paths)
+    with open(archive_path, "rb") as f:
+        header, segment_size = encrypt.read_header(f)
+    layout = Layout(index.blocks, segment_size)
+    # Workers may extract the content of a directory before the directory itself
+    for name in directories:
+        os.makedirs(os.path.join(dest, name), exist_ok=True)
+    tasks = [(archive_path, key, header, layout, start, end, paths, dest) for start, end in groups]
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    if jobs > 1:
+        with multiprocessing.get_context("fork").Pool(jobs) as pool:
+            results = pool.starmap(_extract_group, tasks)
+    else:
+        results = [_extract_group(*task) for task in tasks]
+    # Hard links once their targets exist
+    members = {name: (offset, length) for name, offset, length, kind in index.members()} if links else {}
+    for start, end in links:
+        _extract_link(archive_path, key, header, layout, start, end, paths, dest, members)
+    # Directories last, extracting their content changes their mtime
+    for directory in sorted((directory for result in results for directory in result), reverse=True):
+        _set_metadata(os.path.join(dest, directory[0]), directory)
+    return len(groups)
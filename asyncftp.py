@@ -0,0 +1,694 @@
+import os
+import ssl
+import time
+import ftplib
+import socket
+import asyncio
+import threading
+import concurrent.futures
+import tools
+import ftppool
+import governor
+
+# FTP over TLS client running in an asyncio event loop
+#
+# ftplib waits for the reply of every command before sending the next one and holds a thread per
+# transfer, so against a distant server the scripts mostly wait for round-trips. This client runs
+# all its sessions in a single event loop, in a thread of its own :
+#   - commands which do not depend on the reply of each other are pipelined, ie sent in a single
+#     write and their replies read in order : the login (USER, PASS, PBSZ, PROT) and the setup of
+#     a transfer (TYPE, PASV or PORT, REST, then STOR or RETR) take one round-trip each, and so do
+#     the deletes and creations of folders of the rotation, see tools.pipeline
+#   - the transfers of a pool (see AsyncFTPPool) are tasks of the loop, each one over its own
+#     session and TLS data channel
+# TLS runs over memory BIOs (ssl.SSLObject) instead of the transports of asyncio, which can not
+# resume a TLS session : the data channels resume the session of the control connection like
+# tools.SessionReuseFTP_TLS.
+#
+# The code written for ftplib uses the backend through a common interface, see ftppool.backend :
+#   - connect() takes the arguments of tools.connectftp and returns a FTPSession, which has the
+#     methods of 'ftplib.FTP' used by the scripts (cwd, nlst, mlsd, retrbinary, storbinary ...),
+#     so ftprotation, pipeline and tools work unchanged over it
+#   - AsyncFTPPool is a ftppool.FTPPool whose transfers run in the event loop
+
+TIMEOUT = 60
+BUFFER_SIZE = 256 * 1024
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """Return the event loop of the sessions, started in a thread on first use"""
+    global _loop, _loop_pid
+    with _loop_lock:
+        # A forked child does not have the thread of the loop of its parent
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="asyncftp", daemon=True).start()
+    return _loop
+
+
+def run(coroutine):
+    """Run the coroutine in the event loop of the sessions and return its result
+       Must not be called from the event loop itself.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+
+def _check(reply):
+    """Raise the ftplib exception matching the reply of the server like ftplib.FTP.getresp"""
+    if reply[:1] in ("1", "2", "3"):
+        return reply
+    if reply[:1] == "4":
+        raise ftplib.error_temp(reply)
+    if reply[:1] == "5":
+        raise ftplib.error_perm(reply)
+    raise ftplib.error_proto(reply)
+
+
+class _Channel:
+    """Connection with the server, in clear or over TLS"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tls = None
+        self.incoming = None
+        self.outgoing = None
+        self.buffer = b""
+
+    async def start_tls(self, context, hostname, session=None):
+        """Handshake as a TLS client, resuming session if given"""
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_hostname=hostname, session=session)
+        await self._call(self.tls.do_handshake)
+
+    async def _flush(self):
+        data = self.outgoing.read()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def _call(self, func, *args):
+        """Call a method of the SSLObject, feeding it with the data of the connection until it completes"""
+        while True:
+            try:
+                result = func(*args)
+            except ssl.SSLWantReadError:
+                if self.incoming.eof:
+                    raise ConnectionResetError("TLS connection closed by the server")
+                await self._flush()
+                data = await self.reader.read(BUFFER_SIZE)
+                if data:
+                    self.incoming.write(data)
+                else:
+                    self.incoming.write_eof()
+                continue
+            await self._flush()
+            return result
+
+    async def read(self, size=BUFFER_SIZE):
+        """Return the next bytes received, b"" at the end of the stream"""
+        if self.tls is None:
+            return await self.reader.read(size)
+        try:
+            return await self._call(self.tls.read, size)
+        except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+            return b""
+
+    async def readline(self):
+        while b"\n" not in self.buffer:
+            data = await self.read()
+            if not data:
+                raise EOFError("Connection closed by the server")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    async def write(self, data):
+        if self.tls is None:
+            self.writer.write(data)
+            await self.writer.drain()
+            return
+        view = memoryview(data)
+        while view:
+            view = view[await self._call(self.tls.write, view):]
+
+    async def close(self, unwrap=False):
+        """Close the connection, after the TLS shutdown if unwrap"""
+        if self.tls is not None and unwrap:
+            try:
+                await asyncio.wait_for(self._call(self.tls.unwrap), TIMEOUT)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncFTP:
+    """Session with a FTP server over explicit TLS, its coroutines run in the event loop
+       - passive: passive mode, else active mode like tools.connectftp
+    """
+    encoding = "utf-8"
+
+    def __init__(self, passive=False):
+        self.passive = passive
+        self.host = None
+        self.control = None
+        self.type = None
+        # Certificates are not verified, like ftplib.FTP_TLS by default
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    async def connect(self, host, port, user, passwd):
+        """Connect to the server, secure the control connection and log in"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), TIMEOUT)
+        self.host = host
+        self.control = _Channel(reader, writer)
+        _check(await self._reply())
+        await self.command("AUTH TLS")
+        await self.control.start_tls(self.context, host)
+        replies = await self.pipeline(["USER " + user, "PASS " + passwd, "PBSZ 0", "PROT P"], check=False)
+        _check(replies[0])
+        # No password needed, PASS is then refused
+        if not replies[0].startswith("230"):
+            _check(replies[1])
+        _check(replies[2])
+        _check(replies[3])
+
+    async def _reply(self):
+        """Read a reply, multi-line or not"""
+        line = (await self.control.readline()).decode(self.encoding).rstrip("\r")
+        if line[3:4] == "-":
+            code = line[:3]
+            while True:
+                following = (await self.control.readline()).decode(self.encoding).rstrip("\r")
+                line += "\n" + following
+                if following[:3] == code and following[3:4] != "-":
+                    break
+        return line
+
+    async def _send(self, commands):
+        if any("\r" in command or "\n" in command for command in commands):
+            raise ValueError("an illegal newline character should not be contained")
+        tools.count_ftp_commands(len(commands))
+        await self.control.write("".join(command + ftplib.CRLF for command in commands).encode(self.encoding))
+
+    async def pipeline(self, commands, check=True):
+        """Send the commands in a single write and return their replies, see tools.pipeline
+           - check: raise the error of the first failed command once all the replies are read
+        """
+        await self._send(commands)
+        replies = [await self._reply() for command in commands]
+        for command, reply in zip(commands, replies):
+            if command[:5].upper() == "TYPE " and reply.startswith("2"):
+                self.type = command[5:].strip().upper()
+        if check:
+            for reply in replies:
+                _check(reply)
+        return replies
+
+    async def command(self, command):
+        """Send a command and return its reply like ftplib.FTP.sendcmd"""
+        return (await self.pipeline([command]))[0]
+
+    async def size(self, name):
+        """Return the size of the file name, None if the server gives none"""
+        commands = ["SIZE " + name]
+        if self.type != "I":
+            commands.insert(0, "TYPE I")
+        reply = (await self.pipeline(commands))[-1]
+        if reply.startswith("213"):
+            return int(reply[3:].strip())
+        return None
+
+    async def _listen(self):
+        """Listen for the data connection of the server in active mode, return the server, the future of the connection and the command"""
+        future = asyncio.get_running_loop().create_future()
+
+        def accepted(reader, writer):
+            if future.done():
+                writer.close()
+            else:
+                future.set_result(_Channel(reader, writer))
+        sockname = self.control.writer.get_extra_info("sockname")
+        server = await asyncio.start_server(accepted, sockname[0], 0)
+        port = server.sockets[0].getsockname()[1]
+        if self.control.writer.get_extra_info("socket").family == socket.AF_INET:
+            command = "PORT " + ",".join(sockname[0].split(".") + [str(port >> 8), str(port & 0xFF)])
+        else:
+            command = "EPRT |2|" + sockname[0] + "|" + str(port) + "|"
+        return server, future, command
+
+    async def transfer(self, command, rest=None, kind="I", before=()):
+        """Start the transfer command (ie STOR or RETR) and return its data channel
+           - rest: optional, offset where the transfer starts
+           - kind: type of the transfer, I (binary) or A (listings)
+           - before: commands sent first, ie OPTS
+           In passive mode, the type, the data connection, the offset and the command are sent in a single
+           round-trip, the server waits for the data connection before starting the transfer.
+        """
+        commands = list(before)
+        if self.type != kind:
+            commands.append("TYPE " + kind)
+        server = future = None
+        if self.passive:
+            family = self.control.writer.get_extra_info("socket").family
+            commands.append("PASV" if family == socket.AF_INET else "EPSV")
+            groups = [commands]
+        else:
+            # Some servers only reply to PORT once connected, possibly after the reply to the next
+            # command : the transfer command waits for the reply to PORT
+            server, future, port_command = await self._listen()
+            commands.append(port_command)
+            groups = [commands, []]
+        if rest:
+            groups[-1].append("REST " + str(rest))
+        groups[-1].append(command)
+        channel = None
+        failure = None
+        try:
+            for group in groups:
+                await self._send(group)
+                for sent in group:
+                    reply = await self._reply()
+                    try:
+                        _check(reply)
+                        if sent == command and not reply.startswith("1"):
+                            raise ftplib.error_reply(reply)
+                    except ftplib.Error as error:
+                        failure = failure or error
+                        continue
+                    if sent[:5] == "TYPE ":
+                        self.type = kind
+                    elif sent == "PASV":
+                        channel = await self._open(ftplib.parse227(reply)[1])
+                    elif sent == "EPSV":
+                        channel = await self._open(ftplib.parse229(reply, self.control.writer.get_extra_info("peername"))[1])
+                if failure is not None:
+                    break
+            if failure is None and future is not None:
+                channel = await asyncio.wait_for(future, TIMEOUT)
+        except BaseException:
+            if channel is not None:
+                await channel.close()
+            raise
+        finally:
+            if server is not None:
+                server.close()
+        if failure is not None:
+            if channel is not None:
+                await channel.close()
+            if reply.startswith("1"):
+                # The transfer started anyway, ie after a refused REST, read its final reply
+                await self._reply()
+            raise failure
+        try:
+            await channel.start_tls(self.context, self.host, self.control.tls.session)
+        except BaseException:
+            await self.finish(channel, abort=True)
+            raise
+        return channel
+
+    async def _open(self, port):
+        """Open the data connection in passive mode, to the host of the control connection like ftplib"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.control.writer.get_extra_info("peername")[0], port), TIMEOUT)
+        return _Channel(reader, writer)
+
+    async def finish(self, channel, abort=False):
+        """Close the data channel and return the final reply of the transfer
+           - abort: the transfer is stopped before its end, the reply is not checked
+        """
+        await channel.close(unwrap=not abort)
+        reply = await self._reply()
+        if abort:
+            return reply
+        if not reply.startswith("2"):
+            _check(reply)
+            raise ftplib.error_reply(reply)
+        return reply
+
+    async def store(self, command, read, rest=None):
+        """Send the data of an upload, return the number of bytes sent
+           - command: ie STOR name
+           - read: coroutine function returning the next bytes to send, b"" at the end
+           - rest: optional, offset where the upload starts in the remote file
+        """
+        channel = await self.transfer(command, rest)
+        sent = 0
+        try:
+            while True:
+                data = await read()
+                if not data:
+                    break
+                await governor.athrottle("upload", len(data))
+                await channel.write(data)
+                sent += len(data)
+        except BaseException:
+            await self.finish(channel, abort=True)
+            raise
+        await self.finish(channel)
+        return sent
+
+    async def retrieve(self, command, write, rest=None, length=None, kind="I", before=()):
+        """Receive the data of a download, return the number of bytes received
+           - command: ie RETR name
+           - write: coroutine function called with the bytes received
+           - rest: optional, offset where the download starts
+           - length: optional, the data connection is closed after length bytes, the rest is not needed
+        """
+        channel = await self.transfer(command, rest, kind, before)
+        received = 0
+        try:
+            while length is None or received < length:
+                data = await channel.read(BUFFER_SIZE if length is None else min(BUFFER_SIZE, length - received))
+                if not data:
+                    break
+                await governor.athrottle("download", len(data))
+                await write(data)
+                received += len(data)
+        except BaseException:
+            await self.finish(channel, abort=True)
+            raise
+        if length is not None and received == length:
+            await self.finish(channel, abort=True)
+        else:
+            await self.finish(channel)
+        return received
+
+    async def lines(self, command, before=()):
+        """Return the lines of a listing, ie NLST or MLSD"""
+        data = bytearray()
+
+        async def write(block):
+            data.extend(block)
+        await self.retrieve(command, write, kind="A", before=before)
+        return data.decode(self.encoding).splitlines()
+
+    async def quit(self):
+        try:
+            return await self.command("QUIT")
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.control is not None:
+            control, self.control = self.control, None
+            await control.close()
+
+
+class FTPSession:
+    """Blocking session with the methods of 'ftplib.FTP' used by the scripts, over an AsyncFTP
+       Its methods run the coroutines of the client in the event loop and wait for their result.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def sendcmd(self, cmd):
+        return run(self.client.command(cmd))
+
+    def voidcmd(self, cmd):
+        reply = self.sendcmd(cmd)
+        if not reply.startswith("2"):
+            raise ftplib.error_reply(reply)
+        return reply
+
+    def pipeline(self, commands, check=True):
+        """Send the commands in a single write and return their replies, see tools.pipeline"""
+        return run(self.client.pipeline(commands, check))
+
+    def cwd(self, dirname):
+        if dirname == "..":
+            return self.voidcmd("CDUP")
+        return self.voidcmd("CWD " + (dirname or "."))
+
+    def pwd(self):
+        return ftplib.parse257(self.voidcmd("PWD"))
+
+    def mkd(self, dirname):
+        reply = self.voidcmd("MKD " + dirname)
+        if not reply.startswith("257"):
+            return ""
+        return ftplib.parse257(reply)
+
+    def rmd(self, dirname):
+        return self.voidcmd("RMD " + dirname)
+
+    def delete(self, filename):
+        reply = self.sendcmd("DELE " + filename)
+        if reply[:3] in ("250", "200"):
+            return reply
+        raise ftplib.error_reply(reply)
+
+    def rename(self, fromname, toname):
+        return self.pipeline(["RNFR " + fromname, "RNTO " + toname])[1]
+
+    def size(self, filename):
+        reply = self.sendcmd("SIZE " + filename)
+        if reply.startswith("213"):
+            return int(reply[3:].strip())
+
+    def nlst(self, *args):
+        return run(self.client.lines("NLST" + "".join(" " + arg for arg in args)))
+
+    def mlsd(self, path="", facts=[]):
+        before = ["OPTS MLST " + ";".join(facts) + ";"] if facts else []
+        entries = []
+        for line in run(self.client.lines("MLSD " + path if path else "MLSD", before)):
+            found, _, name = line.rstrip(ftplib.CRLF).partition(" ")
+            entry = {}
+            for fact in found[:-1].split(";"):
+                key, _, value = fact.partition("=")
+                entry[key.lower()] = value
+            entries.append((name, entry))
+        return entries
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        """Download like ftplib.FTP.retrbinary, the callback runs in a thread and may block"""
+        loop = _event_loop()
+
+        async def write(data):
+            await loop.run_in_executor(None, callback, data)
+        run(self.client.retrieve(cmd, write, rest))
+        return "226 Transfer complete"
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        """Upload like ftplib.FTP.storbinary, fp is read in a thread and may block"""
+        loop = _event_loop()
+
+        async def read():
+            data = await loop.run_in_executor(None, fp.read, blocksize)
+            if data and callback:
+                callback(data)
+            return data
+        run(self.client.store(cmd, read, rest))
+        return "226 Transfer complete"
+
+    def quit(self):
+        return run(self.client.quit())
+
+    def close(self):
+        run(self.client.close())
+
+
+def connect(ftpserver="172.16.30.32", username='anonymous', password='anonymous@', passive=False, port=21):
+    """connect to ftp server and open a session, like tools.connectftp
+       return a FTPSession after connection and opening of a session
+    """
+    client = AsyncFTP(passive)
+    try:
+        run(client.connect(ftpserver, port, username, password))
+    except BaseException:
+        run(client.close())
+        raise
+    return FTPSession(client)
+
+
+class AsyncFTPPool(ftppool.FTPPool):
+    """ftppool.FTPPool whose transfers are tasks of the event loop
+       - connect: function without argument returning a new FTPSession, in the right folder
+       The sessions are opened by a few threads, the transfers do not need any.
+    """
+    def _execute(self, tasks):
+        return run(self._gather(tasks))
+
+    async def _gather(self, tasks):
+        slots = asyncio.Semaphore(self.size)
+        # acquire() may wait for a session used by another thread and connect() for the loop
+        with concurrent.futures.ThreadPoolExecutor(self.size) as executor:
+            async def task(func, *args):
+                async with slots:
+                    return await self._run_async(executor, _TRANSFERS[func], *args)
+            results = await asyncio.gather(*[task(*task_args) for task_args in tasks], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return sum(results)
+
+    async def _run_async(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(executor, self._take)
+        broken = True
+        try:
+            start = time.perf_counter()
+            attempt = 0
+            while True:
+                try:
+                    # Opening the session again is part of the attempt, it is retried the same way
+                    if session.ftp is None:
+                        session.ftp = await loop.run_in_executor(executor, self.connect)
+                    transferred = await func(session.ftp.client, *args)
+                    break
+                except ftplib.all_errors:
+                    if attempt >= tools.RETRIES:
+                        raise
+                if session.ftp is not None:
+                    await session.ftp.client.close()
+                    session.ftp = None
+                await asyncio.sleep(tools.RETRY_DELAY * 2 ** attempt)
+                attempt += 1
+            session.seconds += time.perf_counter() - start
+            session.bytes += transferred
+            session.transfers += 1
+            broken = False
+            return transferred
+        finally:
+            if broken and session.ftp is not None:
+                try:
+                    await session.ftp.client.close()
+                except Exception:
+                    pass
+                session.ftp = None
+            self.release(session)
+
+
+async def _upload_file(ftp, ficdsk, ftpPath):
+    """Upload the whole file ficdsk to the folder ftpPath, resuming an interrupted upload like tools.uploadftp"""
+    loop = asyncio.get_running_loop()
+    ficftp = ftpPath + "/" + os.path.basename(ficdsk)
+    st = os.stat(ficdsk)
+    checkpoint = tools.Checkpoint(ficdsk, {"remote": ficftp, "size": st.st_size, "mtime": st.st_mtime_ns})
+    try:
+        with open(ficdsk, "rb") as f:
+            # The file is read and hashed in a thread like FTPSession.storbinary, the loop runs the other transfers
+            def read_block():
+                data = f.read(ftppool.BLOCK_SIZE)
+                checkpoint.update(data)
+                return data
+
+            def skip_remote():
+                while f.tell() < remote:
+                    checkpoint.update(f.read(min(tools.CHECKPOINT_BLOCK, remote - f.tell())))
+
+            async def read():
+                return await loop.run_in_executor(None, read_block)
+            remote = 0
+            offset = 0
+            if checkpoint.blocks:
+                try:
+                    remote = await ftp.size(ficftp) or 0
+                except ftplib.error_perm:
+                    remote = 0
+                if remote > st.st_size:
+                    remote = 0
+                offset = await loop.run_in_executor(None, checkpoint.resume_offset, remote, f)
+            checkpoint.start()
+            f.seek(offset)
+            if offset:
+                try:
+                    await ftp.store("STOR " + ficftp, read, rest=offset)
+                except ftplib.error_perm:
+                    # REST before STOR refused, append from the end of the remote file instead
+                    checkpoint.start()
+                    f.seek(offset)
+                    await loop.run_in_executor(None, skip_remote)
+                    await ftp.store("APPE " + ficftp, read)
+            else:
+                await ftp.store("STOR " + ficftp, read)
+        if await ftp.size(ficftp) != st.st_size:
+            raise ftplib.error_temp("Size of " + ficftp + " on the server does not match " + ficdsk)
+        checkpoint.done()
+    finally:
+        checkpoint.close()
+    return st.st_size
+
+
+async def _download_file(ftp, ficftp, ficdsk):
+    """Download the whole file ficftp to ficdsk, resuming an interrupted download like tools.downloadftp"""
+    loop = asyncio.get_running_loop()
+    commands = ["SIZE " + ficftp, "MDTM " + ficftp]
+    if ftp.type != "I":
+        commands.insert(0, "TYPE I")
+    size_reply, mtime_reply = (await ftp.pipeline(commands, check=False))[-2:]
+    size = int(_check(size_reply)[3:].strip())
+    mtime = mtime_reply[4:].strip() if mtime_reply.startswith("2") else None
+    checkpoint = tools.Checkpoint(ficdsk, {"remote": ficftp, "size": size, "mtime": mtime})
+    try:
+        with open(ficdsk, "ab+") as f:
+            offset = 0
+            if checkpoint.blocks:
+                offset = await loop.run_in_executor(None, checkpoint.resume_offset, f.seek(0, os.SEEK_END), f)
+            f.truncate(offset)
+            f.seek(offset)
+            checkpoint.start()
+
+            # Written and hashed in a thread like FTPSession.retrbinary
+            def write_block(data):
+                f.write(data)
+                checkpoint.update(data)
+
+            async def write(data):
+                await loop.run_in_executor(None, write_block, data)
+            await ftp.retrieve("RETR " + ficftp, write, rest=offset or None)
+            if f.tell() != size:
+                raise ftplib.error_temp("Size of " + ficdsk + " does not match " + ficftp + " on the server")
+        checkpoint.done()
+    finally:
+        checkpoint.close()
+    return size
+
+
+async def _upload_range(ftp, ficdsk, ficftp, offset, length):
+    """Upload length bytes of ficdsk from offset to the file ficftp, the whole file if length is None"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+    with open(ficdsk, "rb") as f:
+        f.seek(offset)
+
+        async def read():
+            nonlocal sent
+            data = await loop.run_in_executor(None, f.read, ftppool.BLOCK_SIZE if length is None else min(ftppool.BLOCK_SIZE, length - sent))
+            sent += len(data)
+            return data
+        return await ftp.store("STOR " + ficftp, read)
+
+
+async def _download_range(ftp, ficftp, ficdsk, base, offset, length, whole):
+    """Download length bytes of ficftp from offset, written at base + offset in ficdsk"""
+    loop = asyncio.get_running_loop()
+    with open(ficdsk, "r+b") as f:
+        f.seek(base + offset)
+
+        async def write(data):
+            await loop.run_in_executor(None, f.write, data)
+        # The rest of the file is not needed, the data connection is closed before its end
+        received = await ftp.retrieve("RETR " + ficftp, write, rest=offset or None, length=None if whole else length)
+    if received < length:
+        raise ftplib.error_temp("Transfer of " + ficftp + " interrupted at " + str(offset + received))
+    return received
+
+
+# Transfers of ftppool and their counterparts running in the event loop
+_TRANSFERS = {
+    ftppool._upload_file: _upload_file,
+    ftppool._download_file: _download_file,
+    ftppool._upload_range: _upload_range,
+    ftppool._download_range: _download_range,
+}
@@ -0,0 +1,785 @@
+import os
+import time
+import contextlib
+import configparser
+import tools
+import encrypt
+import pipeline
+import compress
+import incremental
+import ftprotation
+import retention
+import ftppool
+import governor
+import dbdump
+import binlog
+import chunkstore
+import scanner
+import archive
+import fileio
+import metrics
+import verify
+from scheduler import Scheduler, StageError
+
+# Backup of a WordPress site and of its database, as the tasks of a Scheduler (see scheduler.py)
+#
+#   rotate, key, scan, connect   : no dependency, they start together
+#   dump                         : after rotate and key
+#   site                         : after rotate, key and scan
+#   date                         : after dump and site
+#   encrypt-dump, -site, -date   : after the file they encrypt is written
+#   ftp-rotate                   : after connect and rotate
+#   upload-pack                  : after connect and site
+#   upload-dump, upload-site     : after ftp-rotate and the encryption of their files, and the pack for the site
+#   stream                       : after ftp-rotate and site, in streaming mode
+#   checksums                    : after the encryption of the files and the stream, checksums of the uploaded files
+#   upload-date                  : after all the other uploads, date.txt.bin marks a complete backup
+#   prune, finish                : delete the packs not used anymore, close the sessions and commit the scan
+#
+# The dump of the database runs while the site is archived and the FTP session is opened, and each
+# file is uploaded as soon as it is encrypted, so the backup takes the time of its longest chain of stages.
+# Each stage raises StageError with the message of the email sent when the backup fails, see backup-wp.py.
+#
+# Several sites are backed up in one process by run_jobs : their stages share the slots of a single
+# scheduler, which takes the next stage from the site with the fewest running stages.
+# Each site keeps its own folders, rotation, FTP sessions and report, and a site failing does not stop the others.
+
+MODES = ("full", "incremental", "dedup")
+
+
+class Settings:
+    """Parameters of a backup read from a configuration file, see README.md
+       - path: configuration file, ie /etc/backup-wp.conf
+       - site: optional, name of a site of the file, its sections <site>:<SECTION> override the sections SECTION
+    """
+    def __init__(self, path, site=None):
+        config = tools.read_config(path, site)
+        self.path = path
+        self.site = site or os.path.splitext(os.path.basename(path))[0]
+
+        self.wp_path = config.get('WP','WP_PATH')
+        self.db_host = config.get('DB','DB_HOST')
+        self.db_name = config.get('DB','DB_NAME')
+
+        self.smtp_host = config.get('SMTP','SMTP_HOST')
+        self.smtp_from = config.get('SMTP','SMTP_FROM')
+        self.smtp_to = config.get('SMTP','SMTP_TO')
+
+        self.retention = int(config.get('BACKUP','BACKUP_RETENTION'))
+        self.root_path = config.get('BACKUP','LOCALBKPATH')
+        if self.retention < 1:
+            raise ValueError("BACKUP_RETENTION must be at least 1 in " + path)
+        # Grandfather-father-son retention, see retention.py : the BACKUP_RETENTION newest backups are kept,
+        # and the first backup of each of the WEEKLY_RETENTION last weeks and MONTHLY_RETENTION last months
+        self.weekly_retention = config.getint('BACKUP','WEEKLY_RETENTION',fallback=0)
+        self.monthly_retention = config.getint('BACKUP','MONTHLY_RETENTION',fallback=0)
+        self.policy = {"daily": self.retention, "weekly": self.weekly_retention, "monthly": self.monthly_retention}
+        # Most snapshots kept at once, DAYJ ... DAYJ-(SNAPSHOTS-1)
+        self.snapshots = sum(self.policy.values())
+
+        self.keypath = config.get('ENCRYPT','KEYPATH')
+        # Encryption of the backup files : WORKERS threads encrypting segments of SEGMENT_SIZE bytes, see encrypt.py
+        # 0 means one thread per core
+        self.encryption_workers = config.getint('ENCRYPT','WORKERS',fallback=0)
+        self.encryption_segment_size = config.getint('ENCRYPT','SEGMENT_SIZE',fallback=encrypt.SEGMENT_SIZE)
+
+        self.ftp_server = config.get('BACKUP','FTP_SERVER')
+        self.ftp_user = config.get('BACKUP','FTP_USER')
+        self.ftp_passwd = config.get('BACKUP','FTP_PASSWD')
+        self.ftp_root_path = config.get('BACKUP','FTP_PATH')
+        self.ftp_port = config.getint('BACKUP','FTP_PORT',fallback=21)
+        # Number of FTP sessions used to transfer the files concurrently
+        self.ftp_connections = config.getint('BACKUP','FTP_CONNECTIONS',fallback=1)
+        # FTP_BACKEND : ftplib (default) or asyncio for pipelined commands and transfers in an event loop, see asyncftp.py
+        self.ftp_backend = config.get('BACKUP','FTP_BACKEND',fallback='ftplib')
+        if self.ftp_backend not in ftppool.BACKENDS:
+            raise ValueError("Unknown FTP_BACKEND " + self.ftp_backend + " in " + path)
+
+        # MODE : full (default) to make a full archive of the site each day
+        # or incremental to store only new or changed files, see incremental.py
+        # or dedup to store only the new chunks of the site archive, see chunkstore.py
+        self.mode = config.get('BACKUP','MODE',fallback='full')
+        if self.mode not in MODES:
+            raise ValueError("Unknown MODE " + self.mode + " in " + path)
+
+        # Streaming mode : the site archive is tarred, compressed, encrypted and uploaded in a single pass
+        # LOCAL_COPY : in streaming mode, keep a copy of the encrypted site archive in DAYJ
+        self.stream = config.getboolean('BACKUP','STREAM',fallback=False)
+        self.local_copy = config.getboolean('BACKUP','LOCAL_COPY',fallback=True)
+        if self.mode in ('incremental','dedup'):
+            # Only new or changed data is stored, there is no site archive to stream
+            self.stream = False
+
+        # Compression of the site archive and of the SQL dump, see compress.py for the list of codecs
+        # WORKERS : number of processes or threads used by pgzip and zstd, 0 means one per core
+        # MEDIA : yes to compress the media files of the site (images, videos, archives ...) like the others,
+        # they are stored with the fastest setting of the codec by default, see compress.classify
+        self.codec = config.get('COMPRESS','CODEC',fallback=compress.DEFAULT_CODEC)
+        try:
+            compress.check_codec(self.codec)
+        except ValueError as error:
+            raise ValueError(str(error) + " in " + path)
+        self.level = config.getint('COMPRESS','LEVEL',fallback=compress.DEFAULT_LEVEL)
+        self.compress_workers = config.getint('COMPRESS','WORKERS',fallback=0)
+        self.compress_media = config.getboolean('COMPRESS','MEDIA',fallback=False)
+
+        # Dump of the database : mysqldump (default) for a single SQL stream
+        # or parallel to export the tables and chunks of the big tables in parallel, see dbdump.py
+        # DUMP_JOBS : number of worker processes of the parallel dump, 0 means one per core
+        self.dump = config.get('DB','DUMP',fallback='mysqldump')
+        self.dump_jobs = config.getint('DB','DUMP_JOBS',fallback=0)
+        self.chunk_rows = config.getint('DB','CHUNK_ROWS',fallback=dbdump.CHUNK_ROWS)
+
+        # Capture of the binary logs between the dumps for restore-wp.py --until, see binlog.py and binlog-wp.py
+        # With a BINLOG section, each dump starts a new binary log and records its position
+        # SEGMENT_SECONDS, SEGMENT_SIZE : the new events are cut in a segment every SEGMENT_SECONDS seconds,
+        # a segment holding at most SEGMENT_SIZE bytes of events
+        # MYSQLBINLOG : command copying the binary logs, ie mariadb-binlog, mysqlbinlog by default
+        self.binlog = config.has_section('BINLOG')
+        self.binlog_seconds = config.getint('BINLOG','SEGMENT_SECONDS',fallback=binlog.SEGMENT_SECONDS)
+        self.binlog_size = config.getint('BINLOG','SEGMENT_SIZE',fallback=binlog.SEGMENT_SIZE)
+        self.mysqlbinlog = config.get('BINLOG','MYSQLBINLOG',fallback='mysqlbinlog')
+        self.binlog_path = self.root_path + "/binlog"
+
+        # Changes of the site folder are detected with a stat cache, see scanner.py
+        # SCAN_WORKERS : number of threads listing the folders of the site
+        self.scan_workers = config.getint('BACKUP','SCAN_WORKERS',fallback=scanner.WORKERS)
+        self.scan_cache = self.root_path + "/" + scanner.CACHE
+
+        # Slots of the scheduler, see scheduler.py : CPU (0 means one per core) and IO,
+        # the FTP slots are the FTP_CONNECTIONS sessions
+        self.cpu_slots = config.getint('SCHEDULER','CPU',fallback=0) or os.cpu_count() or 1
+        self.io_slots = config.getint('SCHEDULER','IO',fallback=2)
+        # FTP : FTP sessions of all the sites of a batch backup
+        self.ftp_slots = config.getint('SCHEDULER','FTP',fallback=self.ftp_connections)
+
+        # Rates and priorities of the backup while the site is serving, see governor.py
+        # UPLOAD_RATE, DOWNLOAD_RATE, DISK_RATE : schedules of the rates, ie 08:00-20:00=2M, no limit by default
+        # NICE, IONICE : priority of the child processes, ie 10 and idle
+        # LOAD_MAX, SITE_URL, LATENCY_MAX : the rates are backed off when the load average per core
+        # or the response time of SITE_URL is above these limits, measured every INTERVAL seconds
+        # MIN_RATE : rate backed off for a kind with no limit before its throughput is measured
+        self.governed = config.has_section('GOVERNOR')
+        self.schedules = {kind: governor.Schedule(config.get('GOVERNOR',kind.upper() + '_RATE',fallback='')) for kind in governor.KINDS}
+        self.nice = config.getint('GOVERNOR','NICE',fallback=0)
+        self.ionice = config.get('GOVERNOR','IONICE',fallback='')
+        self.load_max = config.getfloat('GOVERNOR','LOAD_MAX',fallback=0.0)
+        self.site_url = config.get('GOVERNOR','SITE_URL',fallback=None)
+        self.latency_max = config.getfloat('GOVERNOR','LATENCY_MAX',fallback=1.0)
+        self.governor_interval = config.getfloat('GOVERNOR','INTERVAL',fallback=governor.INTERVAL)
+        self.min_rate = governor.parse_rate(config.get('GOVERNOR','MIN_RATE',fallback='1M')) or governor.MIN_RATE
+        if self.ionice and self.ionice.partition(':')[0] not in governor.IOPRIO_CLASSES:
+            raise ValueError("Unknown IONICE " + self.ionice + " in " + path)
+
+        # Timings and sizes of the stages are written in DAYJ/backup-report.json, see metrics.py
+        # TEXTFILE_DIR : optional, folder of the textfile collector of node_exporter where the metrics are also written
+        self.textfile_dir = config.get('METRICS','TEXTFILE_DIR',fallback=None)
+
+    def resources(self):
+        """Return the slots of the scheduler running the backup"""
+        return {"cpu": self.cpu_slots, "io": self.io_slots, "ftp": self.ftp_slots}
+
+    def governor(self):
+        """Return the governor.Governor of the backup, None without GOVERNOR section"""
+        if not self.governed:
+            return None
+        return governor.Governor(self.schedules,self.nice,self.ionice,self.load_max,self.site_url,self.latency_max,self.governor_interval,self.min_rate)
+
+
+def read_sites(paths):
+    """Return the Settings of the sites described by the configuration files paths
+       A file with sections <site>:<SECTION> gives one site per name, the sections without a site giving
+       the values shared by its sites, else the file is a single site named after the file.
+       raise ValueError if two sites use the same local folder or the same FTP folder
+    """
+    sites = []
+    for path in paths:
+        config = configparser.ConfigParser()
+        if not config.read(path):
+            raise ValueError("Can not read " + path)
+        names = tools.site_names(config)
+        if names:
+            sites += [Settings(path, name) for name in names]
+        else:
+            sites.append(Settings(path))
+    for index, settings in enumerate(sites):
+        for other in sites[:index]:
+            if settings.site == other.site:
+                raise ValueError("Site " + settings.site + " defined twice")
+            if settings.root_path == other.root_path:
+                raise ValueError("Sites " + other.site + " and " + settings.site + " use the same LOCALBKPATH")
+            if (settings.ftp_server, settings.ftp_port, settings.ftp_root_path) == (other.ftp_server, other.ftp_port, other.ftp_root_path):
+                raise ValueError("Sites " + other.site + " and " + settings.site + " use the same FTP_PATH")
+    return sites
+
+
+@contextlib.contextmanager
+def governed(jobs):
+    """Run the jobs under the governor of the settings of the first job, if any, see governor.py
+       The seconds waited for the rates are added to the report of each job.
+    """
+    backup_governor = jobs[0].settings.governor()
+    if backup_governor is None:
+        yield
+        return
+    governor.install(backup_governor)
+    try:
+        yield
+    finally:
+        governor.uninstall()
+        for job in jobs:
+            job.run.info["governor"] = backup_governor.stats()
+
+
+def run_jobs(jobs, resources=None):
+    """Run the backups jobs on a shared scheduler, return the scheduler
+       - resources: slots shared by the jobs, the ones of the settings of the first job by default
+       The failure of each job, if any, is in scheduler.failures by job name. The sessions and files
+       of the failed jobs are closed.
+       The jobs are governed by the GOVERNOR section of the first job, the rates being shared by the sites.
+    """
+    scheduler = Scheduler(resources or jobs[0].settings.resources())
+    for job in jobs:
+        job.add_tasks(scheduler)
+    try:
+        with governed(jobs):
+            scheduler.run()
+    except StageError:
+        for job in jobs:
+            if job.name in scheduler.failures:
+                job.close()
+    return scheduler
+
+
+class BackupJob:
+    """Backup of the site and of the database described by settings
+       - settings: Settings of the backup
+       - verbose: 0 disable verbose, 1 minimal verbose, 2 debug mode
+       - run: optional metrics.Run measuring the stages, a new one by default
+       - name: optional, name of the job, prefix of the names of its tasks and site of its report,
+         to schedule several jobs together
+    """
+    def __init__(self, settings, verbose=0, run=None, name=""):
+        self.settings = settings
+        self.verbose = verbose
+        self.name = name
+        self.today = time.strftime('%Y%m%d')
+        if run is None:
+            info = {"site": name} if name else {}
+            run = metrics.Run("backup",date=self.today,mode=settings.mode,codec=settings.codec,dump=settings.dump,**info)
+        self.run = run
+        self.prefix = name + ":" if name else ""
+
+        # Snapshots of LOCALBKPATH, see retention.py
+        self.catalog = retention.Catalog(settings.root_path)
+        newest = self.catalog.path(0)
+        if newest is not None and (self.catalog.snapshots[0]["date"] == self.today or not os.path.exists(newest + "/date.txt")):
+            # The backup of today, or the last one which did not complete, is written again
+            self.snapshot_id = self.catalog.snapshots[0]["id"]
+        else:
+            self.snapshot_id = retention.new_id()
+        self.backup_path = retention.tier_path(settings.root_path, "daily", self.snapshot_id)
+        self.datefile = self.backup_path + "/date.txt"
+        self.date_in_file = None
+        self.rotation = False
+        self.key = None
+        if settings.dump == 'parallel':
+            self.db_backup = self.backup_path + "/" + settings.db_name + dbdump.DUMP_SUFFIX
+        else:
+            self.db_backup = self.backup_path + "/" + settings.db_name + ".sql.gz"
+        self.wp_archive = self.backup_path + "/" + "wordpress.site.tar.gz"
+        # Index of the members of the archive, used for selective and parallel restores, see archive.py
+        self.site_index = self.backup_path + "/" + archive.INDEX
+        # Checksums of the uploaded files, compared with the ones of the server by verify-wp.py, see verify.py
+        self.sums = self.backup_path + "/" + verify.SUMS
+        self.stream_checksum = None
+        self.site_scanner = None
+        self.site_counters = {"pack": False}
+        self.site_reused = False
+        self.stream = settings.stream
+        # Encrypted files of the site to upload, known once the site is saved
+        self.site_files = []
+        self.new_pack = None
+        self.chunk_store = None
+        self.ftpserver = None
+        self.ftp_pool = None
+        self.ftp_state = None
+        self.ftp_path = None
+        if settings.mode == 'dedup':
+            self.pack_path = settings.root_path + "/" + chunkstore.CHUNK_DIR
+            self.remote_pack_path = chunkstore.CHUNK_DIR
+        else:
+            self.pack_path = settings.root_path + "/" + incremental.PACK_DIR
+            self.remote_pack_path = incremental.PACK_DIR
+
+    def log(self, level, text=""):
+        if self.verbose >= level:
+            print(self.prefix + " " + text if self.prefix and text else text)
+
+    def add_tasks(self, scheduler):
+        """Add the stages of the backup to scheduler"""
+        def add(name, func, deps=(), resources=None, message=None):
+            scheduler.add(self.prefix + name, func, deps=[self.prefix + dep for dep in deps], resources=resources, message=message, group=self.name)
+        add("rotate", self.rotate_local, resources={"io": 1}, message="Error during rotation of local backup folders")
+        add("key", self.read_key, message="Error during read of the encryption key " + self.settings.keypath)
+        add("scan", self.scan, resources={"io": 1}, message="Error during scan of Wordpress site")
+        add("connect", self.connect, resources={"ftp": 1})
+        add("dump", self.dump_database, deps=("rotate", "key"), resources={"cpu": 1, "io": 1})
+        add("site", self.save_site, deps=("rotate", "key", "scan"), resources={"cpu": 1, "io": 1})
+        add("date", self.write_date, deps=("dump", "site"), message="Error during create of DATEFILE")
+        if self.settings.dump == 'parallel':
+            add("encrypt-dump", self.encrypt_dump, deps=("dump",), resources={"cpu": 1})
+        add("encrypt-site", self.encrypt_site, deps=("site",), resources={"cpu": 1})
+        add("encrypt-date", self.encrypt_date, deps=("date",), resources={"cpu": 1})
+        add("ftp-rotate", self.rotate_ftp, deps=("connect", "rotate"), resources={"ftp": 1}, message="Error during rotation of FTP folders")
+        add("upload-pack", self.upload_pack, deps=("connect", "site"), resources={"ftp": 1})
+        add("upload-dump", self.upload_dump, deps=("dump", "encrypt-dump", "ftp-rotate"), resources={"ftp": 1})
+        add("upload-site", self.upload_site, deps=("encrypt-site", "ftp-rotate", "upload-pack"), resources={"ftp": 1})
+        add("stream", self.stream_site, deps=("site", "ftp-rotate"), resources={"cpu": 1, "io": 1, "ftp": 1})
+        add("checksums", self.write_checksums, deps=("dump", "encrypt-dump", "encrypt-site", "encrypt-date", "stream"), resources={"cpu": 1, "io": 1}, message="Error during checksum of the backup files")
+        add("upload-date", self.upload_date, deps=("checksums", "upload-dump", "upload-site", "stream"), resources={"ftp": 1})
+        add("prune", self.prune_packs, deps=("upload-date",), resources={"io": 1, "ftp": 1}, message="Error during delete of the packs not used anymore")
+        add("finish", self.finish, deps=("prune",))
+
+    def execute(self):
+        """Run the backup on its own scheduler, return the scheduler
+           raise StageError when a stage fails
+        """
+        scheduler = Scheduler(self.settings.resources())
+        self.add_tasks(scheduler)
+        with governed([self]):
+            scheduler.run()
+        return scheduler
+
+    @contextlib.contextmanager
+    def session(self):
+        """Give an idle FTP session of the pool, in the folder FTP_PATH
+           The session is replaced by a new one when the block fails, it may be in the middle of a transfer.
+        """
+        session = self.ftp_pool.acquire()
+        try:
+            yield session.ftp
+        except BaseException:
+            self.ftp_pool.release(session, broken=True)
+            raise
+        self.ftp_pool.release(session)
+
+    def _encrypt(self, files):
+        for file in files:
+            file_name = os.path.basename(file)
+            self.log(2, "Encrypt file " + file_name)
+            try:
+                with self.run.stage("encrypt") as stage:
+                    # Encrypted in the thread of the task, pycryptodome releases the GIL, see encrypt.py
+                    encrypt_stats = encrypt.encrypt_file(file, self.key, self.settings.encryption_segment_size, self.settings.encryption_workers)
+                    stage.add(encrypt_stats["bytes"],os.path.getsize(file + ".bin"))
+            except Exception:
+                raise StageError("Error during encryption of file " + file_name)
+            self.log(2, "  %d bytes encrypted at %.1f MB/s" % (encrypt_stats["bytes"],encrypt_stats["mb_per_s"]))
+
+    def _upload(self, files, folder, message):
+        for file in files:
+            self.log(1, "Transfering " + file + " to " + folder)
+        try:
+            with self.run.stage("upload") as stage:
+                ftp_stats = self.ftp_pool.upload_files(files,folder)
+                stage.add(ftp_stats["bytes"],ftp_stats["bytes"])
+        except Exception:
+            raise StageError(message)
+        self.log(1, "Transferred %d bytes at %.1f MB/s" % (ftp_stats["bytes"],ftp_stats["mb_per_s"]))
+        if self.verbose == 2:
+            for connection in ftp_stats["connections"]:
+                print("  connection %d : %d transfers, %d bytes, %.1f MB/s" % (connection["connection"],connection["transfers"],connection["bytes"],connection["mb_per_s"]))
+
+    def scan_changes(self):
+        """Scan the site without updating the stat cache, return the Scanner and the counters of the scan"""
+        os.makedirs(self.settings.root_path, exist_ok=True)
+        site_scanner = scanner.Scanner(self.settings.scan_cache)
+        return site_scanner, site_scanner.scan(self.settings.wp_path,self.settings.scan_workers)
+
+    def rotate_local(self):
+        """Create the folder of the snapshot of the backup, then promote and prune the older snapshots, see retention.py"""
+        settings = self.settings
+        catalog = self.catalog
+        self.log(2)
+        if catalog.legacy:
+            self.log(2, "Adoption of the local backup folders DAYJ, DAYJ-1 ... as daily snapshots")
+            try:
+                catalog.adopt()
+            except Exception:
+                raise StageError("Error during adoption of the local backup folders of " + settings.root_path)
+        if catalog.path(0) is not None and os.path.exists(catalog.path(0) + "/date.txt"):
+            with open(catalog.path(0) + "/date.txt","r") as datefile:
+                self.date_in_file = datefile.readline()
+        if catalog.snapshots and catalog.snapshots[0]["id"] == self.snapshot_id:
+            # Backup already occured today, or the last one did not complete, so no ROTATION needed
+            self.log(2, "ROTATION = False ")
+            if catalog.snapshots[0]["date"] != self.today:
+                catalog.snapshots[0]["date"] = self.today
+                catalog.save()
+            os.makedirs(self.backup_path, exist_ok=True)
+            return
+        self.rotation = bool(catalog.snapshots)
+        self.log(2, "Create folder " + self.backup_path)
+        catalog.add(self.snapshot_id,self.today)
+        if not self.rotation:
+            return
+        self.log(2)
+        self.log(2, "Local backup folders rotation")
+        self.log(2)
+        try:
+            promoted, expired = catalog.apply(settings.policy,self.release_chunks)
+        except Exception:
+            raise StageError("Error during rotation of the local snapshots of " + settings.root_path)
+        for snapshot_id, tier in promoted:
+            self.log(2, "Snapshot " + snapshot_id + " promoted to " + tier)
+        for snapshot_id in expired:
+            self.log(2, "Delete of snapshot " + snapshot_id)
+
+    def release_chunks(self, path):
+        """Release the chunks of the recipe of the folder of an expired snapshot, see chunkstore.py"""
+        if os.path.exists(self.settings.root_path + "/" + chunkstore.CHUNK_DIR + "/" + chunkstore.INDEX):
+            chunk_store = chunkstore.ChunkStore(self.settings.root_path + "/" + chunkstore.CHUNK_DIR)
+            chunk_store.release(path + "/" + chunkstore.RECIPE)
+            chunk_store.close()
+
+    def previous_path(self):
+        """Return the folder of the last backup, the one of this backup if it is written again"""
+        if self.rotation and self.catalog.path(1) is not None:
+            return self.catalog.path(1)
+        return self.backup_path
+
+    def read_key(self):
+        with open(self.settings.keypath,'rb') as fdKey:
+            self.key = fdKey.read()
+
+    def scan(self):
+        """Changes of the site since the last backup, see scanner.py"""
+        with self.run.stage("scan"):
+            self.site_scanner, scan_counters = self.scan_changes()
+        self.log(2, "%d entries scanned : %d added, %d changed, %d deleted" % (scan_counters["entries"],scan_counters["added"],scan_counters["changed"],scan_counters["deleted"]))
+
+    def dump_database(self):
+        settings = self.settings
+        self.log(1)
+        self.log(1, "Starting Backup of MySQL")
+        if settings.dump == 'parallel':
+            try:
+                with self.run.stage("dump") as stage:
+                    dump_counters = dbdump.dump({"host": settings.db_host, "database": settings.db_name},self.db_backup,settings.dump_jobs,settings.chunk_rows,settings.codec,settings.level,settings.binlog)
+                    stage.add(bytes_out=os.path.getsize(self.db_backup))
+            except Exception:
+                raise StageError("Error during parallel dump of MySQL")
+            self.log(2, "%d rows of %d tables dumped in %d chunks" % (dump_counters["rows"],dump_counters["tables"],dump_counters["chunks"]))
+        else:
+            # mysqldump output is compressed and encrypted on the fly, see pipeline.stream_command
+            dumpcmd = ["mysqldump","-h",settings.db_host,settings.db_name]
+            if settings.binlog:
+                dumpcmd[1:1] = ["--single-transaction","--flush-logs","--master-data=2"]
+            try:
+                with self.run.stage("dump") as stage:
+                    dump_stats = pipeline.stream_command(dumpcmd,self.db_backup + ".bin",self.key,settings.codec,settings.level,settings.compress_workers)
+                    stage.add(dump_stats["bytes_in"],dump_stats["bytes_out"])
+            except Exception:
+                raise StageError("Error during mysqldump")
+        self.log(2, "Local MySQL dump copied in " + self.db_backup)
+        self.log(1)
+        self.log(1, "Backup of MySQL completed")
+
+    def save_site(self):
+        """Store the site folder as an archive, a manifest and a pack or a recipe, depending on MODE"""
+        settings = self.settings
+        self.log(1)
+        self.log(1, "Starting backup of Wordpress Site folder")
+        # Folder of the last backup, its site backup is reused when nothing changed since
+        previous_path = self.previous_path()
+        site_unchanged = self.site_scanner.unchanged() and self.date_in_file is not None and self.site_scanner.tag == self.date_in_file
+        if settings.mode == 'incremental':
+            os.makedirs(self.pack_path, exist_ok=True)
+            site_manifest = self.backup_path + "/" + incremental.MANIFEST
+            # Compare with the backup already made today if any, else with the one of yesterday
+            if os.path.exists(site_manifest):
+                previous_manifest = site_manifest
+            else:
+                previous_manifest = (self.catalog.path(1) or self.backup_path) + "/" + incremental.MANIFEST
+            self.new_pack = self.pack_path + "/" + incremental.new_pack_id() + incremental.PACK_SUFFIX
+            try:
+                with self.run.stage("site") as stage:
+                    self.site_counters = incremental.backup_site(settings.wp_path,site_manifest,previous_manifest,self.new_pack,self.key,settings.codec,settings.level,self.site_scanner.entries(),settings.compress_media)
+                    if self.site_counters["pack"]:
+                        stage.add(bytes_out=os.path.getsize(self.new_pack))
+            except Exception:
+                raise StageError("Error during incremental backup of Wordpress site")
+            self.report_classes(self.site_counters["classes"],"objects")
+            self.site_files = [site_manifest]
+            self.log(2, "Local Wordpress site manifest written in " + site_manifest)
+            self.log(2, str(self.site_counters["changed"]) + " new or changed files out of " + str(self.site_counters["files"]) + " stored in " + self.new_pack)
+            self.log(1)
+            self.log(1, "Incremental backup of Wordpress Site folder completed")
+        elif settings.mode == 'dedup':
+            site_recipe = self.backup_path + "/" + chunkstore.RECIPE
+            new_pack_id = incremental.new_pack_id()
+            self.new_pack = self.pack_path + "/" + new_pack_id + incremental.PACK_SUFFIX
+            self.chunk_store = chunkstore.ChunkStore(self.pack_path,self.key,settings.codec,settings.level,settings.compress_media)
+            self.site_reused = site_unchanged and os.path.exists(previous_path + "/" + chunkstore.RECIPE)
+            try:
+                with self.run.stage("site") as stage:
+                    if self.site_reused:
+                        # Nothing changed since the last backup, its recipe is copied instead of reading the site again
+                        if previous_path != self.backup_path:
+                            self.chunk_store.copy_recipe(previous_path + "/" + chunkstore.RECIPE,site_recipe)
+                        self.site_counters = {"pack": False}
+                    else:
+                        self.site_counters = chunkstore.backup_tree(self.chunk_store,settings.wp_path,site_recipe,new_pack_id)
+                    if self.site_counters["pack"]:
+                        stage.add(bytes_out=os.path.getsize(self.new_pack))
+            except Exception:
+                raise StageError("Error during deduplicated backup of Wordpress site")
+            self.site_files = [site_recipe]
+            self.log(2, "Local Wordpress site recipe written in " + site_recipe)
+            if self.site_reused:
+                self.log(2, "No change since the backup of " + self.date_in_file + ", recipe reused")
+            else:
+                self.report_classes(self.site_counters["classes"],"objects")
+                self.log(2, str(self.site_counters["new_chunks"]) + " new chunks out of " + str(self.site_counters["chunks"]) + " stored in " + self.new_pack)
+            self.log(1)
+            self.log(1, "Deduplicated backup of Wordpress Site folder completed")
+        elif site_unchanged and os.path.exists(previous_path + "/" + os.path.basename(self.wp_archive) + ".bin"):
+            # Nothing changed since the last backup, its encrypted archive is copied (in the kernel, see fileio.py) instead of archiving the site again
+            self.site_reused = True
+            self.stream = False
+            try:
+                with self.run.stage("site"):
+                    if previous_path != self.backup_path:
+                        fileio.copy_file(previous_path + "/" + os.path.basename(self.wp_archive) + ".bin",self.wp_archive + ".bin")
+                        if os.path.exists(previous_path + "/" + archive.INDEX + ".bin"):
+                            fileio.copy_file(previous_path + "/" + archive.INDEX + ".bin",self.site_index + ".bin")
+            except Exception:
+                raise StageError("Error during copy of the Wordpress site archive of " + previous_path)
+            self.log(1)
+            self.log(1, "No change since the backup of " + self.date_in_file + ", Wordpress Site archive reused")
+        elif self.stream:
+            # The archive is streamed directly to the FTP server by stream_site
+            self.log(1)
+            self.log(1, "Streaming mode : Wordpress Site folder will be archived during the copy to FTP Server")
+        else:
+            # The archive is compressed in independent blocks and its members are indexed, see archive.py
+            try:
+                with self.run.stage("site") as stage:
+                    site_stats = archive.write_archive(settings.wp_path,self.wp_archive,self.site_index,settings.codec,settings.level,settings.compress_workers,settings.compress_media)
+                    stage.add(site_stats["bytes_in"],site_stats["bytes_out"])
+            except Exception:
+                raise StageError("Error during Tar GZ of of Wordpress site")
+            self.report_classes(site_stats["classes"],"files")
+            self.site_files = [self.wp_archive,self.site_index]
+            self.log(2, "Local Wordpress site dump copied in " + self.wp_archive)
+            self.log(2, "Index of the archive written in " + self.site_index)
+            self.log(1)
+            self.log(1, "Backup of  Wordpress Site folder completed")
+
+    def report_classes(self, classes, count):
+        """Add the stats of the text and the media of the site to the report, see compress.classify
+           - count: name of the number of items of each class, files or objects of the packs
+        """
+        self.run.info["classes"] = {name: dict(stats, seconds=round(stats["seconds"], 3)) for name, stats in classes.items()}
+        for name, stats in classes.items():
+            self.log(2, "%-5s : %d %s, %.1f MB compressed to %.1f MB in %.2f s" % (name, stats[count], count, stats["bytes_in"] / 1e6, stats["bytes_out"] / 1e6, stats["seconds"]))
+
+    def write_date(self):
+        with open(self.datefile,"w") as datefile:
+            datefile.write(self.today)
+
+    def encrypt_dump(self):
+        self._encrypt([self.db_backup])
+
+    def encrypt_site(self):
+        self._encrypt(self.site_files)
+
+    def encrypt_date(self):
+        self._encrypt([self.datefile])
+
+    def site_uploads(self):
+        """Return the encrypted files of the site to upload"""
+        files = [file + ".bin" for file in self.site_files]
+        if self.site_reused and self.settings.mode == 'full':
+            files.append(self.wp_archive + ".bin")
+            if os.path.exists(self.site_index + ".bin"):
+                files.append(self.site_index + ".bin")
+        return files
+
+    def connect_ftp(self):
+        connectftp = ftppool.backend(self.settings.ftp_backend)[0]
+        ftp = connectftp(self.settings.ftp_server,self.settings.ftp_user,self.settings.ftp_passwd,port=self.settings.ftp_port)
+        ftp.cwd(self.settings.ftp_root_path)
+        return ftp
+
+    def connect(self):
+        """Open the first FTP session and the pool, and read the state of the remote folders"""
+        settings = self.settings
+        self.log(1)
+        self.log(1, "Starting Copy to FTP Server")
+        self.log(1)
+        connectftp, pool_class = ftppool.backend(settings.ftp_backend)
+        try:
+            self.ftpserver = connectftp(settings.ftp_server,settings.ftp_user,settings.ftp_passwd,port=settings.ftp_port)
+        except Exception:
+            raise StageError("Error during connection to FTP Server " + settings.ftp_server + " : please check FTP parameters")
+        try:
+            self.ftpserver.cwd(settings.ftp_root_path)
+        except Exception:
+            raise StageError("Error during CWD on FTP Server " + settings.ftp_server + " : please check BACKUP_PATH parameter")
+        # Files are transferred over a pool of FTP_CONNECTIONS sessions, see ftppool.py
+        self.ftp_pool = pool_class(self.connect_ftp,settings.ftp_connections,first=self.ftpserver)
+        self.log(2, "Init : Create FTP folder if not existing")
+        # The remote snapshots DAYJ, DAYJ-1 ... are described by a state file, see ftprotation.py
+        try:
+            with self.session() as ftp:
+                self.ftp_state = ftprotation.init(ftp)
+        except ValueError as error:
+            # Corrupt or unsupported rotation state file
+            raise StageError(str(error) + " in " + settings.ftp_root_path)
+        except Exception:
+            raise StageError("Error during init of FTP folders in " + settings.ftp_root_path)
+
+    def rotate_ftp(self):
+        """Rotate the remote folders, the reused folder is emptied before the new backup is uploaded"""
+        slots = self.ftp_state["slots"]
+        with self.session() as ftp:
+            # The remote snapshot has the ID of the local one, it is only created once
+            if not slots or slots[0]["id"] != self.snapshot_id:
+                self.log(2)
+                self.log(2, "FTP folders rotation")
+                deleted_files = ftprotation.rotate(ftp,self.ftp_state,self.snapshot_id,self.today,self.settings.policy)
+                for file in deleted_files:
+                    self.log(2, "Delete file " + file)
+                self.log(2, "DAYJ is now folder " + ftprotation.slot_dir(self.ftp_state,0))
+                self.log(2)
+            elif slots[0]["date"] != self.today:
+                slots[0]["date"] = self.today
+                ftprotation.save_state(ftp,self.ftp_state)
+        self.ftp_path = ftprotation.slot_dir(self.ftp_state,0)
+
+    def upload_pack(self):
+        """The pack must be on the server before the manifest or the recipe referencing it"""
+        if self.settings.mode not in ('incremental','dedup') or not self.site_counters["pack"]:
+            return
+        with self.session() as ftp:
+            try:
+                ftp.cwd(self.remote_pack_path)
+            except Exception:
+                ftp.mkd(self.remote_pack_path)
+            else:
+                ftp.cwd("..")
+        self._upload([self.new_pack],self.remote_pack_path,"Error during transfer of " + self.new_pack)
+
+    def upload_dump(self):
+        self._upload([self.db_backup + ".bin"],self.ftp_path,"Error during transfer of files to FTP Server " + self.settings.ftp_server)
+
+    def upload_site(self):
+        files = self.site_uploads()
+        if files:
+            self._upload(files,self.ftp_path,"Error during transfer of files to FTP Server " + self.settings.ftp_server)
+
+    def stream_site(self):
+        """Archive, compress and encrypt the site while it is uploaded, then upload the index of the archive"""
+        if not self.stream:
+            return
+        settings = self.settings
+        self.log(1, "Streaming Wordpress Site folder to " + self.ftp_path)
+        if settings.local_copy:
+            tee_path = self.wp_archive + ".bin"
+        else:
+            tee_path = None
+        ficftp = self.ftp_path + "/" + os.path.basename(self.wp_archive) + ".bin"
+        try:
+            with self.run.stage("stream") as stage, self.session() as ftp:
+                self.stream_checksum = verify.Checksum()
+                stream_stats = pipeline.stream_archive(ftp,settings.wp_path,ficftp,self.key,codec=settings.codec,level=settings.level,workers=settings.compress_workers,tee_path=tee_path,index_path=self.site_index,checksum=self.stream_checksum,media=settings.compress_media)
+                stage.add(stream_stats["bytes_in"],stream_stats["bytes_out"])
+            self.report_classes(stream_stats["classes"],"files")
+            # The index is only complete once the archive is written
+            self._encrypt([self.site_index])
+            self._upload([self.site_index + ".bin"],self.ftp_path,"Error during transfer of " + self.site_index)
+        except Exception:
+            # The partial archive is not left in DAYJ, over a new session
+            try:
+                with self.session() as ftp:
+                    ftp.delete(ficftp)
+            except Exception:
+                pass
+            raise StageError("Error during streaming of Wordpress site to FTP Server " + settings.ftp_server)
+
+    def write_checksums(self):
+        """Write the checksums of the encrypted files of the backup and of the packs it references, see verify.py"""
+        settings = self.settings
+        files = {os.path.basename(file): file for file in [self.db_backup + ".bin",self.datefile + ".bin"] + self.site_uploads()}
+        if self.stream:
+            files[os.path.basename(self.site_index) + ".bin"] = self.site_index + ".bin"
+        with self.run.stage("checksums") as stage:
+            sums = verify.checksums(files,settings.ftp_connections)
+            if self.stream:
+                sums[os.path.basename(self.wp_archive) + ".bin"] = self.stream_checksum.entry()
+            if settings.mode == 'incremental':
+                pack_ids = incremental.referenced_packs([self.backup_path + "/" + incremental.MANIFEST])
+            elif settings.mode == 'dedup':
+                pack_ids = chunkstore.recipe_packs(self.backup_path + "/" + chunkstore.RECIPE)
+            else:
+                pack_ids = set()
+            # The packs are never rewritten, their checksums are the ones of the last backup
+            previous_path = self.previous_path()
+            previous = verify.load_sums(previous_path + "/" + verify.SUMS)
+            packs = {"../" + self.remote_pack_path + "/" + pack_id + incremental.PACK_SUFFIX: self.pack_path + "/" + pack_id + incremental.PACK_SUFFIX for pack_id in pack_ids}
+            sums.update(verify.checksums(packs,settings.ftp_connections,previous))
+            verify.write_sums(self.sums,sums,self.today)
+            stage.add(sum(entry["size"] for entry in sums.values()))
+        self._encrypt([self.sums])
+
+    def upload_date(self):
+        self._upload([self.sums + ".bin",self.datefile + ".bin"],self.ftp_path,"Error during transfer of files to FTP Server " + self.settings.ftp_server)
+
+    def prune_packs(self):
+        """Delete the local and remote packs not referenced anymore by the backups of the retention folders"""
+        settings = self.settings
+        if settings.mode not in ('incremental','dedup'):
+            return
+        if settings.mode == 'incremental':
+            # Delete the packs not referenced anymore by the manifests of the snapshots
+            manifests = [path + "/" + incremental.MANIFEST for path in self.catalog.paths()]
+            keep = incremental.referenced_packs(manifests)
+            deleted_packs = incremental.prune_packs(self.pack_path,keep)
+        else:
+            # Delete the packs without any chunk referenced by the recipes of the retention folders
+            deleted_packs = self.chunk_store.collect()
+            keep = self.chunk_store.live_packs()
+            self.chunk_store.close()
+        for file in deleted_packs:
+            self.log(2, "Delete local pack " + file)
+        with self.session() as ftp:
+            for file in ftp.nlst(self.remote_pack_path):
+                file = os.path.basename(file)
+                # Large packs may have been uploaded in parts
+                pack = tools.partof(file)
+                if pack.endswith(incremental.PACK_SUFFIX) and pack[:-len(incremental.PACK_SUFFIX)] not in keep:
+                    self.log(2, "Delete FTP pack " + file)
+                    ftp.delete(self.remote_pack_path + "/" + file)
+
+    def close(self):
+        """Close the sessions and the files of a failed backup"""
+        for close in (self.ftp_pool and self.ftp_pool.close, self.ftpserver and self.ftpserver.close,
+                      self.site_scanner and self.site_scanner.close, self.chunk_store and self.chunk_store.close):
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+    def finish(self):
+        self.ftp_pool.close()
+        tools.closeftp(self.ftpserver)
+        # The backup is complete, the scan becomes the stat cache compared with the next backup
+        self.site_scanner.commit(self.today)
+        self.site_scanner.close()
+        # The run of a site of a batch ends with its last stage, not with the batch
+        self.run.finish()
+        self.log(1)
+        self.log(1, "Copy to FTP Server completed")
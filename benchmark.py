@@ -0,0 +1,1104 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to benchmark the stages of the backup and restore scripts
+# against local stand-ins of the servers (pyftpdlib for the FTP server).
+#
+# Needs the python module pyftpdlib for the FTP benchmarks, and pyOpenSSL and the openssl command
+# for the end-to-end benchmark (FTP over TLS like the production server)
+# Needs the python module pymysql, a local MariaDB or MySQL server and the mysqldump and mysql
+# clients for the database benchmarks, credentials are read from ~/.my.cnf, and the binary log enabled
+# with the mysqlbinlog client for the point-in-time restore benchmark
+#
+##########################################################
+
+import io
+import os
+import sys
+import json
+import zlib
+import math
+import time
+import hashlib
+import sqlite3
+import configparser
+import socketserver
+import random
+import shutil
+import string
+import subprocess
+import ftplib
+import logging
+import argparse
+import tempfile
+import threading
+import ftprotation
+import retention
+import ftppool
+import tools
+import dbdump
+import binlog
+import fileio
+import resource
+import chunkstore
+import scanner
+import encrypt
+import compress
+import tarfile
+
+FTP_USER = "bench"
+FTP_PASSWD = "bench"
+
+
+class CountingFTP(ftplib.FTP):
+    """ftplib.FTP counting the commands sent to the server, ie the round-trips"""
+    commands = 0
+
+    def putcmd(self, line):
+        self.commands += 1
+        super().putcmd(line)
+
+
+def start_ftp_server(root, certfile=None, latency=0.0):
+    """Start a local pyftpdlib server serving root in a thread, return its port
+       - certfile: optional, certificate and key in PEM format, the server then supports FTP over TLS
+       - latency: optional, round-trip time in seconds added to every exchange with the server
+       pyftpdlib uses a single event loop per process, so only one server can be started.
+       Over TLS, each session is served by its own thread : in the shared event loop, a TLS session
+       may stop being polled while another one is handshaking its data connection.
+       The latency is injected by the thread of the session, which waits before handling what it
+       receives on the control connection (commands sent together wait once) and before accepting
+       a data connection, so the sessions are served by their own thread too.
+       The server computes the checksums of its files (HASH with SHA-256 or CRC32, and XCRC), see verify.py.
+    """
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+    except ImportError:
+        raise SystemExit("FTP benchmarks need the python module pyftpdlib")
+    logger = logging.getLogger("pyftpdlib")
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWD, root, perm="elradfmwMT")
+    if certfile:
+        try:
+            from pyftpdlib.handlers import TLS_FTPHandler
+        except ImportError:
+            raise SystemExit("FTP over TLS needs the python module pyOpenSSL")
+        handler = type("BenchHandler", (TLS_FTPHandler,), dict(checksum_commands(TLS_FTPHandler), authorizer=authorizer, certfile=certfile))
+    else:
+        handler = type("BenchHandler", (FTPHandler,), dict(checksum_commands(FTPHandler), authorizer=authorizer))
+    if latency:
+        base = handler
+
+        def handle_read(self):
+            time.sleep(latency)
+            base.handle_read(self)
+
+        def dtp_init(self, sock, cmd_channel):
+            time.sleep(latency)
+            base.dtp_handler.__init__(self, sock, cmd_channel)
+        dtp_handler = type("LatencyDTPHandler", (base.dtp_handler,), {"__init__": dtp_init})
+        handler = type("LatencyHandler", (base,), {"handle_read": handle_read, "dtp_handler": dtp_handler})
+    if certfile or latency:
+        server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    else:
+        server = FTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.address[1]
+
+
+def checksum_commands(base):
+    """Return the attributes adding the commands HASH, OPTS HASH and XCRC to the pyftpdlib handler class base"""
+    def checksum(path, algorithm):
+        digest = hashlib.sha256() if algorithm == "SHA-256" else None
+        crc32 = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                if digest is None:
+                    crc32 = zlib.crc32(data, crc32)
+                else:
+                    digest.update(data)
+        return digest.hexdigest() if digest is not None else "%08X" % crc32
+
+    def ftp_HASH(self, path):
+        algorithm = getattr(self, "hash_algorithm", "SHA-256")
+        self.respond("213 %s 0-%d %s %s" % (algorithm, os.path.getsize(path), checksum(path, algorithm), self.fs.fs2ftp(path)))
+
+    def ftp_XCRC(self, path):
+        self.respond("250 " + checksum(path, "CRC32"))
+
+    def ftp_OPTS(self, line):
+        command, _, algorithm = line.partition(" ")
+        if command.upper() != "HASH":
+            return base.ftp_OPTS(self, line)
+        if algorithm.upper() not in ("SHA-256", "CRC32"):
+            self.respond("501 Unsupported algorithm.")
+            return
+        self.hash_algorithm = algorithm.upper()
+        self.respond("200 " + self.hash_algorithm)
+
+    def __init__(self, *args, **kwargs):
+        base.__init__(self, *args, **kwargs)
+        self._extra_feats = self._extra_feats + ["HASH SHA-256*;CRC32", "XCRC"]
+    path_command = {"perm": "r", "auth": True, "arg": True}
+    return {"proto_cmds": dict(base.proto_cmds, HASH=dict(path_command, help="Syntax: HASH <SP> file-name"), XCRC=dict(path_command, help="Syntax: XCRC <SP> file-name")),
+            "__init__": __init__, "ftp_HASH": ftp_HASH, "ftp_XCRC": ftp_XCRC, "ftp_OPTS": ftp_OPTS}
+
+
+def make_certificate(path):
+    """Write a self-signed certificate and its key in PEM format to path, for FTP over TLS"""
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", path, "-out", path], check=True, capture_output=True)
+
+
+def connect(port, ftp_class=CountingFTP):
+    ftp = ftp_class()
+    ftp.connect("127.0.0.1", port)
+    ftp.login(FTP_USER, FTP_PASSWD)
+    return ftp
+
+
+def populate(root, folders, files):
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        for index in range(files):
+            with open(os.path.join(root, folder, "file" + str(index)), "wb") as f:
+                f.write(b"x")
+
+
+def legacy_rotation(ftp, retention):
+    """FTP init and rotation as done by backup-wp.py before the rotation state file"""
+    for index in range(retention):
+        path = ftprotation.legacy_dir(index)
+        try:
+            ftp.cwd(path)
+        except ftplib.error_perm:
+            ftp.mkd(path)
+        else:
+            ftp.cwd("..")
+    path = ftprotation.legacy_dir(retention - 1)
+    ftp.cwd(path)
+    ftp.nlst()
+    for file in ftp.nlst():
+        ftp.delete(file)
+    ftp.cwd("..")
+    ftp.rmd(path)
+    for index in range(retention - 2, -1, -1):
+        ftp.rename(ftprotation.legacy_dir(index), ftprotation.legacy_dir(index + 1))
+    ftp.mkd("DAYJ")
+
+
+def state_rotation(ftp, policy, day):
+    """FTP init and rotation using ftprotation, for the backup of day days from now"""
+    state = ftprotation.init(ftp)
+    date = time.strftime('%Y%m%d', time.localtime(time.time() + day * 86400))
+    ftprotation.rotate(ftp, state, date + "-020000", date, policy)
+    return state
+
+
+def bench_rotation(args):
+    policy = {"daily": args.retention, "weekly": args.weekly, "monthly": args.monthly}
+    print("retention=%d weekly=%d monthly=%d files per folder=%d days=%d" % (args.retention, args.weekly, args.monthly, args.files, args.days))
+    with tempfile.TemporaryDirectory() as root:
+        port = start_ftp_server(root)
+        for name in ["legacy", "state"]:
+            path = os.path.join(root, name)
+            populate(path, [ftprotation.legacy_dir(index) for index in range(args.retention)], args.files)
+            ftp = connect(port)
+            ftp.cwd(name)
+            # First run creates the state file, it is not part of the measure
+            if name == "state":
+                ftprotation.init(ftp)
+            ftp.commands = 0
+            start = time.perf_counter()
+            for day in range(args.days):
+                if name == "legacy":
+                    legacy_rotation(ftp, args.retention)
+                    populate(os.path.join(path, "DAYJ"), [""], args.files)
+                else:
+                    state = state_rotation(ftp, policy, day)
+                    populate(path, [ftprotation.slot_dir(state, 0)], args.files)
+            elapsed = time.perf_counter() - start
+            ftp.quit()
+            kept = " snapshots kept: %d" % len(state["slots"]) if name == "state" else ""
+            print("%-8s round-trips per rotation: %6.1f  time per rotation: %8.2f ms%s" % (name, ftp.commands / args.days, 1000 * elapsed / args.days, kept))
+
+
+def bench_transfer(args):
+    with tempfile.TemporaryDirectory() as root:
+        port = start_ftp_server(root)
+        local = os.path.join(root, "local")
+        os.mkdir(local)
+        os.mkdir(os.path.join(root, "remote"))
+        files = []
+        for index in range(args.files):
+            files.append(os.path.join(local, "file" + str(index)))
+            with open(files[-1], "wb") as f:
+                for block in range(args.size):
+                    f.write(os.urandom(1024 * 1024))
+        print("files=" + str(args.files) + " size=" + str(args.size) + " MB")
+        for connections in args.connections:
+            pool = ftppool.FTPPool(lambda: connect(port, ftplib.FTP), connections)
+            upload = pool.upload_files(files, "remote")
+            download = pool.download_files(["remote/" + os.path.basename(file) for file in files], local)
+            pool.close()
+            print("connections=%-3d upload: %8.1f MB/s  download: %8.1f MB/s" % (connections, upload["mb_per_s"], download["mb_per_s"]))
+
+
+def bench_latency(args):
+    print("latency=%d ms retention=%d files=%d size=%d KB connections=%d passive=%s" % (args.latency, args.retention, args.files, args.size, args.connections, args.passive))
+    with tempfile.TemporaryDirectory() as root:
+        certfile = os.path.join(root, "cert.pem")
+        make_certificate(certfile)
+        os.mkdir(os.path.join(root, "ftp"))
+        port = start_ftp_server(os.path.join(root, "ftp"), certfile, args.latency / 1000.0)
+        local = os.path.join(root, "local")
+        os.mkdir(local)
+        files = []
+        for index in range(args.files):
+            files.append(os.path.join(local, "file" + str(index)))
+            with open(files[-1], "wb") as f:
+                f.write(os.urandom(args.size * 1024))
+        names = [os.path.basename(file) for file in files]
+        print("%-8s %10s %10s %10s %10s %10s" % ("backend", "connect s", "rotate s", "upload s", "download s", "commands"))
+        for backend in args.backends:
+            connectftp, pool_class = ftppool.backend(backend)
+            os.makedirs(os.path.join(root, "ftp", backend))
+            commands = tools.ftp_commands()
+            start = time.perf_counter()
+            first = connectftp("127.0.0.1", FTP_USER, FTP_PASSWD, passive=args.passive, port=port)
+            first.cwd(backend)
+            connected = time.perf_counter()
+            # The folders DAYJ ... are adopted, the one reused by the rotation holds the files of an older backup, they are deleted
+            populate(os.path.join(root, "ftp", backend), [ftprotation.legacy_dir(index) for index in range(args.retention)], args.files)
+            state = ftprotation.init(first)
+            rotation_start = time.perf_counter()
+            ftprotation.rotate(first, state, retention.new_id(), time.strftime('%Y%m%d'), {"daily": args.retention})
+            rotated = time.perf_counter()
+
+            def connect_session():
+                ftp = connectftp("127.0.0.1", FTP_USER, FTP_PASSWD, passive=args.passive, port=port)
+                ftp.cwd(backend)
+                return ftp
+            pool = pool_class(connect_session, args.connections, first=first)
+            upload = pool.upload_files(files, ftprotation.slot_dir(state, 0))
+            download_dir = os.path.join(root, "download-" + backend)
+            os.mkdir(download_dir)
+            download = pool.download_files([ftprotation.slot_dir(state, 0) + "/" + name for name in names], download_dir)
+            pool.close()
+            tools.closeftp(first)
+            for name in names:
+                with open(os.path.join(local, name), "rb") as f, open(os.path.join(download_dir, name), "rb") as g:
+                    if f.read() != g.read():
+                        raise SystemExit(backend + " : downloaded file " + name + " differs")
+            print("%-8s %10.2f %10.2f %10.2f %10.2f %10d" % (backend, connected - start, rotated - rotation_start,
+                  upload["seconds"], download["seconds"], tools.ftp_commands() - commands))
+
+
+def synthetic_archive(size):
+    """Return size bytes looking like a site archive : text (php, html, sql) and incompressible media"""
+    words = [bytes(random.choices(b"abcdefghijklmnopqrstuvwxyz<>/=;$()", k=random.randint(2, 10))) for index in range(5000)]
+    blocks = []
+    total = 0
+    while total < size:
+        if random.random() < 0.3:
+            block = os.urandom(random.randint(10000, 2000000))
+        else:
+            block = b" ".join(random.choices(words, k=random.randint(1000, 200000)))
+        blocks.append(block)
+        total += len(block)
+    return b"".join(blocks)[:size]
+
+
+class NullWriter:
+    """File-like object dropping what is written to it"""
+    def write(self, data):
+        return len(data)
+
+
+def bench_encryption(args):
+    data = os.urandom(args.size * 1024 * 1024)
+    key = os.urandom(32)
+    print("size=" + str(args.size) + " MB cores=" + str(os.cpu_count()))
+    for segment_size in args.segment_sizes:
+        results = []
+        for workers in args.workers:
+            start = time.perf_counter()
+            writer = encrypt.EncryptWriter(NullWriter(), key, segment_size * 1024, workers)
+            for offset in range(0, len(data), compress.READ_SIZE):
+                writer.write(data[offset:offset + compress.READ_SIZE])
+            writer.close()
+            results.append("workers=%d: %8.1f MB/s" % (workers, len(data) / (time.perf_counter() - start) / 1e6))
+        print("segment=%5d KB  " % segment_size + "  ".join(results))
+
+
+# Allocations of the local I/O paths, see fileio.py
+#
+# The benchmark runs with a fixed mmap threshold of glibc (MALLOC_MMAP_THRESHOLD_) : every allocation of
+# at least 128 KiB, ie every block of data, is a new mapping whose pages fault once. The minor page faults
+# per GB processed give the volume of the blocks allocated, 1 GB allocated per GB being one copy of the data.
+# Reading a memory map faults too, once per 16 pages mapped from the page cache (fault-around).
+MMAP_THRESHOLD = 128 * 1024
+PAGE_SIZE = resource.getpagesize()
+
+
+def bench_io(args):
+    if "MALLOC_MMAP_THRESHOLD_" not in os.environ:
+        sys.exit(subprocess.call([sys.executable] + sys.argv, env=dict(os.environ, MALLOC_MMAP_THRESHOLD_=str(MMAP_THRESHOLD))))
+    key = os.urandom(32)
+    size = args.size * 1024 * 1024
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        path = os.path.join(root, "data")
+        with open(path, "wb") as f:
+            for offset in range(0, size, fileio.BLOCK_SIZE):
+                f.write(os.urandom(min(fileio.BLOCK_SIZE, size - offset)))
+        os.mkdir(os.path.join(root, "ftp"))
+        port = start_ftp_server(os.path.join(root, "ftp"))
+
+        # The blocks read are checksummed, the pages of the memory map are touched as the others
+        def read():
+            with open(path, "rb", buffering=0) as f:
+                for block in iter(lambda: f.read(fileio.BLOCK_SIZE), b""):
+                    zlib.crc32(block)
+
+        def readinto():
+            with open(path, "rb", buffering=0) as f:
+                for block in fileio.read_blocks(f):
+                    zlib.crc32(block)
+
+        def mapped():
+            with fileio.open_mapped(path) as f:
+                for block in iter(lambda: f.read(fileio.BLOCK_SIZE), b""):
+                    zlib.crc32(block)
+
+        def copy():
+            with open(path, "rb") as fin, open(path + ".copy", "wb") as fout:
+                shutil.copyfileobj(fin, fout, fileio.BLOCK_SIZE)
+
+        def transfer(upload):
+            ftp = ftplib.FTP()
+            ftp.connect("127.0.0.1", port)
+            ftp.login(FTP_USER, FTP_PASSWD)
+            if upload:
+                tools.uploadftp(ftp, path, "/", resume=True)
+            else:
+                tools.downloadftp(ftp, "data", root, "data.download", resume=True)
+            ftp.quit()
+
+        steps = [("read", read), ("readinto", readinto), ("mmap", mapped),
+                 ("copy", copy), ("copy_file", lambda: fileio.copy_file(path, path + ".copy")),
+                 ("encrypt_file", lambda: encrypt.encrypt_file(path, key, workers=1)),
+                 ("decrypt_file", lambda: encrypt.decrypt_file(path + ".bin", key)),
+                 ("uploadftp", lambda: transfer(True)), ("downloadftp", lambda: transfer(False))]
+        print("size=%d MB block=%d KB" % (args.size, fileio.BLOCK_SIZE // 1024))
+        for name, step in steps:
+            if args.steps and name not in args.steps:
+                continue
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+            start = time.perf_counter()
+            cpu = time.process_time()
+            step()
+            elapsed = time.perf_counter() - start
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+            print("%-13s %8.2f s  cpu %6.2f s  %8.1f MB/s  %8.0f MB faulted per GB"
+                  % (name, elapsed, time.process_time() - cpu, size / elapsed / 1e6, faults * PAGE_SIZE / 1e6 / (size / 1e9)))
+
+
+def bench_chunking(args):
+    data = synthetic_archive(args.size * 1024 * 1024)
+    print("size=" + str(args.size) + " MB days=" + str(args.days) + " changes per day=" + str(args.changes))
+    start = time.perf_counter()
+    count = sum(1 for chunk in chunkstore.chunks(io.BytesIO(data)))
+    elapsed = time.perf_counter() - start
+    print("chunking: %8.1f MB/s  %d chunks  average size %d KB" % (len(data) / elapsed / 1e6, count, len(data) / count / 1024))
+    with tempfile.TemporaryDirectory() as root:
+        store = chunkstore.ChunkStore(os.path.join(root, chunkstore.CHUNK_DIR), os.urandom(32))
+        stored = 0
+        full = 0
+        start = time.perf_counter()
+        for day in range(args.days):
+            # Small insertions, deletions and rewrites, like the daily changes of a site
+            for change in range(args.changes):
+                offset = random.randrange(len(data))
+                data = data[:offset] + os.urandom(random.randint(100, 50000)) + data[offset + random.choice([0, 0, 20000]):]
+            os.mkdir(os.path.join(root, str(day)))
+            counters = store.backup(io.BytesIO(data), os.path.join(root, str(day), chunkstore.RECIPE), "day" + str(day))
+            stored += counters["bytes_stored"]
+            full += len(data)
+        elapsed = time.perf_counter() - start
+        store.close()
+    print("store   : %8.1f MB/s  %d days : %.1f MB stored for %.1f MB of archives (%.1f%%)" % (full / elapsed / 1e6, args.days, stored / 1e6, full / 1e6, 100 * stored / full))
+
+
+def synthetic_tree(root, files):
+    """Create a tree shaped like a WordPress site folder with files small files"""
+    for index in range(files):
+        folder = os.path.join(root, "wp-content", "uploads", str(index // 10000), str(index // 100 % 100))
+        if index % 100 == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "file" + str(index) + ".php"), "wb") as f:
+            f.write(os.urandom(random.randint(100, 8000)))
+
+
+def bench_scan(args):
+    print("files=" + str(args.files))
+    with tempfile.TemporaryDirectory() as root:
+        tree = os.path.join(root, "site")
+        synthetic_tree(tree, args.files)
+        start = time.perf_counter()
+        with open(os.devnull, "wb") as null:
+            tar = tarfile.open(fileobj=null, mode="w|")
+            tar.add(tree)
+            tar.close()
+        print("%-12s %8.2f s" % ("tar", time.perf_counter() - start))
+        for workers in args.workers:
+            cache = os.path.join(root, "scan" + str(workers) + ".sqlite")
+            site_scanner = scanner.Scanner(cache)
+            start = time.perf_counter()
+            site_scanner.scan(tree, workers)
+            first = time.perf_counter() - start
+            site_scanner.commit("bench")
+            # Change a few files, then scan again
+            for index in random.sample(range(args.files), min(args.changes, args.files)):
+                folder = os.path.join(tree, "wp-content", "uploads", str(index // 10000), str(index // 100 % 100))
+                with open(os.path.join(folder, "file" + str(index) + ".php"), "ab") as f:
+                    f.write(b"changed")
+            start = time.perf_counter()
+            counters = site_scanner.scan(tree, workers)
+            changed = sum(1 for change in site_scanner.changes())
+            second = time.perf_counter() - start
+            site_scanner.close()
+            print("%-12s first scan: %8.2f s  next scan: %8.2f s  %d changed out of %d entries  cache: %.1f MB"
+                  % ("workers=" + str(workers), first, second, changed, counters["entries"], os.path.getsize(cache) / 1e6))
+
+
+def create_wp_tables(cursor, rows):
+    """Create and fill tables shaped like wp_postmeta and wp_options with random content"""
+    cursor.execute("DROP TABLE IF EXISTS wp_postmeta, wp_options")
+    cursor.execute("""CREATE TABLE wp_postmeta (
+  meta_id bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  post_id bigint(20) unsigned NOT NULL DEFAULT 0,
+  meta_key varchar(255) DEFAULT NULL,
+  meta_value longtext,
+  PRIMARY KEY (meta_id),
+  KEY post_id (post_id),
+  KEY meta_key (meta_key(191))
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""")
+    cursor.execute("""CREATE TABLE wp_options (
+  option_id bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  option_name varchar(191) NOT NULL DEFAULT '',
+  option_value longtext NOT NULL,
+  autoload varchar(20) NOT NULL DEFAULT 'yes',
+  PRIMARY KEY (option_id),
+  UNIQUE KEY option_name (option_name),
+  KEY autoload (autoload)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""")
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for index in range(5000)]
+    def text(count):
+        return " ".join(random.choices(words, k=count))
+    batch = 1000
+    for start in range(0, rows, batch):
+        cursor.executemany("INSERT INTO wp_postmeta (post_id, meta_key, meta_value) VALUES (%s, %s, %s)",
+                           [(random.randint(1, rows // 10 + 1), "_" + random.choice(words), text(random.randint(5, 80))) for index in range(min(batch, rows - start))])
+    for start in range(0, rows // 10, batch):
+        cursor.executemany("INSERT INTO wp_options (option_name, option_value, autoload) VALUES (%s, %s, %s)",
+                           [("option_" + str(start + index), text(random.randint(20, 400)), random.choice(["yes", "no"])) for index in range(min(batch, rows // 10 - start))])
+
+
+def bench_mysql(args):
+    source = {"host": args.host, "database": args.database}
+    target = {"host": args.host, "database": args.database + "_restore"}
+    conn = dbdump.connect(args.host)
+    cursor = conn.cursor()
+    for database in (source["database"], target["database"]):
+        cursor.execute("CREATE DATABASE IF NOT EXISTS `" + database + "`")
+    if args.rows:
+        cursor.execute("USE `" + source["database"] + "`")
+        create_wp_tables(cursor, args.rows)
+    conn.close()
+    print("database=" + source["database"] + " cores=" + str(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as root:
+        # Single stream : mysqldump | gzip and gunzip | mysql
+        path = os.path.join(root, "dump.sql.gz")
+        start = time.perf_counter()
+        subprocess.run("mysqldump --single-transaction -h " + args.host + " " + source["database"] + " | gzip > " + path, shell=True, check=True)
+        dump_time = time.perf_counter() - start
+        start = time.perf_counter()
+        subprocess.run("gunzip -c " + path + " | mysql -h " + args.host + " " + target["database"], shell=True, check=True)
+        load_time = time.perf_counter() - start
+        print("%-12s dump: %8.2f s  import: %8.2f s  size: %8.1f MB" % ("mysqldump", dump_time, load_time, os.path.getsize(path) / 1e6))
+        for jobs in args.jobs:
+            path = os.path.join(root, "dump" + str(jobs) + dbdump.DUMP_SUFFIX)
+            start = time.perf_counter()
+            dbdump.dump(source, path, jobs, args.chunk_rows)
+            dump_time = time.perf_counter() - start
+            start = time.perf_counter()
+            dbdump.load(target, path, jobs)
+            load_time = time.perf_counter() - start
+            print("%-12s dump: %8.2f s  import: %8.2f s  size: %8.1f MB" % ("jobs=" + str(jobs), dump_time, load_time, os.path.getsize(path) / 1e6))
+
+
+def insert_options(cursor, conn, seconds, rate, capture):
+    """Insert rate rows per second in wp_options, one per transaction, for seconds seconds
+       The new events are cut in segments every second, return the seconds spent cutting them
+    """
+    cut_seconds = 0.0
+    for second in range(seconds):
+        start = time.time()
+        for index in range(rate):
+            cursor.execute("INSERT INTO wp_options (option_name, option_value) VALUES (%s, %s)", ("pitr_%.6f_%d" % (start, index), "x" * random.randint(20, 400)))
+            conn.commit()
+        time.sleep(max(0.0, start + 1 - time.time()))
+        cut_start = time.perf_counter()
+        capture.cut()
+        cut_seconds += time.perf_counter() - cut_start
+    return cut_seconds
+
+
+def bench_pitr(args):
+    conn = dbdump.connect(args.host)
+    cursor = conn.cursor()
+    cursor.execute("CREATE DATABASE IF NOT EXISTS `" + args.database + "`")
+    cursor.execute("USE `" + args.database + "`")
+    create_wp_tables(cursor, args.rows)
+    conn.commit()
+    key = os.urandom(32)
+    with tempfile.TemporaryDirectory() as root:
+        # Nightly dump starting a new binary log, then the capture of the writes of the site
+        dump = os.path.join(root, args.database + ".sql.gz")
+        subprocess.run("mysqldump --single-transaction --flush-logs --master-data=2 -h " + args.host + " " + args.database + " | gzip > " + dump, shell=True, check=True)
+        with open(dump, "rb") as f:
+            position = binlog.dump_position(f)
+        capture = binlog.Capture(os.path.join(root, "binlog"), key, segment_size=args.segment_size)
+        copy = subprocess.Popen(capture.command(args.mysqlbinlog, args.host, position["file"]))
+        try:
+            cut_seconds = insert_options(cursor, conn, args.seconds, args.rate, capture)
+            cursor.execute("SELECT COUNT(*) FROM wp_options")
+            expected = cursor.fetchone()[0]
+            # The time to restore is a whole second without writes, the writes go on after it
+            until = math.floor(time.time()) + 1
+            time.sleep(until + 1 - time.time())
+            cut_seconds += insert_options(cursor, conn, args.seconds, args.rate, capture)
+            time.sleep(1)
+            capture.cut()
+        finally:
+            copy.terminate()
+            copy.wait()
+        captured = sum(capture.state["logs"].values())
+        segments = os.listdir(capture.segments)
+        stored = sum(os.path.getsize(os.path.join(capture.segments, name)) for name in segments)
+        print("%d rows per second for 2 x %d s : %d segments, %.1f MB of binary log in %.1f MB, %.2f s to cut them"
+              % (args.rate, args.seconds, len(segments), captured / 1e6, stored / 1e6, cut_seconds))
+        # Restore of the database until the time between the two series of writes
+        cursor.execute("DROP DATABASE `" + args.database + "`")
+        cursor.execute("CREATE DATABASE `" + args.database + "`")
+        start = time.perf_counter()
+        subprocess.run("gunzip -c " + dump + " | mysql -h " + args.host + " " + args.database, shell=True, check=True)
+        import_time = time.perf_counter() - start
+        start = time.perf_counter()
+        logs = os.path.join(root, "logs")
+        os.mkdir(logs)
+        paths = binlog.rebuild(binlog.plan(segments, position, until), lambda name: open(os.path.join(capture.segments, name), "rb"), key, logs)
+        binlog.replay(paths, position, until, args.host, args.database, args.mysqlbinlog)
+        replay_time = time.perf_counter() - start
+        cursor.execute("SELECT COUNT(*) FROM `" + args.database + "`.wp_options")
+        restored = cursor.fetchone()[0]
+        print("restore until %s : dump imported in %.2f s, binary logs replayed in %.2f s, %d rows of wp_options (%s)"
+              % (time.strftime(binlog.UNTIL_FORMAT, time.localtime(until)), import_time, replay_time, restored, "ok" if restored == expected else "expected %d" % expected))
+    conn.close()
+
+
+# End-to-end benchmark
+#
+# backup-wp.py and restore-wp.py are run as they are, with a configuration file pointing to local stand-ins :
+#   - a pyftpdlib server over TLS with a self-signed certificate
+#   - mysqldump and mysql replaced, through the PATH, by the scripts below working on a sqlite database :
+#     the SQL is not the one of MariaDB, but the dump and the import are streams of SQL going through
+#     the same compression, encryption and transfer stages
+#   - an SMTP server dropping the messages
+# The runs are timed as a whole, and stage by stage from the reports written by the scripts (see metrics.py).
+# Results are appended to a JSON lines file with the commit they were measured on, and compared with the
+# last result of the same parameters measured on another commit.
+
+SQLITE_DIR = "BENCH_SQLITE_DIR"
+DUMP_SHIM = """import os, sys, sqlite3
+connection = sqlite3.connect(os.path.join(os.environ["%s"], sys.argv[-1] + ".sqlite"))
+for statement in connection.iterdump():
+    sys.stdout.write(statement + "\\n")
+""" % SQLITE_DIR
+IMPORT_SHIM = """import os, sys, sqlite3
+connection = sqlite3.connect(os.path.join(os.environ["%s"], sys.argv[-1] + ".sqlite"), isolation_level=None)
+statement = ""
+for line in sys.stdin:
+    statement += line
+    if sqlite3.complete_statement(statement):
+        connection.execute(statement)
+        statement = ""
+""" % SQLITE_DIR
+RESULTS = "benchmark-results.jsonl"
+# Folder of the synthetic site holding a hard link to a file of another folder, restored alone by restore-path
+LINKED_DIR = "wp-content/uploads/linked"
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    """Minimal SMTP server accepting and dropping the messages"""
+    def handle(self):
+        self.wfile.write(b"220 bench\r\n")
+        data = False
+        for line in self.rfile:
+            if data:
+                if line == b".\r\n":
+                    data = False
+                    self.wfile.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command == b"DATA":
+                data = True
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+def start_smtp_server():
+    """Start a local SMTP server dropping the messages in a thread, return its port"""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def synthetic_site(root, files, median_size, sigma, media, rnd):
+    """Create a tree shaped like a WordPress site : php, js and css files in wp-admin, wp-includes,
+       plugins and themes, and uploads by year and month
+       - files: number of files
+       - median_size, sigma: parameters of the log-normal distribution of the sizes in bytes
+       - media: part of the files being incompressible media (uploads)
+       - rnd: random.Random, the same seed gives the same tree
+    """
+    words = [bytes(rnd.choices(b"abcdefghijklmnopqrstuvwxyz<>/=;$()", k=rnd.randint(2, 10))) for index in range(5000)]
+    text = b" ".join(rnd.choices(words, k=300000))
+    for index in range(files):
+        size = min(int(rnd.lognormvariate(math.log(median_size), sigma)), 64 * 1024 * 1024)
+        if rnd.random() < media:
+            folder = os.path.join(root, "wp-content", "uploads", str(2015 + index % 10), "%02d" % (index // 10 % 12 + 1))
+            name = "image%d.jpg" % index
+            data = rnd.randbytes(size)
+        else:
+            folder = os.path.join(root, rnd.choice(["wp-admin", "wp-includes", "wp-content/plugins/plugin%d" % (index % 20), "wp-content/themes/theme%d" % (index % 3)]))
+            name = "file%d.%s" % (index, rnd.choice(["php", "php", "js", "css"]))
+            offset = rnd.randrange(len(text))
+            data = (text[offset:] + text)[:size] if size <= len(text) else (text * (size // len(text) + 1))[:size]
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(data)
+
+
+def synthetic_database(path, rows, rnd):
+    """Create a sqlite database with tables shaped like wp_posts, wp_postmeta and wp_options"""
+    words = ["".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 10))) for index in range(5000)]
+    def text(count):
+        return " ".join(rnd.choices(words, k=count))
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE wp_posts (ID INTEGER PRIMARY KEY, post_title TEXT, post_content TEXT)")
+    connection.execute("CREATE TABLE wp_postmeta (meta_id INTEGER PRIMARY KEY, post_id INTEGER, meta_key TEXT, meta_value TEXT)")
+    connection.execute("CREATE TABLE wp_options (option_id INTEGER PRIMARY KEY, option_name TEXT UNIQUE, option_value TEXT)")
+    connection.executemany("INSERT INTO wp_posts (post_title, post_content) VALUES (?, ?)",
+                           ((text(8), text(rnd.randint(100, 2000))) for index in range(rows // 10)))
+    connection.executemany("INSERT INTO wp_postmeta (post_id, meta_key, meta_value) VALUES (?, ?, ?)",
+                           ((rnd.randint(1, rows // 10 + 1), "_" + rnd.choice(words), text(rnd.randint(5, 80))) for index in range(rows)))
+    connection.executemany("INSERT INTO wp_options (option_name, option_value) VALUES (?, ?)",
+                           (("option_" + str(index), text(rnd.randint(20, 400))) for index in range(rows // 100)))
+    connection.commit()
+    connection.close()
+
+
+def tree_digest(root):
+    """Return {path: (mode, sha256)} for the files and folders below root"""
+    digest = {}
+    for folder, dirs, names in os.walk(root):
+        for name in dirs + names:
+            path = os.path.join(folder, name)
+            st = os.lstat(path)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    digest[path] = (st.st_mode, hashlib.file_digest(f, "sha256").hexdigest())
+            else:
+                digest[path] = (st.st_mode, None)
+    return digest
+
+
+def table_counts(path):
+    connection = sqlite3.connect(path)
+    counts = {table: connection.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+              for table, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")}
+    connection.close()
+    return counts
+
+
+def commit_id():
+    """Return the commit of the scripts measured, with -dirty if they are modified"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if changes else "")
+
+
+def compare(previous, current, threshold):
+    """Print the times of current against previous, flag the steps and stages slower by more than threshold percent"""
+    print("")
+    print("Compared with commit %s of %s" % (previous["commit"], previous["date"]))
+    for step, result in current["results"].items():
+        before = previous["results"].get(step)
+        if before is None:
+            continue
+        rows = [(step, before["seconds"], result["seconds"])]
+        rows += [("  " + stage, before["stages"].get(stage, 0.0), seconds) for stage, seconds in result["stages"].items()]
+        for name, old, new in rows:
+            change = 100.0 * (new - old) / old if old else 0.0
+            flag = "  REGRESSION" if change > threshold and new - old > 0.05 else ""
+            print("%-20s %9.2f s -> %9.2f s  %+7.1f %%%s" % (name, old, new, change, flag))
+
+
+def standins(root, args):
+    """Start the stand-ins of the servers used by the scripts, return the configuration shared by the sites
+       and the environment of the scripts
+       - root: folder of the stand-ins : ftp (root of the FTP server), db (sqlite databases), bin (mysqldump
+         and mysql shims), the certificate of the FTP server and the AES key
+       - args: mode, stream, codec, connections and FTP backend of the backups
+    """
+    ftp_root = os.path.join(root, "ftp")
+    sqlite_dir = os.path.join(root, "db")
+    bin_dir = os.path.join(root, "bin")
+    for folder in (ftp_root, sqlite_dir, bin_dir):
+        os.makedirs(folder, exist_ok=True)
+    for name, shim in (("mysqldump", DUMP_SHIM), ("mysql", IMPORT_SHIM)):
+        with open(os.path.join(bin_dir, name), "w") as f:
+            f.write("#!" + sys.executable + "\n" + shim)
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+    certfile = os.path.join(root, "cert.pem")
+    make_certificate(certfile)
+    keypath = os.path.join(root, "AES.key")
+    with open(keypath, "wb") as f:
+        f.write(os.urandom(32))
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config["DB"] = {"DB_HOST": "localhost"}
+    config["SMTP"] = {"SMTP_HOST": "127.0.0.1:%d" % start_smtp_server(), "SMTP_FROM": "bench@localhost", "SMTP_TO": "bench@localhost"}
+    config["BACKUP"] = {"BACKUP_RETENTION": "3", "FTP_SERVER": "127.0.0.1",
+                        "FTP_PORT": str(start_ftp_server(ftp_root, certfile)), "FTP_USER": FTP_USER, "FTP_PASSWD": FTP_PASSWD,
+                        "MODE": args.mode, "FTP_CONNECTIONS": str(args.connections), "STREAM": "yes" if args.stream else "no",
+                        "FTP_BACKEND": args.backend}
+    config["COMPRESS"] = {"CODEC": args.codec, "MEDIA": "yes" if args.compress_media else "no"}
+    config["ENCRYPT"] = {"KEYPATH": keypath}
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"], **{SQLITE_DIR: sqlite_dir})
+    return config, env
+
+
+def bench_endtoend(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    params = {"files": args.files, "median_size": args.median_size, "sigma": args.sigma, "media": args.media,
+              "rows": args.rows, "mode": args.mode, "codec": args.codec, "stream": args.stream,
+              "connections": args.connections, "changes": args.changes, "seed": args.seed}
+    # The results of the default backend are compared with the ones recorded before the asyncio backend
+    if args.backend != "ftplib":
+        params["backend"] = args.backend
+    if args.upload_rate:
+        params["upload_rate"] = args.upload_rate
+    if args.compress_media:
+        params["compress_media"] = True
+    print(" ".join("%s=%s" % item for item in params.items()) + " cores=" + str(os.cpu_count()))
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as root:
+        site = os.path.join(root, "site")
+        backup = os.path.join(root, "backup")
+        config, env = standins(root, args)
+        for folder in (site, backup, os.path.join(root, "ftp", "backup-wp")):
+            os.makedirs(folder, exist_ok=True)
+        start = time.perf_counter()
+        synthetic_site(site, args.files, args.median_size, args.sigma, args.media, rnd)
+        # wp-admin is archived first, the member of LINKED_DIR is the hard link
+        os.makedirs(os.path.join(site, "wp-admin"), exist_ok=True)
+        os.makedirs(os.path.join(site, LINKED_DIR))
+        with open(os.path.join(site, "wp-admin", "shared.php"), "wb") as f:
+            f.write(b"<?php shared ?>\n" * 1000)
+        os.link(os.path.join(site, "wp-admin", "shared.php"), os.path.join(site, LINKED_DIR, "shared.php"))
+        database = os.path.join(env[SQLITE_DIR], "wordpress.sqlite")
+        synthetic_database(database, args.rows, rnd)
+        print("data generated in %.1f s" % (time.perf_counter() - start))
+        config["WP"] = {"WP_PATH": site}
+        config["DB"]["DB_NAME"] = "wordpress"
+        config["BACKUP"].update({"LOCALBKPATH": backup, "FTP_PATH": "backup-wp"})
+        if args.upload_rate:
+            config["GOVERNOR"] = {"UPLOAD_RATE": args.upload_rate, "NICE": "10", "IONICE": "idle"}
+        config_file = os.path.join(root, "backup-wp.conf")
+        with open(config_file, "w") as f:
+            config.write(f)
+        results = {}
+
+        def run(step, script, report, *options):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, os.path.join(here, script), "-f", config_file, "-v", "2"] + list(options),
+                                     env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if process.returncode:
+                print(process.stdout)
+                raise SystemExit(step + " : " + script + " failed")
+            seconds = time.perf_counter() - start
+            with open(report) as f:
+                report = json.load(f)
+            stages = {stage["name"]: stage["seconds"] for stage in report["stages"]}
+            results[step] = {"seconds": round(seconds, 3), "stages": stages}
+            print("%-16s %8.2f s  " % (step, seconds) + "  ".join("%s %.2f" % stage for stage in stages.items()))
+            # Compression of the text and of the media of the site, see compress.classify
+            if report.get("classes"):
+                results[step]["classes"] = report["classes"]
+                print("%-16s %10s  " % ("", "") + "  ".join("%s %.1f MB %.2f s" % (name, stats["bytes_in"] / 1e6, stats["seconds"]) for name, stats in report["classes"].items()))
+
+        backup_report = os.path.join(backup, "DAYJ", "backup-report.json")
+        restore_report = os.path.join(backup, "RESTORE-" + time.strftime('%Y%m%d'), "restore-report.json")
+        run("backup", "backup-wp.py", backup_report)
+        # Same day and nothing changed : the site backup of the first run is reused
+        run("backup-unchanged", "backup-wp.py", backup_report)
+        # Next day : rotation of the folders and backup of the changed files
+        catalog = retention.Catalog(backup)
+        catalog.snapshots[0]["date"] = "19700101"
+        catalog.save()
+        changed = [os.path.join(folder, name) for folder, dirs, names in os.walk(site) for name in names]
+        for path in rnd.sample(changed, min(args.changes, len(changed))):
+            with open(path, "ab") as f:
+                f.write(b"changed")
+        run("backup-rotation", "backup-wp.py", backup_report)
+        expected = tree_digest(site)
+        expected_tables = table_counts(database)
+        for step, options in (("restore", []), ("restore-stream", ["-s"])):
+            shutil.rmtree(site)
+            os.remove(database)
+            run(step, "restore-wp.py", restore_report, *options)
+            if tree_digest(site) != expected or table_counts(database) != expected_tables:
+                raise SystemExit(step + " : the restored site or database differs from the backup")
+        # Only the folder of the hard link, its target is neither restored nor on the disk
+        linked = os.path.join(site, LINKED_DIR)
+        shutil.rmtree(site)
+        run("restore-path", "restore-wp.py", restore_report, "-p", LINKED_DIR)
+        if tree_digest(linked) != {path: digest for path, digest in expected.items() if path.startswith(linked + os.sep)}:
+            raise SystemExit("restore-path : the restored folder differs from the backup")
+        # Both retention folders, read from the server, then by the checksums of the server
+        verify_report = os.path.join(backup, "verify-report.json")
+        for step, options in (("verify", []), ("verify-checksums", ["-c"])):
+            run(step, "verify-wp.py", verify_report, "-d", "0", "-d", "1", *options)
+    current = {"benchmark": "endtoend", "commit": commit_id(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "params": params, "results": results}
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            for line in f:
+                record = json.loads(line)
+                if record["params"] == params and record["commit"] != current["commit"]:
+                    previous = record
+    if previous:
+        compare(previous, current, args.threshold)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(current) + "\n")
+    print("")
+    print("Results of commit %s appended to %s" % (current["commit"], args.results))
+
+
+def bench_batch(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    print("sites=%d files=%d huge=%d rows=%d mode=%s connections=%d backend=%s cores=%d" % (args.sites, args.files, args.huge, args.rows, args.mode, args.connections, args.backend, os.cpu_count()))
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as root:
+        config, env = standins(root, args)
+        config["SCHEDULER"] = {"FTP": str(args.connections * 2)}
+        shared = {section: dict(config[section]) for section in config.sections()}
+        names = ["site%d" % index for index in range(args.sites)]
+        start = time.perf_counter()
+        site_files = []
+        for index, name in enumerate(names):
+            # The first site is huge, the other ones wait for it when the sites are backed up one after the other
+            site = os.path.join(root, "sites", name)
+            synthetic_site(site, args.files * (args.huge if index == 0 else 1), args.median_size, args.sigma, args.media, rnd)
+            synthetic_database(os.path.join(env[SQLITE_DIR], name + ".sqlite"), args.rows, rnd)
+            sections = {"WP": {"WP_PATH": site}, "DB": {"DB_NAME": name},
+                        "BACKUP": {"LOCALBKPATH": os.path.join(root, "backup", name), "FTP_PATH": name}}
+            # A configuration file per site for the sequential backups
+            site_config = configparser.ConfigParser()
+            site_config.optionxform = str
+            site_config.read_dict(shared)
+            site_config.read_dict(sections)
+            site_files.append(os.path.join(root, name + ".conf"))
+            with open(site_files[-1], "w") as f:
+                site_config.write(f)
+            # and the sections <site>:<SECTION> of a single file for the batch backup
+            config.read_dict({name + ":" + section: values for section, values in sections.items()})
+        config_file = os.path.join(root, "batch.conf")
+        with open(config_file, "w") as f:
+            config.write(f)
+        print("data generated in %.1f s" % (time.perf_counter() - start))
+
+        def reset():
+            shutil.rmtree(os.path.join(root, "backup"), ignore_errors=True)
+            for name in names:
+                shutil.rmtree(os.path.join(root, "ftp", name), ignore_errors=True)
+                os.makedirs(os.path.join(root, "ftp", name))
+
+        def backup(*options):
+            process = subprocess.run([sys.executable, os.path.join(here, "backup-wp.py")] + list(options),
+                                     env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if process.returncode:
+                print(process.stdout)
+                raise SystemExit("backup-wp.py failed")
+            return {name: json.load(open(os.path.join(root, "backup", name, "DAYJ", "backup-report.json")))["seconds"]
+                    for name in names if os.path.exists(os.path.join(root, "backup", name, "DAYJ", "backup-report.json"))}
+
+        reset()
+        sequential = {}
+        elapsed = 0.0
+        for name, site_file in zip(names, site_files):
+            elapsed += backup("-f", site_file)[name]
+            sequential[name] = elapsed
+        reset()
+        start = time.perf_counter()
+        batch = backup("-f", config_file)
+        batch_seconds = time.perf_counter() - start
+        print("%-10s %14s %14s" % ("site", "sequential s", "batch s"))
+        for name in names:
+            print("%-10s %14.2f %14.2f" % (name, sequential[name], batch[name]))
+        print("%-10s %14.2f %14.2f" % ("total", sequential[names[-1]], batch_seconds))
+        # A site of the batch is restored from the file describing all the sites
+        site = os.path.join(root, "sites", names[-1])
+        database = os.path.join(env[SQLITE_DIR], names[-1] + ".sqlite")
+        expected = tree_digest(site)
+        expected_tables = table_counts(database)
+        shutil.rmtree(site)
+        os.remove(database)
+        process = subprocess.run([sys.executable, os.path.join(here, "restore-wp.py"), "-f", config_file, "--site", names[-1]],
+                                 env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if process.returncode or tree_digest(site) != expected or table_counts(database) != expected_tables:
+            print(process.stdout)
+            raise SystemExit("restore of " + names[-1] + " differs from the backup")
+
+
+# create parser
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+# add arguments to the parser
+rotation = subparsers.add_parser("rotation", help="round-trips of the FTP folders rotation")
+rotation.add_argument("--retention", type=int, default=7, help="number of daily folders")
+rotation.add_argument("--files", type=int, default=3, help="number of files in each folder")
+rotation.add_argument("--days", type=int, default=10, help="number of rotations measured")
+rotation.add_argument("--weekly", type=int, default=0, help="number of weekly snapshots kept, see retention.py")
+rotation.add_argument("--monthly", type=int, default=0, help="number of monthly snapshots kept")
+rotation.set_defaults(func=bench_rotation)
+
+transfer = subparsers.add_parser("transfer", help="throughput of the FTP pool")
+transfer.add_argument("--files", type=int, default=2, help="number of files transferred")
+transfer.add_argument("--size", type=int, default=256, help="size of each file in MB")
+transfer.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4, 8], help="sizes of the pool")
+transfer.set_defaults(func=bench_transfer)
+
+latency = subparsers.add_parser("latency", help="login, rotation and transfers of the FTP backends against a server with injected latency")
+latency.add_argument("--latency", type=int, default=80, help="round-trip time to the server in ms")
+latency.add_argument("--retention", type=int, default=7, help="number of daily folders")
+latency.add_argument("--files", type=int, default=50, help="number of files transferred and deleted by the rotation")
+latency.add_argument("--size", type=int, default=64, help="size of each file in KB")
+latency.add_argument("--connections", type=int, default=4, help="size of the pool")
+latency.add_argument("--passive", action="store_true", help="passive mode, the scripts use the active mode")
+latency.add_argument("--backends", nargs="+", default=list(ftppool.BACKENDS), choices=ftppool.BACKENDS, help="FTP backends measured")
+latency.set_defaults(func=bench_latency)
+
+chunking = subparsers.add_parser("chunking", help="throughput of the content-defined chunking and deduplication over several days")
+chunking.add_argument("--size", type=int, default=256, help="size of the archive in MB")
+chunking.add_argument("--days", type=int, default=7, help="number of daily backups stored")
+chunking.add_argument("--changes", type=int, default=20, help="number of changes in the archive each day")
+chunking.set_defaults(func=bench_chunking)
+
+encryption = subparsers.add_parser("encryption", help="throughput of the segment encryption by segment size and number of threads")
+encryption.add_argument("--size", type=int, default=512, help="size of the data encrypted in MB")
+encryption.add_argument("--segment-sizes", type=int, nargs="+", default=[64, 256, 1024, 4096], help="sizes of the segments in KB")
+encryption.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of encryption threads")
+encryption.set_defaults(func=bench_encryption)
+
+localio = subparsers.add_parser("io", help="allocations and throughput of the local I/O paths, see fileio.py")
+localio.add_argument("--size", type=int, default=256, help="size of the file processed in MB")
+localio.add_argument("--dir", help="folder of the file, a temporary folder by default")
+localio.add_argument("--steps", nargs="+", help="steps to run, all by default")
+localio.set_defaults(func=bench_io)
+
+scan = subparsers.add_parser("scan", help="change detection of the site folder against tar")
+scan.add_argument("--files", type=int, default=100000, help="number of files of the synthetic site")
+scan.add_argument("--changes", type=int, default=100, help="number of files changed before the second scan")
+scan.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="numbers of scanning threads")
+scan.set_defaults(func=bench_scan)
+
+endtoend = subparsers.add_parser("endtoend", help="backup, rotation and restore by the scripts against local FTP over TLS, SMTP and database stand-ins")
+endtoend.add_argument("--files", type=int, default=2000, help="number of files of the synthetic site")
+endtoend.add_argument("--median-size", type=int, default=16384, help="median size of the files in bytes")
+endtoend.add_argument("--sigma", type=float, default=1.5, help="sigma of the log-normal distribution of the sizes")
+endtoend.add_argument("--media", type=float, default=0.2, help="part of the files being incompressible media")
+endtoend.add_argument("--rows", type=int, default=100000, help="rows of the synthetic wp_postmeta table")
+endtoend.add_argument("--changes", type=int, default=20, help="number of files changed before the rotation")
+endtoend.add_argument("--mode", default="full", choices=["full", "incremental", "dedup"], help="MODE of the backup")
+endtoend.add_argument("--codec", default=compress.DEFAULT_CODEC, help="CODEC of the compression")
+endtoend.add_argument("--stream", action="store_true", help="STREAM mode of the backup")
+endtoend.add_argument("--connections", type=int, default=1, help="FTP_CONNECTIONS")
+endtoend.add_argument("--backend", default="ftplib", choices=ftppool.BACKENDS, help="FTP_BACKEND")
+endtoend.add_argument("--upload-rate", default="", help="UPLOAD_RATE of the GOVERNOR section, ie 2M")
+endtoend.add_argument("--compress-media", action="store_true", help="compress the media files like the others (MEDIA=yes)")
+endtoend.add_argument("--seed", type=int, default=1, help="seed of the synthetic data")
+endtoend.add_argument("--results", default=RESULTS, help="file where the results are appended")
+endtoend.add_argument("--threshold", type=float, default=10.0, help="slowdown in percent reported as a regression")
+endtoend.set_defaults(func=bench_endtoend)
+
+batch = subparsers.add_parser("batch", help="backup of several sites in one process against one process per site")
+batch.add_argument("--sites", type=int, default=6, help="number of sites")
+batch.add_argument("--files", type=int, default=500, help="number of files of each site")
+batch.add_argument("--huge", type=int, default=10, help="the first site has this many times more files")
+batch.add_argument("--median-size", type=int, default=16384, help="median size of the files in bytes")
+batch.add_argument("--sigma", type=float, default=1.5, help="sigma of the log-normal distribution of the sizes")
+batch.add_argument("--media", type=float, default=0.2, help="part of the files being incompressible media")
+batch.add_argument("--compress-media", action="store_true", help="compress the media files like the others (MEDIA=yes)")
+batch.add_argument("--rows", type=int, default=10000, help="rows of the wp_postmeta table of each site")
+batch.add_argument("--mode", default="full", choices=["full", "incremental", "dedup"], help="MODE of the backups")
+batch.add_argument("--codec", default=compress.DEFAULT_CODEC, help="CODEC of the compression")
+batch.add_argument("--stream", action="store_true", help="STREAM mode of the backups")
+batch.add_argument("--connections", type=int, default=1, help="FTP_CONNECTIONS of each site")
+batch.add_argument("--backend", default="ftplib", choices=ftppool.BACKENDS, help="FTP_BACKEND of the sites")
+batch.add_argument("--seed", type=int, default=1, help="seed of the synthetic data")
+batch.set_defaults(func=bench_batch)
+
+mysql = subparsers.add_parser("mysql", help="parallel dump and import of the database against mysqldump")
+mysql.add_argument("--host", default="localhost", help="MariaDB or MySQL server")
+mysql.add_argument("--database", default="wpbench", help="database dumped, it is imported in DATABASE_restore")
+mysql.add_argument("--rows", type=int, default=1000000, help="rows of the synthetic wp_postmeta table, 0 to keep the existing tables")
+mysql.add_argument("--chunk-rows", type=int, default=dbdump.CHUNK_ROWS, help="rows of the chunks of the parallel dump")
+mysql.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of worker processes")
+mysql.set_defaults(func=bench_mysql)
+
+pitr = subparsers.add_parser("pitr", help="capture of the binary logs and restore of the database until a time")
+pitr.add_argument("--host", default="localhost", help="MariaDB or MySQL server with the binary log enabled")
+pitr.add_argument("--database", default="wpbench", help="database written, dropped and restored")
+pitr.add_argument("--rows", type=int, default=10000, help="rows of the synthetic wp_postmeta table")
+pitr.add_argument("--rate", type=int, default=200, help="rows inserted per second, one per transaction")
+pitr.add_argument("--seconds", type=int, default=10, help="seconds of writes before and after the time restored")
+pitr.add_argument("--segment-size", type=int, default=binlog.SEGMENT_SIZE, help="maximum size of the segments")
+pitr.add_argument("--mysqlbinlog", default="mysqlbinlog", help="command copying the binary logs, ie mariadb-binlog")
+pitr.set_defaults(func=bench_pitr)
+
+if __name__ == "__main__":
+    # parse the arguments
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to capture the binary logs of the Wordpress
+# database between the nightly backups, for the restore of the database
+# at any time with restore-wp.py --until.
+# The new events are cut in segments every SEGMENT_SECONDS, compressed,
+# encrypted and uploaded in the FTP folder of the last backup, see binlog.py
+# Needs the REPLICATION SLAVE and REPLICATION CLIENT privileges
+# and write access to the local backup folder
+#
+##########################################################
+
+# Import required python libraries
+
+import os
+import sys
+import time
+import tools
+import argparse
+import subprocess
+import ftppool
+import ftprotation
+import backupjob
+import metrics
+import binlog
+
+
+# By Default, this script will read configuration from file /etc/backup-wp.conf
+# The option -f reads the parameters from another file
+'''
+1) Copy the binary logs of the server in LOCALBKPATH/binlog/spool with mysqlbinlog, from the last one copied
+2) Every SEGMENT_SECONDS, cut the new complete events in segments, compressed and encrypted
+3) Upload the segments in the FTP folder of DAYJ, the ones which failed are retried at the next cycle
+4) Delete the binary logs completely cut and the local segments older than BACKUP_RETENTION days
+'''
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("-o","--once",action="store_true",help="Copy the binary logs up to the last event and exit, ie from cron, instead of following them")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+parser.add_argument("--site",help="Site of the database, when the configuration file describes several sites")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+
+# parse the arguments
+args = parser.parse_args()
+
+try:
+    SETTINGS = backupjob.Settings(args.config,args.site)
+except ValueError as error:
+    parser.error(str(error))
+if not SETTINGS.binlog:
+    parser.error("No BINLOG section in " + args.config + ", the dumps do not record the position of the binary logs")
+
+VERBOSE = args.verbose
+
+with open(SETTINGS.keypath,'rb') as fdKey:
+    ENCRYPTION_KEY = fdKey.read()
+
+capture = binlog.Capture(SETTINGS.binlog_path,ENCRYPTION_KEY,SETTINGS.codec,SETTINGS.level,SETTINGS.binlog_size)
+connectftp = ftppool.backend(SETTINGS.ftp_backend)[0]
+
+
+def log(level, message):
+    if VERBOSE >= level:
+        print(time.strftime("%Y-%m-%d %H:%M:%S") + " " + message)
+
+
+def start_copy():
+    """Start mysqlbinlog from the first log of the spool, or from the log the server is writing"""
+    logs = capture.logs()
+    first_log = logs[0] if logs else binlog.current_log(SETTINGS.db_host)
+    if first_log is None:
+        sys.exit("The binary log of " + SETTINGS.db_host + " is disabled")
+    log(1, "Copying the binary logs from " + first_log)
+    return subprocess.Popen(capture.command(SETTINGS.mysqlbinlog,SETTINGS.db_host,first_log,not args.once))
+
+
+def upload(stage):
+    """Upload the pending segments in the folder of DAYJ, return the number of segments uploaded"""
+    pending = capture.pending()
+    ftp = connectftp(SETTINGS.ftp_server,SETTINGS.ftp_user,SETTINGS.ftp_passwd,port=SETTINGS.ftp_port)
+    try:
+        ftp.cwd(SETTINGS.ftp_root_path)
+        # DAYJ changes with the rotation of the backups, see ftprotation.py
+        folder = ftprotation.slot_dir(ftprotation.load_state(ftp),0)
+        if folder is None:
+            raise ValueError("No backup on the FTP server yet, the segments are uploaded once there is one")
+        ftp.cwd(folder)
+        for path in pending:
+            with open(path,"rb") as segment:
+                ftp.storbinary("STOR " + os.path.basename(path),segment)
+            capture.uploaded(os.path.basename(path))
+            stage.add(os.path.getsize(path),os.path.getsize(path))
+    finally:
+        tools.closeftp(ftp)
+    return len(pending)
+
+
+def cycle():
+    """Cut, upload and prune the segments, report the run in LOCALBKPATH/binlog and the textfile collector"""
+    run = metrics.Run("binlog",site=SETTINGS.site if args.site else None)
+    with run.stage("segment") as stage:
+        names = capture.cut()
+        stage.add(sum(os.path.getsize(capture.segments + "/" + name) for name in names))
+    uploaded = 0
+    if capture.pending():
+        with run.stage("upload") as stage:
+            uploaded = upload(stage)
+    pruned = capture.prune(SETTINGS.retention)
+    run.info.update(segments=len(names),uploaded=uploaded,pruned=len(pruned))
+    run.finish()
+    run.write_json(SETTINGS.binlog_path)
+    if SETTINGS.textfile_dir:
+        run.write_textfile(SETTINGS.textfile_dir)
+    for name in names:
+        log(2, "Segment " + name)
+    if names or uploaded:
+        log(1, "%d segments, %d uploaded" % (len(names),uploaded))
+
+
+copy = start_copy()
+failing = False
+try:
+    while True:
+        if args.once:
+            stopped = copy.wait()
+        else:
+            time.sleep(SETTINGS.binlog_seconds)
+            stopped = copy.poll()
+        try:
+            cycle()
+            failing = False
+        except Exception as error:
+            # The segments not uploaded stay pending, the failure is only mailed once
+            log(0, "Capture of the binary logs failed : " + str(error))
+            if not failing:
+                tools.sendmail(mailfrom=SETTINGS.smtp_from,mailto=SETTINGS.smtp_to,message="Capture of the binary logs failed\n\n" + str(error),subject="Binary logs of the Wordpress database of " + SETTINGS.site, smtphost=SETTINGS.smtp_host)
+            failing = True
+        if args.once:
+            sys.exit(1 if failing or stopped else 0)
+        if stopped is not None:
+            # Server restarted or connection lost, the copy starts again from the first log of the spool
+            log(0, "mysqlbinlog stopped with status %d" % stopped)
+            copy = start_copy()
+finally:
+    if copy.poll() is None:
+        copy.terminate()
+        copy.wait()
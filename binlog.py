@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import time
+import struct
+import subprocess
+import compress
+import encrypt
+
+# Point-in-time restore of the database from its binary logs
+#
+# The nightly dump (mysqldump --flush-logs --master-data=2, or FLUSH BINARY LOGS for DUMP=parallel)
+# starts a new binary log and records its position. Between two dumps, binlog-wp.py copies the binary
+# logs as the server writes them (mysqlbinlog --read-from-remote-server --raw --stop-never) into the
+# spool folder LOCALBKPATH/binlog/spool, and every SEGMENT_SECONDS it cuts what was added to them in
+# segments, at event boundaries and of at most SEGMENT_SIZE bytes. Each segment is compressed and
+# encrypted like the other backup files, kept in LOCALBKPATH/binlog/segments and uploaded in the FTP
+# folder of DAYJ, so the segments follow the rotation of the backups. A segment is named after its
+# binary log, the offset of its first byte in the log and the time of its first event :
+#
+#   mysql-bin.000042-000000012345-20261018121500.binlog.gz.bin
+#
+# restore-wp.py --until <time> loads the last dump taken before that time, rebuilds the binary logs
+# from the segments of all the retention folders (the segments cut between the dump and the rotation
+# are in the folder of the previous backup) and replays them from the position of the dump with
+# mysqlbinlog --stop-datetime <time> | mysql. The binary logs must not be encrypted by the server.
+
+SPOOL_DIR = "spool"
+SEGMENT_DIR = "segments"
+STATE_FILE = "state.json"
+STATE_VERSION = 1
+SEGMENT_SUFFIX = ".binlog.gz"
+SEGMENT_SECONDS = 60
+SEGMENT_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+TIME_FORMAT = "%Y%m%d%H%M%S"
+UNTIL_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+MAGIC = b"\xfebin"
+# Header of the events of the binary log format v4 : timestamp, type, server id, event size, next position, flags
+EVENT_HEADER = struct.Struct("<IBIIIH")
+SEGMENT_NAME = re.compile(r"^(.+)-(\d{12})-(\d{14})" + re.escape(SEGMENT_SUFFIX) + r"\.bin$")
+# Position written as a comment by mysqldump --master-data=2 (--source-data=2 for MySQL 8)
+POSITION = re.compile(rb"(?:MASTER|SOURCE)_LOG_FILE='([^']+)',\s*(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+POSITION_LINES = 100
+
+
+def segment_name(log, offset, when):
+    """Return the name of the encrypted segment of log starting at offset, when is the time of its first event"""
+    return "%s-%012d-%s%s.bin" % (log, offset, time.strftime(TIME_FORMAT, time.localtime(when)), SEGMENT_SUFFIX)
+
+
+def parse_segment(name):
+    """Return (log, offset, time of the first event as YYYYmmddHHMMSS) of a segment name, None for another file"""
+    match = SEGMENT_NAME.match(name)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), match.group(3)
+
+
+def scan_events(path, offset, size, limit=SEGMENT_SIZE):
+    """Return (end, timestamp) of the complete events of the binary log path from offset
+       - size: bytes of the log to consider, the last event may be incomplete
+       - limit: maximum number of bytes from offset, one event at least is taken
+       end is offset when there is no complete event, timestamp is the one of the first event
+    """
+    position = offset
+    timestamp = None
+    with open(path, "rb") as f:
+        f.seek(offset)
+        if offset == 0:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a binary log")
+            position = len(MAGIC)
+        while position + EVENT_HEADER.size <= size:
+            event_time, kind, server_id, event_size, next_position, flags = EVENT_HEADER.unpack(f.read(EVENT_HEADER.size))
+            if event_size < EVENT_HEADER.size:
+                raise ValueError("Corrupted event at offset %d of %s" % (position, path))
+            if position + event_size > size or position + event_size - offset > limit and timestamp is not None:
+                break
+            if timestamp is None or not timestamp:
+                timestamp = event_time
+            position += event_size
+            f.seek(position)
+    if timestamp is None:
+        return offset, None
+    return position, timestamp or time.time()
+
+
+class Capture:
+    """Segments of the binary logs copied in the spool folder, see above
+       - folder: LOCALBKPATH/binlog, holds the spool, the segments and the state of the capture
+       - key: AES key used for encryption
+       - codec, level: compression of the segments, see compress.get_compressor
+       - segment_size: maximum size of the events of a segment
+       The state gives the offset up to which each log of the spool has been cut in segments,
+       and the segments not uploaded yet.
+    """
+    def __init__(self, folder, key, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, segment_size=SEGMENT_SIZE):
+        self.spool = os.path.join(folder, SPOOL_DIR)
+        self.segments = os.path.join(folder, SEGMENT_DIR)
+        self.state_path = os.path.join(folder, STATE_FILE)
+        self.key = key
+        self.codec = "gzip" if codec == "pgzip" else codec
+        self.level = level
+        self.segment_size = segment_size
+        os.makedirs(self.spool, exist_ok=True)
+        os.makedirs(self.segments, exist_ok=True)
+        self.state = {"version": STATE_VERSION, "logs": {}, "pending": []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+            if self.state.get("version") != STATE_VERSION:
+                raise ValueError("Unsupported binary log capture state version")
+
+    def save(self):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def logs(self):
+        """Return the names of the binary logs of the spool, oldest first"""
+        return sorted(name for name in os.listdir(self.spool) if not name.startswith("."))
+
+    def _write_segment(self, log, offset, end, when):
+        name = segment_name(log, offset, when)
+        path = os.path.join(self.segments, name)
+        with open(os.path.join(self.spool, log), "rb") as source, open(path + ".tmp", "wb") as f:
+            source.seek(offset)
+            writer = encrypt.EncryptWriter(f, self.key)
+            compressor = compress.CompressWriter(writer, self.codec, self.level)
+            left = end - offset
+            while left:
+                data = source.read(min(left, READ_SIZE))
+                if not data:
+                    raise ValueError("Binary log " + log + " is shorter than expected")
+                compressor.write(data)
+                left -= len(data)
+            compressor.close()
+            writer.close()
+        os.replace(path + ".tmp", path)
+        return name
+
+    def cut(self):
+        """Cut the events added to the logs of the spool in segments, return the names of the new segments"""
+        names = []
+        for log in self.logs():
+            path = os.path.join(self.spool, log)
+            size = os.path.getsize(path)
+            offset = self.state["logs"].get(log, 0)
+            while True:
+                end, when = scan_events(path, offset, size, self.segment_size)
+                if end == offset:
+                    break
+                names.append(self._write_segment(log, offset, end, when))
+                offset = end
+                self.state["logs"][log] = offset
+                self.state["pending"].append(names[-1])
+                self.save()
+        return names
+
+    def pending(self):
+        """Return the paths of the segments not uploaded yet, oldest first"""
+        return [os.path.join(self.segments, name) for name in self.state["pending"]]
+
+    def uploaded(self, name):
+        """Record that the segment name is on the FTP server"""
+        self.state["pending"].remove(name)
+        self.save()
+
+    def prune(self, days):
+        """Delete the logs of the spool which are complete and the local segments older than days days
+           return the names of the deleted files
+        """
+        deleted = []
+        logs = self.logs()
+        for log in logs[:-1]:
+            # mysqlbinlog only writes the last log, the other ones are complete
+            if self.state["logs"].get(log, 0) == os.path.getsize(os.path.join(self.spool, log)):
+                os.remove(os.path.join(self.spool, log))
+                del self.state["logs"][log]
+                deleted.append(log)
+        oldest = time.strftime(TIME_FORMAT, time.localtime(time.time() - days * 86400))
+        for name in sorted(os.listdir(self.segments)):
+            segment = parse_segment(name)
+            if segment is not None and segment[2] < oldest and name not in self.state["pending"]:
+                os.remove(os.path.join(self.segments, name))
+                deleted.append(name)
+        if deleted:
+            self.save()
+        return deleted
+
+    def command(self, mysqlbinlog, host, first_log, follow=True):
+        """Return the command copying the binary logs from first_log into the spool
+           - follow: True to wait for the new events forever, False to stop at the end of the last log
+        """
+        return [mysqlbinlog, "--read-from-remote-server", "--host=" + host, "--raw",
+                "--stop-never" if follow else "--to-last-log", "--result-file=" + self.spool + os.sep, first_log]
+
+
+def current_log(host, mysql="mysql"):
+    """Return the name of the binary log the server is writing, None if the binary log is disabled"""
+    output = subprocess.run([mysql, "-h", host, "-N", "-B", "-e", "SHOW MASTER STATUS"], stdout=subprocess.PIPE, check=True, text=True).stdout
+    return output.split()[0] if output.strip() else None
+
+
+def dump_position(fileobj):
+    """Return the position {"file", "position"} recorded at the beginning of the compressed SQL dump fileobj, None if there is none"""
+    reader = compress.DecompressReader(fileobj)
+    head = b""
+    while head.count(b"\n") < POSITION_LINES:
+        data = reader.read(64 * 1024)
+        if not data:
+            break
+        head += data
+    match = POSITION.search(head)
+    if match is None:
+        return None
+    return {"file": match.group(1).decode(), "position": int(match.group(2))}
+
+
+def parse_until(text):
+    """Return the time of text, ie 2026-10-18 12:15 or 2026-10-18T12:15:30, in seconds since the epoch"""
+    text = text.strip().replace("T", " ")
+    for pattern in (UNTIL_FORMAT, "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, pattern))
+        except ValueError:
+            pass
+    raise ValueError("Invalid time " + text + ", expected YYYY-MM-DD HH:MM:SS")
+
+
+def backup_day(dates, until):
+    """Return the index of the newest backup of the day of until or before
+       - dates: dates of the backups as YYYYmmdd, the last one first, "" when unknown
+       return 0 when the date of the backups is not known
+    """
+    day = time.strftime("%Y%m%d", time.localtime(until))
+    for index, date in enumerate(dates):
+        if date and date <= day:
+            return index
+    return 0
+
+
+def plan(names, position, until):
+    """Return the segments to replay from position until the time until, by log
+       - names: names of the segments available
+       - position: position of the dump, see dump_position
+       - until: time in seconds since the epoch
+       return a list of (log, [segment names sorted by offset])
+       raise ValueError when the log of the dump has no segment before until
+    """
+    limit = time.strftime(TIME_FORMAT, time.localtime(until))
+    logs = {}
+    for name in set(names):
+        segment = parse_segment(name)
+        if segment is not None and segment[0] >= position["file"] and segment[2] <= limit:
+            logs.setdefault(segment[0], []).append((segment[1], name))
+    if position["file"] not in logs:
+        raise ValueError("No segment of the binary log %s before %s : the dump was taken after this time, or the binary logs were not captured" % (position["file"], time.strftime(UNTIL_FORMAT, time.localtime(until))))
+    ordered = sorted(logs)
+    for previous, log in zip(ordered, ordered[1:]):
+        base, number = log.rsplit(".", 1)
+        if (base + "." + "%0*d" % (len(number), int(number) - 1)) != previous:
+            raise ValueError("No segment of the binary logs between %s and %s" % (previous, log))
+    return [(log, [name for offset, name in sorted(logs[log])]) for log in ordered]
+
+
+def rebuild(logs, open_segment, key, folder):
+    """Write the binary logs of the plan logs in folder from their segments, return their paths
+       - open_segment: function returning a file object reading a segment by name
+       raise ValueError if a segment is missing
+    """
+    paths = []
+    for log, names in logs:
+        path = os.path.join(folder, log)
+        with open(path, "wb") as out:
+            for name in names:
+                offset = parse_segment(name)[1]
+                if offset != out.tell():
+                    raise ValueError("Segment of %s missing between offsets %d and %d" % (log, out.tell(), offset))
+                with open_segment(name) as fileobj:
+                    reader = compress.DecompressReader(encrypt.DecryptReader(fileobj, key))
+                    while True:
+                        data = reader.read(READ_SIZE)
+                        if not data:
+                            break
+                        out.write(data)
+        paths.append(path)
+    return paths
+
+
+def replay(paths, position, until, host, database, mysqlbinlog="mysqlbinlog"):
+    """Apply the events of the binary logs paths to database, from position until the time until
+       The events of the other databases of the server are skipped.
+       raise subprocess.CalledProcessError if mysqlbinlog or mysql fails
+    """
+    command = [mysqlbinlog, "--start-position=" + str(position["position"]), "--stop-datetime=" + time.strftime(UNTIL_FORMAT, time.localtime(until)),
+               "--database=" + database] + list(paths)
+    importcmd = ["mysql", "-h", host, database]
+    reader = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        writer = subprocess.Popen(importcmd, stdin=reader.stdout)
+    finally:
+        reader.stdout.close()
+    if writer.wait() != 0:
+        reader.kill()
+        reader.wait()
+        raise subprocess.CalledProcessError(writer.returncode, importcmd)
+    if reader.wait() != 0:
+        raise subprocess.CalledProcessError(reader.returncode, command)
@@ -0,0 +1,284 @@
+import os
+import gzip
+import json
+import time
+import contextlib
+import zlib
+import sqlite3
+import hashlib
+import compress
+import encrypt
+import incremental
+import pipeline
+import fileio
+
+# Deduplicating store of the site archive
+#
+# With MODE=dedup, the tar stream of WP_PATH is cut in chunks by content-defined chunking : a chunk
+# ends where a hash of the last bytes matches a pattern, so an insertion or a deletion only changes
+# the chunks around it and the following boundaries are found again at the same content.
+# Each chunk is identified by the sha256 of its content. Chunks not yet stored are compressed and
+# encrypted in a new pack file (see incremental.PackWriter) under LOCALBKPATH/chunks and FTP_PATH/chunks.
+# DAYJ only holds the recipe of the archive, the list of its chunks, so the retention folders
+# together take about one full archive plus the daily changes.
+#
+# The index (LOCALBKPATH/chunks/index.sqlite) maps every chunk to its pack with a reference count,
+# the number of recipes using it. When a retention folder is deleted its recipe is released, and a
+# pack is deleted, locally and on the FTP server, once none of its chunks is referenced anymore.
+#
+# Chunking : the hash is a tabulation hash of the last WINDOW bytes, computed for a whole block
+# at once with big integer operations (one translate, shift and xor per byte of the window).
+# Positions where it is zero (1 out of 256) are confirmed with the crc32 of the last CONFIRM_WINDOW
+# bytes, which gives chunks of AVERAGE_SIZE on average, between MIN_SIZE and MAX_SIZE.
+
+CHUNK_DIR = "chunks"
+INDEX = "index.sqlite"
+RECIPE = "wordpress.site.chunks.gz"
+RECIPE_VERSION = 1
+MIN_SIZE = 64 * 1024
+MAX_SIZE = 1024 * 1024
+AVERAGE_SIZE = 256 * 1024
+WINDOW = 8
+CONFIRM_WINDOW = 32
+CONFIRM_MASK = AVERAGE_SIZE // 256 - 1
+READ_SIZE = 4 * 1024 * 1024
+
+# One permutation of the byte values per position of the window
+_TABLES = [bytes(sorted(range(256), key=lambda value: hashlib.sha256(bytes([position, value])).digest())) for position in range(WINDOW)]
+
+
+def _lanes(data):
+    """Return the hash of the WINDOW bytes ending at each position of data, one byte per position"""
+    value = 0
+    for position, table in enumerate(_TABLES):
+        value ^= int.from_bytes(data.translate(table), "little") << (8 * position)
+    return value.to_bytes(len(data) + WINDOW, "little")
+
+
+def _cuts(data, final):
+    """Return the offsets where the chunks of data end
+       Without final, the data after the last boundary is kept for the next block.
+    """
+    lanes = _lanes(data)
+    cuts = []
+    start = 0
+    while start < len(data):
+        end = min(start + MAX_SIZE, len(data))
+        position = lanes.find(0, start + MIN_SIZE - 1, end)
+        while position != -1 and zlib.crc32(data[position + 1 - CONFIRM_WINDOW:position + 1]) & CONFIRM_MASK:
+            position = lanes.find(0, position + 1, end)
+        if position != -1:
+            start = position + 1
+        elif start + MAX_SIZE <= len(data):
+            start += MAX_SIZE
+        elif final:
+            start = len(data)
+        else:
+            break
+        cuts.append(start)
+    return cuts
+
+
+def chunks(fileobj):
+    """Yield the content-defined chunks of the stream fileobj"""
+    buffer = b""
+    while True:
+        data = fileobj.read(READ_SIZE)
+        buffer += data
+        start = 0
+        for cut in _cuts(buffer, not data):
+            yield buffer[start:cut]
+            start = cut
+        buffer = buffer[start:]
+        if not data:
+            return
+
+
+def read_recipe(path):
+    """Yield the chunks of a recipe as [sha256, pack, offset, length]"""
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != RECIPE_VERSION:
+            raise ValueError("Unsupported recipe version")
+        for line in f:
+            yield json.loads(line)
+
+
+class ChunkStore:
+    """Local chunk store and its index
+       - path: folder of the packs and of the index
+       - key: AES key used for encryption of the chunks, not needed to release recipes
+       - codec, level: compression of the chunks, see compress.get_compressor
+       - media: True to compress the chunks of media like the others, see incremental.PackWriter
+       The store may be used by successive tasks of a scheduler, one thread at a time.
+    """
+    def __init__(self, path, key=None, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, media=False):
+        self.path = path
+        self.key = key
+        self.codec = codec
+        self.level = level
+        self.media = media
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, INDEX), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (hash BLOB PRIMARY KEY, pack TEXT, offset INTEGER, length INTEGER, refs INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack)")
+        self.db.commit()
+
+    def _release(self, recipe_path):
+        hashes = set(bytes.fromhex(chunk[0]) for chunk in read_recipe(recipe_path))
+        self.db.executemany("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", [(digest,) for digest in hashes])
+
+    def release(self, recipe_path):
+        """Release the chunks of the recipe of a deleted retention folder"""
+        if os.path.exists(recipe_path):
+            self._release(recipe_path)
+            self.db.commit()
+
+    def backup(self, fileobj, recipe_path, pack_id):
+        """Store the stream fileobj and write its recipe
+           - fileobj: stream to store, ie the tar stream of WP_PATH
+           - recipe_path: recipe to write, the chunks of a recipe already there are released
+           - pack_id: name of the pack receiving the new chunks
+           return a dict with the counters of the backup, "pack" is False if no chunk has been written,
+           "classes" the stats of the new chunks of each class
+        """
+        pack_path = os.path.join(self.path, pack_id + incremental.PACK_SUFFIX)
+        pack = incremental.PackWriter(pack_path, self.key, self.codec, self.level, self.media)
+        counters = {"chunks": 0, "new_chunks": 0, "bytes": 0, "bytes_stored": 0}
+        used = set()
+        tmp_path = recipe_path + ".tmp"
+        try:
+            with gzip.open(tmp_path, "wt") as out:
+                out.write(json.dumps({"version": RECIPE_VERSION, "date": time.strftime('%Y%m%d'), "pack": pack_id}) + "\n")
+                for chunk in chunks(fileobj):
+                    digest = hashlib.sha256(chunk).digest()
+                    row = self.db.execute("SELECT pack, offset, length FROM chunks WHERE hash = ?", (digest,)).fetchone()
+                    if row is None:
+                        offset, length = pack.add_data(chunk)
+                        row = (pack_id, offset, length)
+                        self.db.execute("INSERT INTO chunks VALUES (?, ?, ?, ?, 0)", (digest,) + row)
+                        counters["new_chunks"] += 1
+                        counters["bytes_stored"] += length
+                    used.add(digest)
+                    counters["chunks"] += 1
+                    counters["bytes"] += len(chunk)
+                    out.write(json.dumps([digest.hex()] + list(row)) + "\n")
+            counters["pack"] = pack.close()
+            counters["classes"] = pack.classes
+            if os.path.exists(recipe_path):
+                self._release(recipe_path)
+            self.db.executemany("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", [(digest,) for digest in used])
+            os.replace(tmp_path, recipe_path)
+        except BaseException:
+            self.db.rollback()
+            pack.close()
+            if os.path.exists(pack_path):
+                os.remove(pack_path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.db.commit()
+        return counters
+
+    def copy_recipe(self, source_path, recipe_path):
+        """Reference the chunks of the recipe source_path from recipe_path, used when the tree did not change
+           A recipe already at recipe_path is released.
+        """
+        hashes = set(bytes.fromhex(chunk[0]) for chunk in read_recipe(source_path))
+        tmp_path = recipe_path + ".tmp"
+        fileio.copy_file(source_path, tmp_path)
+        if os.path.exists(recipe_path):
+            self._release(recipe_path)
+        self.db.executemany("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", [(digest,) for digest in hashes])
+        os.replace(tmp_path, recipe_path)
+        self.db.commit()
+
+    def live_packs(self):
+        """Return the set of pack ids holding at least one referenced chunk"""
+        return set(row[0] for row in self.db.execute("SELECT DISTINCT pack FROM chunks WHERE refs > 0"))
+
+    def collect(self):
+        """Delete the packs without referenced chunks, return the deleted file names"""
+        live = self.live_packs()
+        self.db.execute("DELETE FROM chunks WHERE pack IN (SELECT pack FROM chunks GROUP BY pack HAVING MAX(refs) <= 0)")
+        self.db.commit()
+        return incremental.prune_packs(self.path, live)
+
+    def stats(self):
+        """Return the number of chunks and the stored size of the referenced chunks"""
+        return self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE refs > 0").fetchone()
+
+    def close(self):
+        self.db.close()
+
+
+def backup_tree(store, path, recipe_path, pack_id):
+    """Store the tar stream of the folder path in store, see ChunkStore.backup"""
+    archive = pipeline.Pipeline()
+    tarred = archive.pipe()
+    archive.add(pipeline.tar_stage, path, tarred)
+    try:
+        counters = store.backup(pipeline.PipeReader(tarred), recipe_path, pack_id)
+    except BaseException:
+        archive.abort.set()
+        raise
+    finally:
+        archive.wait()
+    return counters
+
+
+def restore_tree(recipe_path, pack_dir, key, dest="/", paths=None):
+    """Extract the tar stream described by a recipe in the folder dest
+       - paths: optional, only extract these members and everything below them
+    """
+    incremental.extract_selected(lambda: contextlib.closing(RecipeReader(recipe_path, pack_dir, key)), dest, paths, pipeline.BLOCK_SIZE)
+
+
+def recipe_packs(recipe_path):
+    """Return the set of pack ids referenced by a recipe"""
+    return set(chunk[1] for chunk in read_recipe(recipe_path))
+
+
+class RecipeReader:
+    """File-like object returning the stream described by a recipe
+       - recipe_path: clear recipe
+       - pack_dir: local folder containing all the packs referenced by the recipe
+       - key: AES key used for encryption of the chunks
+    """
+    def __init__(self, recipe_path, pack_dir, key):
+        self.chunks = read_recipe(recipe_path)
+        self.pack_dir = pack_dir
+        self.key = key
+        self.packs = {}
+        self.buffer = b""
+        self.position = 0
+
+    def _next_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return None
+        digest, pack_id, offset, length = chunk
+        if pack_id not in self.packs:
+            self.packs[pack_id] = fileio.open_mapped(os.path.join(self.pack_dir, pack_id + incremental.PACK_SUFFIX))
+        pack = self.packs[pack_id]
+        pack.seek(offset)
+        data = compress.DecompressReader(encrypt.DecryptReader(pack, self.key, check_end=False)).read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Content of chunk " + digest + " does not match the recipe")
+        return data
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            data = self._next_chunk()
+            if data is None:
+                break
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        for pack in self.packs.values():
+            pack.close()
@@ -0,0 +1,491 @@
+import os
+import time
+import collections
+import concurrent.futures
+import gzip
+import zlib
+import governor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compression codecs used for the site archive and the SQL dump :
+#
+#   gzip  : single stream gzip, single core (same as tar czf / gzip)
+#   pgzip : parallel gzip, the stream is split in blocks compressed independently
+#           by a pool of processes. Each block is a complete gzip member, so the result
+#           is a multi-member gzip file readable by stock gzip, zcat and tarfile.
+#   zstd  : zstandard, multi-threaded, needs the python module zstandard
+#   lz4   : lz4 frame, needs the python module lz4
+#
+# The codec of a compressed file is detected from its first bytes, so restore does not
+# need to know which codec was used for the backup.
+#
+# Most of the bytes of a site are uploads already compressed (images, videos, audio, archives,
+# fonts) : compressing them again burns CPU for nothing. classify() sorts the files in two classes,
+# text and media, from their extension, then from the magic bytes and a fast compression test of
+# their first SAMPLE_SIZE bytes. The compressors switch to their fastest setting with raw() for the
+# media, a stored gzip member (level 0), a zstd frame at level 1 (zstd stores incompressible blocks
+# as is) or a lz4 frame (already the fastest), so the result is still a stream of the codec.
+
+CODECS = ["gzip", "pgzip", "zstd", "lz4"]
+DEFAULT_CODEC = "gzip"
+DEFAULT_LEVEL = 6
+BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+MAGIC_GZIP = b"\x1f\x8b"
+MAGIC_ZSTD = b"\x28\xb5\x2f\xfd"
+MAGIC_LZ4 = b"\x04\x22\x4d\x18"
+
+CLASSES = ("text", "media")
+RAW_LEVELS = {"gzip": 0, "pgzip": 0, "zstd": 1, "lz4": 0}
+MEDIA_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "avif", "heic", "ico",
+    "mp4", "m4v", "mov", "webm", "mkv", "avi", "mpg", "mpeg", "wmv", "flv",
+    "mp3", "m4a", "aac", "ogg", "oga", "opus", "flac", "wma",
+    "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "zst", "lz4", "jar", "apk",
+    "woff", "woff2", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub",
+}
+MEDIA_MAGICS = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", MAGIC_GZIP, MAGIC_ZSTD, MAGIC_LZ4,
+                b"BZh", b"\xfd7zXZ", b"7z\xbc\xaf", b"Rar!", b"OggS", b"fLaC", b"ID3", b"wOFF", b"wOF2", b"\x1aE\xdf\xa3")
+SAMPLE_SIZE = 64 * 1024
+# Samples compressed by zlib level 1 to more than SAMPLE_RATIO of their size are incompressible
+SAMPLE_RATIO = 0.9
+
+
+def is_media(head):
+    """Return True if the data starting with head is already compressed, from its magic bytes
+       or from the compression of head
+    """
+    if head.startswith(MEDIA_MAGICS) or head[4:8] == b"ftyp" or head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI "):
+        return True
+    return len(head) >= 4096 and len(zlib.compress(head[:SAMPLE_SIZE], 1)) > SAMPLE_RATIO * len(head[:SAMPLE_SIZE])
+
+
+def classify(path, size, head=None):
+    """Return the class of the file path of size bytes, text or media, see is_media
+       - head: optional, first bytes of the file already read
+       Only the files with an unknown extension and of at least SAMPLE_SIZE bytes are read.
+    """
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension in MEDIA_EXTENSIONS:
+        return "media"
+    if size < SAMPLE_SIZE:
+        return "text"
+    if head is None:
+        try:
+            with open(path, "rb") as f:
+                head = f.read(SAMPLE_SIZE)
+        except OSError:
+            return "text"
+    return "media" if is_media(head) else "text"
+
+
+def _workers(workers):
+    if not workers:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+class GzipCompressor:
+    """Single stream gzip compressor"""
+    def __init__(self, level=DEFAULT_LEVEL):
+        self.level = level
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def raw(self):
+        """Store what follows in a new gzip member, return the end of the current one"""
+        if self.level == 0:
+            return b""
+        data = self.compressor.flush()
+        self.level = 0
+        self.compressor = zlib.compressobj(0, zlib.DEFLATED, 31)
+        return data
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+def _gzip_block(data, level):
+    return gzip.compress(data, level, mtime=0)
+
+
+class ParallelGzipCompressor:
+    """pigz-like gzip compressor using a pool of processes
+       - level: gzip compression level
+       - workers: number of processes, 0 for the number of cores
+       - block_size: size of the clear data of each independent gzip member
+       At most 2 * workers blocks are in flight, so memory usage stays bounded.
+       blocks lists (clear size, compressed size) for every member written.
+    """
+    def __init__(self, level=DEFAULT_LEVEL, workers=0, block_size=BLOCK_SIZE):
+        self.level = level
+        self.workers = _workers(workers)
+        self.block_size = block_size
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=governor.child_setup)
+        # Start all the processes now, before the caller starts other threads
+        for future in [self.pool.submit(int) for index in range(self.workers)]:
+            future.result()
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.blocks = []
+
+    def _submit(self, block):
+        self.pending.append((len(block), self.pool.submit(_gzip_block, block, self.level)))
+
+    def _collect(self, keep):
+        output = []
+        while len(self.pending) > keep:
+            clear_size, future = self.pending.popleft()
+            data = future.result()
+            self.blocks.append((clear_size, len(data)))
+            output.append(data)
+        return b"".join(output)
+
+    def compress(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return self._collect(2 * self.workers)
+
+    def raw(self):
+        """Store the next blocks (gzip level 0), return the blocks compressed so far"""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.level = 0
+        return self._collect(0)
+
+    def flush(self):
+        if self.buffer or not self.blocks and not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        data = self._collect(0)
+        self.pool.shutdown()
+        return data
+
+
+class ZstdCompressor:
+    """zstandard compressor, multi-threaded"""
+    def __init__(self, level=DEFAULT_LEVEL, workers=0):
+        if zstandard is None:
+            raise ValueError("Codec zstd needs the python module zstandard")
+        self.level = level
+        self.workers = workers
+        self.compressor = zstandard.ZstdCompressor(level=level, threads=_workers(workers)).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def raw(self):
+        """Compress what follows in a new frame at the level of RAW_LEVELS, return the end of the current one"""
+        if self.level == RAW_LEVELS["zstd"]:
+            return b""
+        data = self.compressor.flush()
+        self.level = RAW_LEVELS["zstd"]
+        self.compressor = zstandard.ZstdCompressor(level=self.level, threads=_workers(self.workers)).compressobj()
+        return data
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class Lz4Compressor:
+    """lz4 frame compressor"""
+    def __init__(self, level=0):
+        if lz4 is None:
+            raise ValueError("Codec lz4 needs the python module lz4")
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def raw(self):
+        """lz4 is fast enough on incompressible data, nothing changes"""
+        return b""
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.flush()
+        return self.compressor.flush()
+
+
+def check_codec(codec):
+    """raise ValueError if codec is not one of CODECS or needs a python module which is not installed"""
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec " + codec)
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("Codec zstd needs the python module zstandard")
+    if codec == "lz4" and lz4 is None:
+        raise ValueError("Codec lz4 needs the python module lz4")
+
+
+def get_compressor(codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=0):
+    """Return a new compressor object with the methods compress(data) and flush()
+       - codec: one of CODECS
+       - level: compression level of the codec
+       - workers: number of processes or threads for pgzip and zstd, 0 for the number of cores
+    """
+    if codec == "gzip":
+        return GzipCompressor(level)
+    if codec == "pgzip":
+        return ParallelGzipCompressor(level, workers)
+    if codec == "zstd":
+        return ZstdCompressor(level, workers)
+    if codec == "lz4":
+        return Lz4Compressor(level)
+    raise ValueError("Unknown compression codec " + codec)
+
+
+class BlockCompressor:
+    """Compressor writing independent blocks of block_size bytes of clear data
+       Each block is a complete gzip member, zstd frame or lz4 frame, so decompression can start
+       at the beginning of any block. blocks lists (clear size, compressed size) for every block
+       written, like ParallelGzipCompressor.
+    """
+    def __init__(self, codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=0, block_size=BLOCK_SIZE):
+        self.codec = codec
+        self.level = level
+        self.workers = workers
+        self.block_size = block_size
+        self.compressor = None
+        self.filled = 0
+        self.compressed = 0
+        self.blocks = []
+
+    def _end(self):
+        data = self.compressor.flush()
+        self.blocks.append((self.filled, self.compressed + len(data)))
+        self.compressor = None
+        return data
+
+    def compress(self, data):
+        output = []
+        view = memoryview(data)
+        while view:
+            if self.compressor is None:
+                self.compressor = get_compressor(self.codec, self.level, self.workers)
+                self.filled = 0
+                self.compressed = 0
+            size = min(len(view), self.block_size - self.filled)
+            output.append(self.compressor.compress(bytes(view[:size])))
+            self.compressed += len(output[-1])
+            self.filled += size
+            view = view[size:]
+            if self.filled == self.block_size:
+                output.append(self._end())
+        return b"".join(output)
+
+    def raw(self):
+        """Compress the next blocks at the level of RAW_LEVELS, return the end of the current block"""
+        self.level = RAW_LEVELS[self.codec]
+        if self.compressor is None:
+            return b""
+        return self._end()
+
+    def flush(self):
+        if self.compressor is None and not self.blocks:
+            # Empty stream, still write a valid compressed stream
+            self.compressor = get_compressor(self.codec, self.level, self.workers)
+        if self.compressor is None:
+            return b""
+        return self._end()
+
+
+def get_block_compressor(codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=0, block_size=BLOCK_SIZE):
+    """Return a compressor writing independent blocks of block_size bytes of clear data
+       The sizes of the blocks are listed in its attribute blocks once flushed.
+    """
+    if codec == "pgzip":
+        return ParallelGzipCompressor(level, workers, block_size)
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec " + codec)
+    return BlockCompressor(codec, level, workers, block_size)
+
+
+class ClassCompressor:
+    """Compressor counting the bytes and the time of compression by class, see classify
+       - compressor: compressor of the text, raw() switches it to the media
+       stats gives bytes_in, bytes_out and seconds of each class, blocks the blocks of compressor.
+    """
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.current = "text"
+        self.stats = {name: {"bytes_in": 0, "bytes_out": 0, "seconds": 0.0} for name in CLASSES}
+
+    def _count(self, bytes_in, output, start):
+        stats = self.stats[self.current]
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += len(output)
+        stats["seconds"] += time.perf_counter() - start
+        return output
+
+    def compress(self, data):
+        start = time.perf_counter()
+        return self._count(len(data), self.compressor.compress(data), start)
+
+    def raw(self):
+        """The data compressed from now on are media"""
+        start = time.perf_counter()
+        output = self._count(0, self.compressor.raw(), start)
+        self.current = "media"
+        return output
+
+    def flush(self):
+        start = time.perf_counter()
+        return self._count(0, self.compressor.flush(), start)
+
+    @property
+    def blocks(self):
+        return self.compressor.blocks
+
+
+def detect(head):
+    """Return the codec of compressed data from its first bytes"""
+    if head.startswith(MAGIC_GZIP):
+        return "gzip"
+    if head.startswith(MAGIC_ZSTD):
+        return "zstd"
+    if head.startswith(MAGIC_LZ4):
+        return "lz4"
+    raise ValueError("Unknown compression format")
+
+
+class Decompressor:
+    """Streaming decompressor for the codecs of this module
+       Concatenated streams (multi-member gzip written by pgzip) are decompressed in sequence.
+       finished is True when the data given so far end with the end of a stream.
+       raise ValueError when the data are not valid for the codec.
+    """
+    def __init__(self, codec):
+        check_codec(codec)
+        self.codec = codec
+        self.decompressor = self._new()
+        self.finished = False
+        # Errors of the codec libraries on corrupt data, lz4.frame raises RuntimeError
+        if codec == "gzip":
+            self.errors = zlib.error
+        elif codec == "zstd":
+            self.errors = zstandard.ZstdError
+        else:
+            self.errors = RuntimeError
+
+    def _new(self):
+        if self.codec == "gzip":
+            return zlib.decompressobj(31)
+        if self.codec == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self.decompressor.decompress(data))
+            except self.errors as error:
+                raise ValueError("Corrupt " + self.codec + " data : " + str(error))
+            self.finished = self.decompressor.eof
+            if not self.decompressor.eof:
+                break
+            # End of a member, go on with the next one
+            data = self.decompressor.unused_data
+            self.decompressor = self._new()
+        return b"".join(output)
+
+
+class CompressWriter:
+    """File-like object compressing everything written to it into fileobj
+       close() flushes the compressor but does not close fileobj.
+    """
+    def __init__(self, fileobj, codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=0, compressor=None):
+        self.fileobj = fileobj
+        self.compressor = compressor or get_compressor(codec, level, workers)
+        self.bytes_in = 0
+        self.closed = False
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        output = self.compressor.compress(data)
+        if output:
+            self.fileobj.write(output)
+        return len(data)
+
+    def raw(self):
+        """Compress what is written from now on with the fastest setting of the codec, see classify"""
+        output = self.compressor.raw()
+        if output:
+            self.fileobj.write(output)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.write(self.compressor.flush())
+            self.closed = True
+
+
+class DecompressReader:
+    """File-like object returning the decompressed data of fileobj, codec is detected automatically
+       raise ValueError when fileobj is empty, corrupt or ends in the middle of a stream, a truncated
+       file is never returned as a shorter one.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.buffer = bytearray()
+        self.decompressor = None
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(READ_SIZE)
+            if not data:
+                self.eof = True
+                if self.decompressor is None:
+                    raise ValueError("No compressed data")
+                if not self.decompressor.finished:
+                    raise ValueError("Compressed data truncated")
+                break
+            if self.decompressor is None:
+                self.decompressor = Decompressor(detect(data))
+            self.buffer += self.decompressor.decompress(data)
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            # Deleting the head of a bytearray does not copy the rest of it
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def close(self):
+        pass
+
+
+def compress_file(src, dst, codec=DEFAULT_CODEC, level=DEFAULT_LEVEL, workers=0):
+    """Compress the local file src into the local file dst"""
+    with open(src, "rb") as f, open(dst, "wb") as file_out:
+        writer = CompressWriter(file_out, codec, level, workers)
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
@@ -0,0 +1,377 @@
+import os
+import re
+import json
+import shutil
+import tarfile
+import tempfile
+import multiprocessing
+import compress
+import governor
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+# Parallel logical dump and import of the MySQL database
+#
+# Instead of a single mysqldump stream, the tables are exported by a pool of worker processes,
+# one file per table or per chunk of a big table. Tables with an integer primary key are split
+# in ranges of this key of about CHUNK_ROWS rows each, so wp_postmeta or wp_options are exported
+# and imported by all the workers at once.
+#
+# Consistent snapshot : the coordinator takes FLUSH TABLES WITH READ LOCK (or LOCK TABLES ... READ
+# without the RELOAD privilege), every worker starts a transaction WITH CONSISTENT SNAPSHOT, then
+# the lock is released. All the workers see the database at the same point in time, as
+# mysqldump --single-transaction does for a single session (InnoDB tables only). A worker started by the pool
+# to replace one that died would start its snapshot after the lock is released : the dump then fails.
+#
+# The dump is an uncompressed tar file (DB_NAME.dump.tar) holding :
+#   - metadata.json : the tables with their CREATE TABLE statement without secondary indexes,
+#                     the deferred indexes, the names of their chunks, the views and triggers
+#   - one compressed file of INSERT statements per chunk, one statement per line
+#
+# The import creates the tables without their secondary indexes, loads the chunks in parallel,
+# then adds the indexes of each table with a single ALTER TABLE, tables in parallel. InnoDB creates only one
+# FULLTEXT index per statement (error 1795), each of them is added by its own ALTER TABLE after the others.
+# Values are read and written with the binary character set (SET NAMES binary in the workers of the dump
+# and of the import), so the content of every column is restored byte for byte whatever its character set.
+#
+# Needs the python module pymysql. Credentials are read from ~/.my.cnf like mysqldump.
+
+DUMP_VERSION = 1
+DUMP_SUFFIX = ".dump.tar"
+METADATA = "metadata.json"
+CHUNK_ROWS = 100000
+STATEMENT_SIZE = 1024 * 1024
+SNAPSHOT_TIMEOUT = 60
+
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "bigint")
+# Clauses of CREATE TABLE added after the data is loaded
+DEFERRED = re.compile(r"^((UNIQUE |FULLTEXT |SPATIAL )?KEY |CONSTRAINT .* FOREIGN KEY )")
+
+
+def connect(host, database=None, **kwargs):
+    """Return a new pymysql connection, credentials are read from ~/.my.cnf if it exists"""
+    if pymysql is None:
+        raise ValueError("Parallel dump needs the python module pymysql")
+    my_cnf = os.path.expanduser("~/.my.cnf")
+    if os.path.exists(my_cnf):
+        kwargs.setdefault("read_default_file", my_cnf)
+    return pymysql.connect(host=host, database=database, charset="utf8mb4", autocommit=True, **kwargs)
+
+
+def _quote(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def split_create(create):
+    """Split a CREATE TABLE statement, return (statement without the deferred clauses, deferred clauses)
+       Indexes on an AUTO_INCREMENT column are kept, the column must be indexed when the table is created.
+    """
+    lines = create.split("\n")
+    close = max(index for index, line in enumerate(lines) if line.startswith(")"))
+    clauses = [line.strip().rstrip(",") for line in lines[1:close]]
+    auto = ["`" + clause.split("`")[1] + "`" for clause in clauses if clause.startswith("`") and " AUTO_INCREMENT" in clause]
+    kept = []
+    deferred = []
+    for clause in clauses:
+        if DEFERRED.match(clause) and not any(column in clause for column in auto):
+            deferred.append(clause)
+        else:
+            kept.append(clause)
+    return "\n".join([lines[0], ",\n".join("  " + clause for clause in kept)] + lines[close:]), deferred
+
+
+def _table_info(cursor, database, name, rows, chunk_rows):
+    """Return the description of a table : columns dumped, create statement, chunks"""
+    cursor.execute("SHOW CREATE TABLE " + _quote(name))
+    create, indexes = split_create(cursor.fetchone()[1])
+    cursor.execute("SELECT COLUMN_NAME, DATA_TYPE, EXTRA FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION", (database, name))
+    columns = []
+    types = {}
+    for column, data_type, extra in cursor.fetchall():
+        types[column] = data_type.lower()
+        # Generated columns are computed by the server, they can not be inserted
+        if "GENERATED" not in extra.upper() and "PERSISTENT" not in extra.upper():
+            columns.append(column)
+    cursor.execute("SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND CONSTRAINT_NAME='PRIMARY' ORDER BY ORDINAL_POSITION", (database, name))
+    primary = [row[0] for row in cursor.fetchall()]
+    ranges = [None]
+    if len(primary) == 1 and types[primary[0]] in INTEGER_TYPES and rows > chunk_rows:
+        cursor.execute("SELECT MIN({0}), MAX({0}) FROM {1}".format(_quote(primary[0]), _quote(name)))
+        low, high = cursor.fetchone()
+        if low is not None:
+            count = min(-(-rows // chunk_rows), high - low + 1)
+            step = -(-(high - low + 1) // count)
+            # First and last ranges are open, rows inserted since the key bounds were read are not missed
+            bounds = [low + index * step for index in range(1, count)]
+            ranges = [(bounds[index - 1] if index else None, bounds[index] if index < len(bounds) else None) for index in range(len(bounds) + 1)]
+    chunks = []
+    for index, bound in enumerate(ranges):
+        conditions = []
+        if bound is not None:
+            if bound[0] is not None:
+                conditions.append("%s >= %d" % (_quote(primary[0]), bound[0]))
+            if bound[1] is not None:
+                conditions.append("%s < %d" % (_quote(primary[0]), bound[1]))
+        chunks.append({"member": "%s.%05d.sql" % (name, index), "where": " AND ".join(conditions)})
+    return {"name": name, "create": create, "indexes": indexes, "columns": columns, "rows": rows, "chunks": chunks}
+
+
+# State of a worker process of the pool
+_worker = {}
+
+
+def _dump_init(conn_args, barrier, started, replaced, folder, codec, level):
+    governor.child_setup()
+    if started.is_set():
+        # Replaces a worker that died, no snapshot is started, its chunks would not be consistent, see above
+        replaced.set()
+        _worker.update(conn=None)
+        return
+    conn = connect(use_unicode=False, **conn_args)
+    cursor = conn.cursor()
+    # Like the import, or the values of the columns not in utf8mb4 would be converted, see above
+    cursor.execute("SET NAMES binary")
+    cursor.execute("SET SESSION sql_mode = ''")
+    cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+    _worker.update(conn=conn, folder=folder, codec=codec, level=level)
+    barrier.wait()
+
+
+def _dump_chunk(task):
+    """Write the INSERT statements of a chunk in a compressed file, return (member, rows, bytes)"""
+    name, columns, chunk = task
+    conn = _worker["conn"]
+    if conn is None:
+        raise ValueError("A worker of the dump died, the consistent snapshot is lost")
+    # QUOTE escapes the values as SQL literals, end of lines are escaped too so a statement is a single line
+    values = ",".join(r"REPLACE(REPLACE(QUOTE({0}), '\n', '\\n'), '\r', '\\r')".format(_quote(column)) for column in columns)
+    query = "SELECT CONCAT('(', CONCAT_WS(',', " + values + "), ')') FROM " + _quote(name)
+    if chunk["where"]:
+        query += " WHERE " + chunk["where"]
+    prefix = ("INSERT INTO " + _quote(name) + " (" + ",".join(_quote(column) for column in columns) + ") VALUES ").encode()
+    path = os.path.join(_worker["folder"], chunk["member"])
+    rows = 0
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    with open(path, "wb") as f:
+        writer = compress.CompressWriter(f, _worker["codec"], _worker["level"], 1)
+        cursor.execute(query)
+        batch = []
+        size = 0
+        for (row,) in cursor:
+            batch.append(row)
+            size += len(row) + 1
+            rows += 1
+            if size >= STATEMENT_SIZE:
+                writer.write(prefix + b",".join(batch) + b";\n")
+                batch = []
+                size = 0
+        if batch:
+            writer.write(prefix + b",".join(batch) + b";\n")
+        writer.close()
+    cursor.close()
+    return chunk["member"], rows, os.path.getsize(path)
+
+
+def _lock(cursor, tables):
+    """Block the writes while the workers start their snapshot"""
+    try:
+        cursor.execute("FLUSH TABLES WITH READ LOCK")
+    except pymysql.err.OperationalError:
+        # No RELOAD privilege, lock the tables of the database only
+        if tables:
+            cursor.execute("LOCK TABLES " + ",".join(_quote(name) + " READ" for name in tables))
+
+
+def _binlog_position(cursor, flush=False):
+    try:
+        if flush:
+            # The binary log replayed by restore-wp.py --until starts with the dump, see binlog.py
+            cursor.execute("FLUSH BINARY LOGS")
+        cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+    except pymysql.err.MySQLError:
+        return None
+    if not row:
+        return None
+    return {"file": row[0], "position": row[1]}
+
+
+def _chunk_codec(codec):
+    # Chunks are compressed by the worker processes, pgzip would start a pool of processes in each
+    if codec == "pgzip":
+        return "gzip"
+    return codec
+
+
+def dump(conn_args, path, jobs=0, chunk_rows=CHUNK_ROWS, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, flush_logs=False):
+    """Dump the database in the tar file path with jobs worker processes
+       - conn_args: dict of the arguments of connect(), host and database
+       - path: dump file to write, see above
+       - jobs: number of worker processes, 0 for the number of cores
+       - chunk_rows: number of rows of the chunks of the big tables
+       - codec, level: compression of the chunks, see compress.get_compressor
+       - flush_logs: True to start a new binary log at the position of the dump, see binlog.py
+       return a dict with the counters of the dump
+    """
+    jobs = jobs or os.cpu_count() or 1
+    database = conn_args["database"]
+    conn = connect(**conn_args)
+    cursor = conn.cursor()
+    cursor.execute("SELECT TABLE_NAME, TABLE_TYPE, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA=%s", (database,))
+    listing = cursor.fetchall()
+    base_tables = [name for name, kind, rows in listing if kind == "BASE TABLE"]
+    folder = tempfile.mkdtemp(prefix=".dump-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        _lock(cursor, base_tables)
+        metadata = {"version": DUMP_VERSION, "database": database, "binlog": _binlog_position(cursor, flush_logs), "tables": [], "views": [], "triggers": []}
+        # Biggest tables first, their chunks keep all the workers busy until the end
+        for name, kind, rows in sorted(listing, key=lambda table: -(table[2] or 0)):
+            if kind == "BASE TABLE":
+                metadata["tables"].append(_table_info(cursor, database, name, rows or 0, chunk_rows))
+            else:
+                cursor.execute("SHOW CREATE VIEW " + _quote(name))
+                metadata["views"].append({"name": name, "create": cursor.fetchone()[1]})
+        cursor.execute("SHOW TRIGGERS")
+        for trigger in [row[0] for row in cursor.fetchall()]:
+            cursor.execute("SHOW CREATE TRIGGER " + _quote(trigger))
+            metadata["triggers"].append(cursor.fetchone()[2])
+        # The workers start their snapshot while the lock is held, see above
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(jobs + 1, timeout=SNAPSHOT_TIMEOUT)
+        started = context.Event()
+        replaced = context.Event()
+        tasks = [(table["name"], table["columns"], chunk) for table in metadata["tables"] for chunk in table["chunks"]]
+        counters = {"tables": len(metadata["tables"]), "chunks": len(tasks), "rows": 0, "bytes": 0}
+        with context.Pool(jobs, _dump_init, (conn_args, barrier, started, replaced, folder, _chunk_codec(codec), level)) as pool:
+            barrier.wait()
+            started.set()
+            cursor.execute("UNLOCK TABLES")
+            results = pool.imap_unordered(_dump_chunk, tasks)
+            while True:
+                # The chunk of a worker that died is never returned, the replacing worker reports it
+                try:
+                    member, rows, size = results.next(timeout=1)
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    if replaced.is_set():
+                        raise ValueError("A worker of the dump died, the consistent snapshot is lost")
+                    continue
+                counters["rows"] += rows
+                counters["bytes"] += size
+        for table in metadata["tables"]:
+            del table["columns"]
+            for chunk in table["chunks"]:
+                del chunk["where"]
+        with open(os.path.join(folder, METADATA), "w") as f:
+            json.dump(metadata, f, indent=1)
+        with tarfile.open(path, "w") as tar:
+            tar.add(os.path.join(folder, METADATA), METADATA)
+            for table in metadata["tables"]:
+                for chunk in table["chunks"]:
+                    tar.add(os.path.join(folder, chunk["member"]), chunk["member"])
+    finally:
+        conn.close()
+        shutil.rmtree(folder, ignore_errors=True)
+    return counters
+
+
+def read_metadata(path):
+    """Return the metadata of the dump file path"""
+    with tarfile.open(path) as tar:
+        metadata = json.load(tar.extractfile(METADATA))
+    if metadata.get("version") != DUMP_VERSION:
+        raise ValueError("Unsupported dump version")
+    return metadata
+
+
+def _load_init(conn_args, path):
+    conn = connect(**conn_args)
+    cursor = conn.cursor()
+    cursor.execute("SET NAMES binary")
+    cursor.execute("SET SESSION sql_mode = 'NO_AUTO_VALUE_ON_ZERO'")
+    cursor.execute("SET SESSION foreign_key_checks = 0")
+    cursor.execute("SET SESSION unique_checks = 0")
+    conn.autocommit(False)
+    _worker.update(conn=conn, tar=tarfile.open(path))
+
+
+def _load_chunk(member):
+    """Execute the INSERT statements of a chunk, return the number of statements"""
+    conn = _worker["conn"]
+    reader = compress.DecompressReader(_worker["tar"].extractfile(member))
+    count = 0
+    pending = b""
+    while True:
+        data = reader.read(compress.READ_SIZE)
+        if not data:
+            break
+        pending += data
+        *statements, pending = pending.split(b"\n")
+        for statement in statements:
+            if statement:
+                conn.query(statement)
+                count += 1
+    if pending:
+        conn.query(pending)
+        count += 1
+    conn.commit()
+    return count
+
+
+def _add_indexes(task):
+    name, indexes = task
+    fulltext = [clause for clause in indexes if clause.startswith("FULLTEXT ")]
+    others = [clause for clause in indexes if not clause.startswith("FULLTEXT ")]
+    statements = [others] if others else []
+    statements += [[clause] for clause in fulltext]
+    for clauses in statements:
+        _worker["conn"].query("ALTER TABLE " + _quote(name) + " " + ", ".join("ADD " + clause for clause in clauses))
+    return name
+
+
+def load_pool(conn_args, path, jobs=0):
+    """Return the pool of worker processes used by load()
+       It can be created in advance, before threads are started, as the workers are forked.
+    """
+    return multiprocessing.get_context("fork").Pool(jobs or os.cpu_count() or 1, _load_init, (conn_args, path))
+
+
+def load(conn_args, path, jobs=0, pool=None):
+    """Import the dump file path in the database with jobs worker processes
+       - conn_args: dict of the arguments of connect(), host and database
+       - path: dump file written by dump()
+       - jobs: number of worker processes, 0 for the number of cores
+       - pool: optional, pool returned by load_pool(), it is closed by load()
+       The tables of the dump are dropped and created again.
+       return a dict with the counters of the import
+    """
+    metadata = read_metadata(path)
+    conn = connect(**conn_args)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION foreign_key_checks = 0")
+        for view in metadata["views"]:
+            cursor.execute("DROP VIEW IF EXISTS " + _quote(view["name"]))
+        for table in metadata["tables"]:
+            cursor.execute("DROP TABLE IF EXISTS " + _quote(table["name"]))
+            cursor.execute(table["create"])
+        chunks = [chunk["member"] for table in metadata["tables"] for chunk in table["chunks"]]
+        counters = {"tables": len(metadata["tables"]), "chunks": len(chunks), "statements": 0}
+        with pool or load_pool(conn_args, path, jobs) as pool:
+            for count in pool.imap_unordered(_load_chunk, chunks):
+                counters["statements"] += count
+            # Indexes are built once the data is loaded, one ALTER TABLE per table and per FULLTEXT index
+            for name in pool.imap_unordered(_add_indexes, [(table["name"], table["indexes"]) for table in metadata["tables"] if table["indexes"]]):
+                pass
+        for view in metadata["views"]:
+            cursor.execute(view["create"])
+        for trigger in metadata["triggers"]:
+            cursor.execute(trigger)
+    finally:
+        conn.close()
+    return counters
@@ -1,34 +1,327 @@
+import os
+import time
+import struct
+import collections
+import concurrent.futures
+import fileio
 from Crypto.Cipher import AES
 from binascii import b2a_hex
 from pathlib import Path
 
-def encrypt_file(path,key):
-    # get the plaintext
-    with open(path,"rb") as f:
-        clear_data = f.read()
+# Chunked container format (version 2) :
+#
+#   header  : MAGIC (7 bytes) | VERSION (1 byte) | segment size (4 bytes)
+#   segment : flag (1 byte) | length (4 bytes) | nonce (12 bytes) | ciphertext | tag (16 bytes)
+#
+# Each segment is encrypted with its own nonce and authenticated with its own tag.
+# The header, the segment index and the final flag are authenticated as associated
+# data, so segments can not be reordered, dropped or truncated without detection.
+#
+# Files written by the previous version (nonce (16) | tag (16) | ciphertext) have
+# no header and are still accepted by decrypt_file and DecryptReader.
+#
+# As the segments are independent, they can be encrypted by a pool of threads (pycryptodome
+# releases the GIL while encrypting), the segments being written in order as they complete.
+#
+# With a single thread, the clear data is gathered in a buffer allocated once and encrypted into another
+# one, and data written in blocks larger than a segment is encrypted where it is, see fileio.py : the
+# data written is only copied once, into the buffer, when it is not aligned on the segments.
 
-    # The key length must be 16 (AES-128), 24 (AES-192), or 32 (AES-256) Bytes.
-    cipher = AES.new(key, AES.MODE_GCM)
-    cipher_data, tag = cipher.encrypt_and_digest(clear_data)
+MAGIC = b"WPBKENC"
+VERSION = 2
+SEGMENT_SIZE = 1024 * 1024
 
-    # output
-    file_out = open(path + ".bin", "wb")
-    [ file_out.write(x) for x in (cipher.nonce, tag, cipher_data) ]
-    file_out.close()
+HEADER = struct.Struct(">7sBI")
+SEGMENT = struct.Struct(">BI")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+FLAG_FINAL = 1
 
 
-def decrypt_file(path,key):
-    # get the plaintext
-    with open(path,"rb") as f:
-        nonce, tag, cipher_data = [ f.read(x) for x in (16, 16, -1) ]
+def _segment_aad(header, index, flag):
+    return header + struct.pack(">QB", index, flag)
+
+
+def _workers(workers):
+    if not workers:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+class EncryptWriter:
+    """File-like object encrypting everything written to it into fileobj
+       - fileobj: binary file object opened for writing
+       - key: AES key, 16, 24 or 32 bytes
+       - segment_size: size of the clear data of each segment
+       - workers: number of threads encrypting the segments, 0 for the number of cores
+       Memory usage is bounded by 2 * workers * segment_size whatever the amount of data written.
+       close() writes the final segment but does not close fileobj.
+    """
+    def __init__(self, fileobj, key, segment_size=SEGMENT_SIZE, workers=1):
+        self.fileobj = fileobj
+        self.key = key
+        self.segment_size = segment_size
+        self.header = HEADER.pack(MAGIC, VERSION, segment_size)
+        self.index = 0
+        self.buffer = memoryview(bytearray(segment_size))
+        self.filled = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self.workers = _workers(workers)
+        self.pool = None
+        self.output = None
+        if self.workers > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        else:
+            self.output = memoryview(bytearray(segment_size))
+        self.pending = collections.deque()
+        self._write(self.header)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def _encrypt(self, data, index, flag, output=None):
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_segment_aad(self.header, index, flag))
+        if output is None:
+            cipher_data = cipher.encrypt(data)
+        else:
+            cipher_data = output[:len(data)]
+            cipher.encrypt(data, output=cipher_data)
+        return SEGMENT.pack(flag, len(cipher_data)) + nonce, cipher_data, cipher.digest()
+
+    def _collect(self, keep):
+        while len(self.pending) > keep:
+            for data in self.pending.popleft().result():
+                self._write(data)
+
+    def _segment(self, data, flag):
+        if self.pool is None:
+            for output in self._encrypt(data, self.index, flag, self.output):
+                self._write(output)
+        else:
+            # The threads get their own copy, data is overwritten by the next writes
+            self.pending.append(self.pool.submit(self._encrypt, bytes(data), self.index, flag))
+            self._collect(2 * self.workers)
+        self.index += 1
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed EncryptWriter")
+        view = memoryview(data).cast("B")
+        size = len(view)
+        position = 0
+        # A full buffer is only encrypted once more data comes, the last segment has the final flag
+        while position < size:
+            if self.filled == self.segment_size:
+                self._segment(self.buffer, 0)
+                self.filled = 0
+            if not self.filled and size - position > self.segment_size:
+                self._segment(view[position:position + self.segment_size], 0)
+                position += self.segment_size
+                continue
+            count = min(self.segment_size - self.filled, size - position)
+            self.buffer[self.filled:self.filled + count] = view[position:position + count]
+            self.filled += count
+            position += count
+        self.bytes_in += size
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        self._segment(self.buffer[:self.filled], FLAG_FINAL)
+        self._collect(0)
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.filled = 0
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
-    # let's assume that the key is somehow available again
-    cipher = AES.new(key, AES.MODE_GCM, nonce)
-    clear_data = cipher.decrypt_and_verify(cipher_data, tag)
+class DecryptReader:
+    """File-like object returning the clear data of the encrypted stream fileobj
+       - fileobj: binary file object opened for reading, positioned at the start of the container
+       - key: AES key used for encryption
+       - header, index: optional, header of the container (see read_header) to start reading at
+         the segment index instead of the start of the container
+       - check_end: False when other data follow the container in fileobj, ie the objects of a pack
+       Chunked containers are read one segment at a time and each segment is verified
+       before any of its data is returned. The segments are decrypted in a buffer allocated once,
+       read() returns a copy of their data and blocks() the buffer itself.
+       Legacy containers (nonce|tag|blob) are decrypted on the fly and only verified
+       when the end of the stream is reached, a ValueError is raised then if the tag is wrong.
+       A ValueError is raised as well when data follow the final segment, unless check_end is False.
+    """
+    def __init__(self, fileobj, key, header=None, index=0, check_end=True):
+        self.fileobj = fileobj
+        self.key = key
+        self.index = index
+        self.check_end = check_end
+        self.buffer = b""
+        self.position = 0
+        self.output = None
+        self.eof = False
+        if header is not None:
+            # fileobj is positioned at the segment index of a chunked container, see segment_offset
+            self.header = header
+            self.segment_size = HEADER.unpack(header)[2]
+            self.legacy = False
+            return
+        start = bytes(self._read_exactly(HEADER.size, allow_short=True))
+        if len(start) == HEADER.size and start[:len(MAGIC)] == MAGIC:
+            magic, version, self.segment_size = HEADER.unpack(start)
+            if version != VERSION:
+                raise ValueError("Unsupported encrypted file version " + str(version))
+            self.header = start
+            self.legacy = False
+        else:
+            # Legacy format : nonce (16) | tag (16) | cipher data
+            start += bytes(self._read_exactly(32 - len(start), allow_short=True))
+            if len(start) < 32:
+                raise ValueError("Encrypted file is truncated")
+            nonce, self.tag = bytes(start[:16]), bytes(start[16:])
+            self.cipher = AES.new(key, AES.MODE_GCM, nonce)
+            self.legacy = True
 
+    def _read_exactly(self, size, allow_short=False):
+        # A file object of fileio.py returns the data in a single memoryview, without copy
+        data = self.fileobj.read(size)
+        if len(data) == size:
+            return data
+        parts = [data]
+        while size:
+            size -= len(parts[-1])
+            if not parts[-1] and size:
+                if allow_short:
+                    break
+                raise ValueError("Encrypted file is truncated")
+            if size:
+                parts.append(self.fileobj.read(size))
+        return b"".join(parts)
+
+    def _next_segment(self):
+        flag, length = SEGMENT.unpack(self._read_exactly(SEGMENT.size))
+        if length > self.segment_size:
+            raise ValueError("Encrypted segment larger than segment size")
+        nonce = bytes(self._read_exactly(NONCE_SIZE))
+        cipher_data = self._read_exactly(length)
+        tag = bytes(self._read_exactly(TAG_SIZE))
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_segment_aad(self.header, self.index, flag))
+        if self.output is None:
+            self.output = memoryview(bytearray(self.segment_size))
+        clear_data = self.output[:length]
+        cipher.decrypt_and_verify(cipher_data, tag, output=clear_data)
+        self.index += 1
+        if flag & FLAG_FINAL:
+            self.eof = True
+            # Appended data is not authenticated, it must not be taken for part of the file
+            if self.check_end and self.fileobj.read(1):
+                raise ValueError("Data after the end of the encrypted file")
+        return clear_data
+
+    def _next_legacy(self):
+        cipher_data = self.fileobj.read(SEGMENT_SIZE)
+        if not cipher_data:
+            self.cipher.verify(self.tag)
+            self.eof = True
+            return b""
+        return self.cipher.decrypt(cipher_data)
+
+    def _fill(self):
+        self.buffer = self._next_legacy() if self.legacy else self._next_segment()
+        self.position = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if self.position == len(self.buffer):
+                if self.eof:
+                    break
+                self._fill()
+                continue
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.position + size)
+            # Copied, the buffer is overwritten by the next segment
+            parts.append(bytes(self.buffer[self.position:end]))
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def blocks(self):
+        """Yield the rest of the clear data segment by segment, without copy
+           Each block is overwritten by the next one, the caller must be done with it or copy it.
+        """
+        while True:
+            if self.position < len(self.buffer):
+                block = self.buffer[self.position:]
+                self.position = len(self.buffer)
+                yield block
+            if self.eof:
+                break
+            self._fill()
+
+    def close(self):
+        pass
+
+
+def read_header(fileobj):
+    """Return the header of a chunked container and its segment size, raise ValueError for other files"""
+    header = fileobj.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a chunked encrypted file")
+    magic, version, segment_size = HEADER.unpack(header)
+    if version != VERSION:
+        raise ValueError("Unsupported encrypted file version " + str(version))
+    return header, segment_size
+
+
+def segment_offset(index, segment_size=SEGMENT_SIZE):
+    """Return the offset in a chunked container of the segment index
+       Segment index holds the clear data from index * segment_size, all the segments but the last one are full.
+    """
+    return HEADER.size + index * (SEGMENT.size + NONCE_SIZE + segment_size + TAG_SIZE)
+
+
+def encrypt_file(path,key,segment_size=SEGMENT_SIZE,workers=0):
+    # The key length must be 16 (AES-128), 24 (AES-192), or 32 (AES-256) Bytes.
+    # Segments are encrypted by workers threads, 0 means one per core
+    # return the statistics of the encryption : bytes, seconds and mb_per_s
+    # The file is read in a single buffer of several segments, see fileio.py
+    start = time.perf_counter()
+    with open(path,"rb",buffering=0) as f, open(path + ".bin", "wb") as file_out:
+        writer = EncryptWriter(file_out, key, segment_size, workers)
+        for clear_data in fileio.read_blocks(f, max(segment_size, fileio.BLOCK_SIZE) * 4):
+            writer.write(clear_data)
+        writer.close()
+    seconds = time.perf_counter() - start
+    return {"bytes": writer.bytes_in, "seconds": seconds, "mb_per_s": writer.bytes_in / seconds / 1e6 if seconds else 0.0}
+
+
+def decrypt_file(path,key):
     # output
     fullpath = Path(path)
     path_dest = fullpath.with_suffix('')
 
-    with open(path_dest, "wb") as file_out:
-        file_out.write(clear_data)
\ No newline at end of file
+    # The encrypted segments are read from a memory map of the file, see fileio.py
+    with fileio.open_mapped(path) as f:
+        reader = DecryptReader(f, key)
+        try:
+            with open(path_dest, "wb") as file_out:
+                for clear_data in reader.blocks():
+                    file_out.write(clear_data)
+        except:
+            # Never leave unauthenticated clear data behind
+            os.remove(path_dest)
+            raise
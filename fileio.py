@@ -0,0 +1,127 @@
+import os
+import io
+import mmap
+import errno
+
+# Local file I/O with as few copies as possible
+#
+# Reading a file with f.read(size) allocates a new bytes object for every block, which each layer
+# (compression, encryption, FTP) then copies again. The helpers below avoid these copies :
+#   - read_blocks reads the blocks with readinto() in a single buffer allocated once, as memoryviews
+#     of it : a block is only valid until the next one is read
+#   - MappedReader maps a file in memory and returns memoryviews of the page cache, without any read
+#     copy ; the packs and the indexed archives are read through it at the offsets of their objects,
+#     and the files uploaded by tools.uploadftp are sent from it
+#   - copy_file copies a local file in the kernel (copy_file_range, which makes a reflink on btrfs and
+#     XFS, else sendfile), the data never enters the process
+# Consumers of these blocks must accept any bytes-like object (memoryview), which zlib, hashlib,
+# pycryptodome, sockets and files do.
+
+BLOCK_SIZE = 1024 * 1024
+# Errors of copy_file_range and sendfile meaning the files can not be copied this way, ie across file systems
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def read_blocks(fileobj, block_size=BLOCK_SIZE):
+    """Yield the content of the binary file object fileobj as memoryviews of a single buffer of block_size bytes
+       Each block is overwritten by the next one, the caller must be done with it or copy it.
+    """
+    view = memoryview(bytearray(block_size))
+    while True:
+        count = fileobj.readinto(view)
+        if not count:
+            break
+        yield view[:count]
+
+
+class MappedReader(io.RawIOBase):
+    """Read-only file object over a memory map of the file open in fileobj
+       read() returns memoryviews of the map, seek() and tell() move in the file like a regular file.
+       The map is released once close() is called and the memoryviews returned are not used anymore.
+    """
+    def __init__(self, fileobj):
+        self.size = os.fstat(fileobj.fileno()).st_size
+        # Empty files can not be mapped
+        self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b"")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        start = min(self.position, self.size)
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        self.position = end
+        return self.view[start:end]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position " + str(offset))
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Blocks returned by read() are still used, the map is released with the last of them
+                pass
+        self.map = None
+
+
+def open_mapped(path):
+    """Return a MappedReader over the file path"""
+    with open(path, "rb") as f:
+        return MappedReader(f)
+
+
+def copy_file(source, dest):
+    """Copy the local file source to dest in the kernel, return the number of bytes copied
+       copy_file_range is tried first, then sendfile, then a copy through a single buffer.
+    """
+    with open(source, "rb") as fin, open(dest, "wb") as fout:
+        size = os.fstat(fin.fileno()).st_size
+        methods = []
+        if hasattr(os, "copy_file_range"):
+            methods.append(lambda count: os.copy_file_range(fin.fileno(), fout.fileno(), count))
+        if hasattr(os, "sendfile"):
+            methods.append(lambda count: os.sendfile(fout.fileno(), fin.fileno(), None, count))
+        for method in methods:
+            copied = 0
+            try:
+                while copied < size:
+                    count = method(min(size - copied, 1 << 30))
+                    if not count:
+                        break
+                    copied += count
+                return copied
+            except OSError as error:
+                # Nothing written yet, the next method starts from the beginning too
+                if copied or error.errno not in COPY_FALLBACK_ERRORS:
+                    raise
+        copied = 0
+        for block in read_blocks(fin):
+            fout.write(block)
+            copied += len(block)
+        return copied
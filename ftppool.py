@@ -0,0 +1,424 @@
+import os
+import ssl
+import time
+import ftplib
+import queue
+import threading
+import concurrent.futures
+import tools
+import governor
+
+# Parallel FTP transfers over a pool of sessions
+#
+# A single TLS data channel is far from the capacity of the link, so files are transferred
+# concurrently over several authenticated sessions which are reused from one transfer to the next.
+# Large files are also split in byte ranges :
+#   - download : every range is read by its own RETR started at its offset with REST
+#   - upload   : every range is stored as its own part file (name.part-00001-of-00004 ...),
+#                the parts are reassembled in the local file when downloaded, by this module
+#                or by tools.downloadftp. Plain FTP offers no way to write at an offset past the
+#                end of a file, so ranges can not be written concurrently into a single remote file.
+# Files transferred in one piece keep a checkpoint (see tools.uploadftp) and every transfer is
+# retried on a new session with an exponential backoff, so an interrupted transfer only sends again
+# what the server did not receive.
+# Several threads may transfer files over the same pool at the same time (see scheduler.py),
+# the number of sessions stays limited by the size of the pool.
+#
+# The sessions come from an FTP backend, see backend() : ftplib, a thread per transfer, or asyncio
+# (see asyncftp.py), every transfer being a task of a single event loop.
+
+PART_SIZE = 64 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+BACKENDS = ("ftplib", "asyncio")
+
+
+def backend(name):
+    """Return the function opening a session and the class of pool of the FTP backend name
+       - name: ftplib or asyncio, see BACKENDS
+       The functions take the arguments of tools.connectftp and the classes the ones of FTPPool.
+    """
+    if name == "ftplib":
+        return tools.connectftp, FTPPool
+    if name == "asyncio":
+        import asyncftp
+        return asyncftp.connect, asyncftp.AsyncFTPPool
+    raise ValueError("Unknown FTP backend " + name)
+
+
+class PooledSession:
+    """An FTP session of the pool with its transfer statistics"""
+    def __init__(self, ftp, number):
+        self.ftp = ftp
+        self.number = number
+        self.bytes = 0
+        self.seconds = 0.0
+        self.transfers = 0
+
+
+class FTPPool:
+    """Pool of FTP sessions
+       - connect: function without argument returning a new 'ftplib.FTP' session, in the right folder
+       - size: maximum number of sessions
+       - first: optional, already open session to use as the first session of the pool,
+         it is not closed by close()
+    """
+    def __init__(self, connect, size, first=None):
+        self.connect = connect
+        self.size = max(1, size)
+        self.idle = queue.Queue()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.first = first
+        if first is not None:
+            self._add(first)
+
+    def _add(self, ftp):
+        session = PooledSession(ftp, len(self.sessions) + 1)
+        self.sessions.append(session)
+        self.idle.put(session)
+
+    def _take(self):
+        """Return an idle session, possibly broken, a new one is added if the pool is not full"""
+        with self.lock:
+            if self.idle.empty() and len(self.sessions) < self.size:
+                # Opened by the caller, outside of the lock
+                self._add(None)
+        return self.idle.get()
+
+    def acquire(self):
+        """Return an idle session, a new one is opened if the pool is not full
+           A broken session is opened again first, it stays in the pool if that fails.
+        """
+        session = self._take()
+        if session.ftp is None:
+            try:
+                session.ftp = self.connect()
+            except BaseException:
+                self.idle.put(session)
+                raise
+        return session
+
+    def release(self, session, broken=False):
+        """Give back a session to the pool, a broken session is closed and opened again by the next acquire()"""
+        try:
+            if broken and session.ftp is not None:
+                session.ftp.close()
+        except Exception:
+            pass
+        finally:
+            if broken:
+                session.ftp = None
+            self.idle.put(session)
+
+    def _transfer(self, tasks):
+        """Run the tasks over the sessions of the pool, return the number of bytes transferred
+           The statistics of the sessions are reset unless other transfers are running.
+        """
+        with self.lock:
+            if not self.active:
+                for session in self.sessions:
+                    session.bytes = 0
+                    session.seconds = 0.0
+                    session.transfers = 0
+            self.active += 1
+        try:
+            return self._execute(tasks)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _execute(self, tasks):
+        with concurrent.futures.ThreadPoolExecutor(self.size) as executor:
+            return sum(future.result() for future in [executor.submit(self._run, *task) for task in tasks])
+
+    def _run(self, func, *args):
+        session = self._take()
+        broken = True
+        try:
+            start = time.perf_counter()
+            attempt = 0
+            while True:
+                try:
+                    # Opening the session again is part of the attempt, it is retried the same way
+                    if session.ftp is None:
+                        session.ftp = self.connect()
+                    transferred = func(session.ftp, *args)
+                    break
+                except ftplib.all_errors:
+                    if attempt >= tools.RETRIES:
+                        raise
+                try:
+                    if session.ftp is not None:
+                        session.ftp.close()
+                except Exception:
+                    pass
+                session.ftp = None
+                time.sleep(tools.RETRY_DELAY * 2 ** attempt)
+                attempt += 1
+            session.seconds += time.perf_counter() - start
+            session.bytes += transferred
+            session.transfers += 1
+            broken = False
+            return transferred
+        finally:
+            self.release(session, broken)
+
+    def _size(self, ficftp):
+        """Return the list of (remote file, offset, size) making the file ficftp"""
+        return self._sizes([ficftp])[0]
+
+    def _sizes(self, files):
+        """Return the lists of (remote file, offset, size) making each one of the files
+           The sizes are asked in a single round-trip, see tools.pipeline, then the ones of the parts
+           of the files uploaded in parts.
+        """
+        session = self.acquire()
+        try:
+            replies = tools.pipeline(session.ftp, ["TYPE I"] + ["SIZE " + ficftp for ficftp in files], check=False)
+            tools.check_reply(replies[0])
+            result = []
+            for ficftp, reply in zip(files, replies[1:]):
+                if reply.startswith("213"):
+                    result.append([(ficftp, 0, int(reply[3:].strip()))])
+                    continue
+                parts = tools.findparts(session.ftp, ficftp)
+                if not parts:
+                    tools.check_reply(reply)
+                    raise ftplib.error_reply(reply)
+                # The listing switched the session to ASCII mode
+                replies = tools.pipeline(session.ftp, ["TYPE I"] + ["SIZE " + part for part in parts])
+                pieces = []
+                offset = 0
+                for part, reply in zip(parts, replies[1:]):
+                    size = int(reply[3:].strip())
+                    pieces.append((part, offset, size))
+                    offset += size
+                result.append(pieces)
+            return result
+        finally:
+            self.release(session)
+
+    def remote_pieces(self, files):
+        """Return the lists of (remote file, offset, size) making each one of the files, None for the missing ones"""
+        try:
+            return self._sizes(files)
+        except ftplib.error_perm:
+            result = []
+            for ficftp in files:
+                try:
+                    result.append(self._size(ficftp))
+                except ftplib.error_perm:
+                    result.append(None)
+            return result
+
+    def remote_size(self, ficftp):
+        """Return the size of the file ficftp, made of parts or not"""
+        return sum(size for remote, offset, size in self._size(ficftp))
+
+    def _remove(self, ftpPath, whole, parts):
+        """Delete the pieces left in the FTP folder ftpPath by a previous upload in the other layout
+           - whole: names of the files uploaded whole, their parts are deleted but not the file itself,
+             an interrupted upload of it is resumed
+           - parts: names of the files uploaded in parts, the file and its parts are deleted
+        """
+        session = self.acquire()
+        broken = False
+        try:
+            try:
+                files = session.ftp.nlst(ftpPath)
+            except (ftplib.error_perm, ftplib.error_temp):
+                # Some servers answer the listing of an empty folder with an error
+                files = []
+            except ssl.SSLError as error:
+                # or close its TLS data connection before the end of the handshake, no name was sent.
+                # The reply of the listing is not read, the session is not used again.
+                if error.reason != "SHUTDOWN_WHILE_IN_INIT":
+                    raise
+                files = []
+                broken = True
+            for file in files:
+                file = file.rsplit("/", 1)[-1]
+                name = tools.partof(file)
+                if name in parts or name in whole and file != name:
+                    session.ftp.delete(ftpPath + "/" + file)
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self.release(session, broken)
+
+    def upload_files(self, files, ftpPath):
+        """Upload the local files to the FTP folder ftpPath concurrently, return the statistics
+           Files larger than 2 * PART_SIZE are uploaded in parts when the pool has several sessions.
+        """
+        start = time.perf_counter()
+        tasks = []
+        whole = set()
+        parts = set()
+        for ficdsk in files:
+            ficftp = ftpPath + "/" + os.path.basename(ficdsk)
+            ranges = upload_ranges(os.path.getsize(ficdsk), self.size)
+            if len(ranges) == 1:
+                whole.add(os.path.basename(ficdsk))
+                tasks.append((_upload_file, ficdsk, ftpPath))
+            else:
+                parts.add(os.path.basename(ficdsk))
+                tasks += [(_upload_range, ficdsk, part) + piece for part, piece in zip(tools.partnames(ficftp, len(ranges)), ranges)]
+        # A file uploaded again, in parts or not, would be read with the pieces of the other layout, see _sizes
+        if tasks:
+            self._remove(ftpPath, whole, parts)
+        transferred = self._transfer(tasks)
+        return self.stats(time.perf_counter() - start, transferred)
+
+    def download_files(self, files, repdsk='.'):
+        """Download the FTP files to the local folder repdsk concurrently, return the statistics"""
+        start = time.perf_counter()
+        tasks = []
+        for ficftp, pieces in zip(files, self._sizes(files) if files else []):
+            ficdsk = os.path.join(repdsk, os.path.basename(ficftp))
+            if len(pieces) == 1 and (self.size == 1 or len(_ranges(pieces[0][2])) == 1):
+                tasks.append((_download_file, ficftp, ficdsk))
+                continue
+            with open(ficdsk, "wb") as f:
+                f.truncate(sum(size for remote, offset, size in pieces))
+            for remote, offset, size in pieces:
+                ranges = _ranges(size) if self.size > 1 else [(0, size)]
+                tasks += [(_download_range, remote, ficdsk, offset, start_range, length, len(ranges) == 1) for start_range, length in ranges]
+        transferred = self._transfer(tasks)
+        return self.stats(time.perf_counter() - start, transferred)
+
+    def download_ranges(self, ficftp, ranges, repdsk='.'):
+        """Download only the byte ranges of the FTP file ficftp concurrently, return the statistics
+           - ranges: list of (offset, length) in the file
+           The local file has the size of the remote file, the bytes outside the ranges are not written.
+        """
+        start = time.perf_counter()
+        ficdsk = os.path.join(repdsk, os.path.basename(ficftp))
+        pieces = self._size(ficftp)
+        with open(ficdsk, "wb") as f:
+            f.truncate(sum(size for remote, offset, size in pieces))
+        tasks = []
+        for remote, base, size in pieces:
+            for offset, length in ranges:
+                first = max(offset, base)
+                last = min(offset + length, base + size)
+                if first < last:
+                    tasks.append((_download_range, remote, ficdsk, base, first - base, last - first, first == base and last == base + size))
+        transferred = self._transfer(tasks)
+        return self.stats(time.perf_counter() - start, transferred)
+
+    def stats(self, seconds, total=None):
+        """Return the aggregate and per-connection statistics of the last transfers
+           - total: bytes transferred, by default the bytes of all the sessions since their reset
+        """
+        if total is None:
+            total = sum(session.bytes for session in self.sessions)
+        return {
+            "bytes": total,
+            "seconds": seconds,
+            "mb_per_s": total / seconds / 1e6 if seconds else 0.0,
+            "connections": [{
+                "connection": session.number,
+                "transfers": session.transfers,
+                "bytes": session.bytes,
+                "mb_per_s": session.bytes / session.seconds / 1e6 if session.seconds else 0.0,
+            } for session in self.sessions],
+        }
+
+    def close(self):
+        """Close the sessions opened by the pool"""
+        for session in self.sessions:
+            if session.ftp is not None and session.ftp is not self.first:
+                try:
+                    session.ftp.quit()
+                except Exception:
+                    session.ftp.close()
+
+
+def _ranges(size):
+    if size < 2 * PART_SIZE:
+        return [(0, size)]
+    return [(offset, min(PART_SIZE, size - offset)) for offset in range(0, size, PART_SIZE)]
+
+
+def upload_ranges(size, connections):
+    """Return the (offset, length) of the parts of a file of size bytes uploaded by a pool of connections
+       sessions, a single range (0, None) when the file is uploaded in one piece
+    """
+    if connections > 1:
+        return _ranges(size)
+    return [(0, None)]
+
+
+def _close_data(conn):
+    if isinstance(conn, ssl.SSLSocket):
+        try:
+            conn.unwrap()
+        except (OSError, ValueError):
+            pass
+    conn.close()
+
+
+def _upload_file(ftp, ficdsk, ftpPath):
+    """Upload the whole file ficdsk to the folder ftpPath, resuming an interrupted upload"""
+    tools.uploadftp(ftp, ficdsk, ftpPath, resume=True, blocksize=BLOCK_SIZE)
+    return os.path.getsize(ficdsk)
+
+
+def _download_file(ftp, ficftp, ficdsk):
+    """Download the whole file ficftp to ficdsk, resuming an interrupted download"""
+    repdsk, name = os.path.split(ficdsk)
+    tools.downloadftp(ftp, ficftp, repdsk, name, resume=True)
+    return os.path.getsize(ficdsk)
+
+
+def _upload_range(ftp, ficdsk, ficftp, offset, length):
+    """Upload length bytes of ficdsk from offset to the file ficftp, the whole file if length is None"""
+    ftp.voidcmd("TYPE I")
+    conn = ftp.transfercmd("STOR " + ficftp)
+    sent = 0
+    view = memoryview(bytearray(BLOCK_SIZE))
+    with open(ficdsk, "rb", buffering=0) as f:
+        f.seek(offset)
+        while length is None or sent < length:
+            count = f.readinto(view if length is None else view[:min(BLOCK_SIZE, length - sent)])
+            if not count:
+                break
+            governor.throttle("upload", count)
+            conn.sendall(view[:count])
+            sent += count
+    _close_data(conn)
+    ftp.voidresp()
+    return sent
+
+
+def _download_range(ftp, ficftp, ficdsk, base, offset, length, whole):
+    """Download length bytes of ficftp from offset, written at base + offset in ficdsk"""
+    ftp.voidcmd("TYPE I")
+    conn = ftp.transfercmd("RETR " + ficftp, offset or None)
+    received = 0
+    view = memoryview(bytearray(BLOCK_SIZE))
+    with open(ficdsk, "r+b") as f:
+        f.seek(base + offset)
+        while received < length:
+            count = conn.recv_into(view, min(BLOCK_SIZE, length - received))
+            if not count:
+                break
+            governor.throttle("download", count)
+            f.write(view[:count])
+            received += count
+    if received < length:
+        _close_data(conn)
+        raise ftplib.error_temp("Transfer of " + ficftp + " interrupted at " + str(offset + received))
+    if whole:
+        _close_data(conn)
+        ftp.voidresp()
+    else:
+        # The rest of the file is not needed, close the data connection before its end
+        conn.close()
+        try:
+            ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm, ftplib.error_reply):
+            pass
+    return received
@@ -0,0 +1,147 @@
+import io
+import json
+import ftplib
+import tools
+import retention
+
+# Rotation of the backup folders on the FTP server
+#
+# The remote snapshots are described by a small state file stored in FTP_PATH, the catalog of the
+# retention (see retention.py). It maps each snapshot to a physical folder of the server, with the
+# tiers keeping it :
+#
+#   {"version": 2, "slots": [{"id": "20261018-020000", "dir": "20261018-020000", "date": "20261018",
+#                             "tiers": ["daily"]}, {"id": "20261011-020000", "dir": "SLOT-1", ...}, ...]}
+#
+# slots[0] is DAYJ, slots[1] is DAYJ-1 and so on, newest first. A rotation only updates the state
+# file : the tiers of every snapshot are computed again, a promotion to the weekly or monthly tier
+# is a change of its entry, and the physical folder of the oldest expired snapshot becomes the folder
+# of the new one, so no folder is renamed and the number of round-trips does not depend on the retention.
+# The reused folder is cleaned with a single MLSD listing, all the deletes being pipelined in a single
+# round-trip (see tools.pipeline), like the removal of the other expired folders. Every file is deleted
+# before the state is saved : a file of the expired backup left in DAYJ, above all date.txt.bin which is
+# uploaded last and marks a complete backup, would make a failed upload look like a complete backup.
+#
+# When no state file exists yet, the folders DAYJ, DAYJ-1 ... created by the previous versions
+# of the script are adopted as they are, and the state of version 1 (flat daily slots) is read as
+# daily snapshots.
+
+STATE_FILE = "rotation.json"
+STATE_VERSION = 2
+
+
+def legacy_dir(index):
+    if index == 0:
+        return "DAYJ"
+    return "DAYJ-" + str(index)
+
+
+def _snapshot(folder, date):
+    return {"id": date + "-000000" if date else folder, "dir": folder, "date": date, "tiers": ["daily"]}
+
+
+def load_state(ftp):
+    """Return the rotation state stored in the current FTP folder, None if there is none"""
+    data = io.BytesIO()
+    try:
+        ftp.retrbinary("RETR " + STATE_FILE, data.write)
+    except ftplib.error_perm:
+        return None
+    try:
+        state = json.loads(data.getvalue().decode())
+    except ValueError:
+        raise ValueError("Corrupt rotation state file " + STATE_FILE + ", it must be repaired or removed from the FTP folder")
+    if state.get("version") == 1:
+        # Flat daily slots, the IDs are made from their dates, or their folders
+        slots = []
+        for slot in state["slots"]:
+            slots.append(_snapshot(slot["dir"], slot["date"]))
+            if any(other["id"] == slots[-1]["id"] for other in slots[:-1]):
+                slots[-1]["id"] = slot["dir"]
+        state = {"version": STATE_VERSION, "slots": slots}
+    if state.get("version") != STATE_VERSION:
+        raise ValueError("Unsupported rotation state version")
+    return state
+
+
+def save_state(ftp, state):
+    """Store the rotation state in the current FTP folder
+       It is uploaded as STATE_FILE.tmp then renamed, an interrupted upload never leaves a truncated state file.
+    """
+    ftp.storbinary("STOR " + STATE_FILE + ".tmp", io.BytesIO(json.dumps(state, indent=1).encode()))
+    try:
+        ftp.rename(STATE_FILE + ".tmp", STATE_FILE)
+    except ftplib.error_perm:
+        # Servers refusing to rename over an existing file
+        ftp.delete(STATE_FILE)
+        ftp.rename(STATE_FILE + ".tmp", STATE_FILE)
+
+
+def listdir(ftp, path=""):
+    """Return a dict name -> type ('dir' or 'file') of the content of path with a single listing
+       MLSD is used when the server supports it, else NLST and every entry is reported as 'file'.
+    """
+    try:
+        return {name: facts.get("type", "file") for name, facts in ftp.mlsd(path, ["type"]) if name not in (".", "..")}
+    except ftplib.error_perm:
+        return {name.rsplit("/", 1)[-1]: "file" for name in ftp.nlst(*([path] if path else []))}
+
+
+def _clean(ftp, path):
+    """Delete the files of path, return the deleted names"""
+    deleted = [name for name, kind in sorted(listdir(ftp, path).items()) if kind not in ("dir", "cdir", "pdir")]
+    tools.pipeline(ftp, ["DELE " + path + "/" + name for name in deleted])
+    return deleted
+
+
+def init(ftp):
+    """Return the rotation state, the one of the folders DAYJ, DAYJ-1 ... if there is no state file yet
+       - ftp: object 'ftplib.FTP' on an open session, the current folder is FTP_PATH
+       The existing content of FTP_PATH is read with a single listing.
+    """
+    state = load_state(ftp)
+    if state is None:
+        existing = listdir(ftp)
+        indexes = sorted(int(match.group(1) or 0) for match in map(retention.LEGACY_DIR.match, existing) if match)
+        state = {"version": STATE_VERSION, "slots": [_snapshot(legacy_dir(index), "") for index in indexes]}
+        save_state(ftp, state)
+    return state
+
+
+def rotate(ftp, state, snapshot_id, date, policy):
+    """Add the snapshot of the new backup as DAYJ, promote and prune the older ones, return the names of the deleted files
+       - ftp: object 'ftplib.FTP' on an open session, the current folder is FTP_PATH
+       - state: rotation state returned by init()
+       - snapshot_id, date: ID and date of the new backup, see retention.new_id
+       - policy: number of snapshots kept by each tier, see retention.plan
+       The physical folder of the oldest expired snapshot becomes DAYJ, a new folder is only created
+       when no snapshot expires.
+    """
+    slots = state["slots"]
+    snapshot = {"id": snapshot_id, "dir": snapshot_id, "date": date, "tiers": ["daily"]}
+    tiers = retention.plan([snapshot] + slots, policy)
+    expired = [slot for slot in slots if not tiers[slot["id"]]]
+    for slot in slots:
+        slot["tiers"] = tiers[slot["id"]]
+    if expired:
+        snapshot["dir"] = expired.pop()["dir"]
+        deleted = _clean(ftp, snapshot["dir"])
+    else:
+        # The folder may be left by a rotation which failed before the state was saved
+        tools.pipeline(ftp, ["MKD " + snapshot["dir"]], check=False)
+        deleted = []
+    for slot in expired:
+        deleted += _clean(ftp, slot["dir"])
+    tools.pipeline(ftp, ["RMD " + slot["dir"] for slot in expired])
+    state["slots"] = [snapshot] + [slot for slot in slots if slot["tiers"]]
+    save_state(ftp, state)
+    return deleted
+
+
+def slot_dir(state, index):
+    """Return the physical folder of DAYJ-index, None if there are fewer snapshots"""
+    if state is None:
+        return legacy_dir(index)
+    if index >= len(state["slots"]):
+        return None
+    return state["slots"][index]["dir"]
@@ -0,0 +1,312 @@
+import os
+import time
+import ctypes
+import shutil
+import asyncio
+import platform
+import threading
+import urllib.request
+
+# Resource governor of the backups run while the site is serving its visitors
+#
+# The bytes uploaded to and downloaded from the FTP server and the bytes of the site read from the
+# local disk go through token buckets, one per kind, shared by all the threads of the process
+# (the sites of a batch backup share the same uplink and disks). A bucket lets through rate bytes
+# per second on average, with bursts of BURST seconds ; a thread taking more tokens than available
+# sleeps until the debt is paid, so large blocks are allowed and the threads share the rate.
+#
+# The rate of each kind follows a schedule by time of day, ie limited during the opening hours of
+# the site and unlimited at night, see Schedule. A monitor thread re-reads the schedules every
+# INTERVAL seconds and backs the rates off when the site suffers : when the load average per core
+# is above LOAD_MAX or when the response time of SITE_URL is above LATENCY_MAX, the rates are halved
+# (down to MIN_FACTOR of their schedule, or of the throughput measured when they are unlimited, or of
+# MIN_RATE when nothing went through yet, as a rate of 0 means no limit), then they grow back by a tenth per interval once the site is fine again.
+#
+# The child processes (mysqldump, the compression, encryption and dump workers) get a lower CPU
+# priority (nice) and I/O priority (ionice), the backup process itself keeps its priority so the
+# rates stay under the control of the buckets.
+
+INTERVAL = 5
+BURST = 1.0
+MIN_FACTOR = 0.1
+MIN_RATE = 1024 ** 2
+KINDS = ("upload", "download", "disk")
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+# Number of the ioprio_set system call by architecture
+IOPRIO_SET = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text):
+    """Return the rate in bytes per second of text, ie 512K or 2M, 0 for no limit"""
+    text = text.strip().upper().rstrip("B")
+    if not text:
+        return 0
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def _minutes(text):
+    hours, minutes = text.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class Schedule:
+    """Rate by time of day
+       - text: windows HH:MM-HH:MM=rate and optionally a rate applying outside the windows, separated
+         by commas, ie "08:00-20:00=2M, 20:00-23:00=10M" or "2M, 00:00-06:00=0". No limit by default.
+       A window may span midnight, ie 22:00-06:00.
+    """
+    def __init__(self, text=""):
+        self.rate = 0
+        self.windows = []
+        for item in text.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            if "=" in item:
+                span, rate = item.split("=", 1)
+                start, end = span.split("-")
+                self.windows.append((_minutes(start), _minutes(end), parse_rate(rate)))
+            else:
+                self.rate = parse_rate(item)
+
+    def rate_at(self, when=None):
+        """Return the rate at the time when, now by default"""
+        tm = time.localtime(when)
+        minute = tm.tm_hour * 60 + tm.tm_min
+        for start, end, rate in self.windows:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.rate
+
+
+class TokenBucket:
+    """Token bucket shared by threads
+       - rate: bytes per second, 0 for no limit
+       - burst: seconds of rate which may be taken at once
+    """
+    def __init__(self, rate=0, burst=BURST):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = rate * burst
+        self.stamp = time.monotonic()
+        self.consumed = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            if rate and not self.rate:
+                self.tokens = rate * self.burst
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.burst)
+
+    def reserve(self, count):
+        """Take count tokens, return the seconds to wait before using them"""
+        with self.lock:
+            self.consumed += count
+            self._refill(time.monotonic())
+            if not self.rate:
+                return 0.0
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += delay
+            return delay
+
+    def consume(self, count):
+        """Take count tokens, waiting for them if needed"""
+        delay = self.reserve(count)
+        if delay:
+            time.sleep(delay)
+
+    def take_consumed(self):
+        """Return the number of tokens taken since the last call"""
+        with self.lock:
+            consumed, self.consumed = self.consumed, 0
+            return consumed
+
+
+class Governor:
+    """Rate limits, adaptive backoff and priority of the child processes, see above
+       - schedules: dict of the Schedule of each kind of KINDS, no limit for the missing ones
+       - nice: niceness added to the child processes, 0 to keep theirs
+       - ionice: I/O scheduling class of the child processes with an optional level, ie idle or best-effort:7
+       - load_max: load average per core above which the rates are backed off, 0 to ignore the load
+       - site_url: optional, page of the site whose response time is measured
+       - latency_max: response time of site_url in seconds above which the rates are backed off
+       - interval: seconds between two measures
+       - min_rate: bytes per second backed off for a kind unlimited and not measured yet
+    """
+    def __init__(self, schedules=None, nice=0, ionice="", load_max=0.0, site_url=None, latency_max=1.0, interval=INTERVAL, min_rate=MIN_RATE):
+        self.schedules = {kind: (schedules or {}).get(kind) or Schedule() for kind in KINDS}
+        if ionice and ionice.partition(":")[0] not in IOPRIO_CLASSES:
+            raise ValueError("Unknown I/O scheduling class " + ionice)
+        self.nice = nice
+        self.ionice = ionice
+        self.load_max = load_max
+        self.site_url = site_url
+        self.latency_max = latency_max
+        self.interval = interval
+        self.min_rate = min_rate
+        self.buckets = {kind: TokenBucket() for kind in KINDS}
+        self.peaks = {kind: 0.0 for kind in KINDS}
+        self.factor = 1.0
+        self.backoffs = 0
+        self.latency = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.update()
+
+    def overloaded(self):
+        """Measure the load and the response time of the site, return True if the backup should slow down"""
+        if self.load_max and os.getloadavg()[0] / (os.cpu_count() or 1) > self.load_max:
+            return True
+        if self.site_url:
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(self.site_url, timeout=2 * self.latency_max) as response:
+                    response.read()
+            except OSError:
+                self.latency = None
+                return True
+            self.latency = time.perf_counter() - start
+            return self.latency > self.latency_max
+        return False
+
+    def update(self, elapsed=0.0):
+        """Set the rates of the buckets from the schedules and the backoff factor
+           - elapsed: seconds since the last update, to measure the throughput of each kind
+        """
+        for kind, bucket in self.buckets.items():
+            if elapsed:
+                # The peak includes the throughput of this interval
+                self.peaks[kind] = max(self.peaks[kind], bucket.take_consumed() / elapsed)
+            rate = self.schedules[kind].rate_at()
+            if self.factor < 1.0:
+                # Never 0, it would mean no limit
+                rate = max(1, int((rate or self.peaks[kind] or self.min_rate) * self.factor))
+            bucket.set_rate(rate)
+
+    def _monitor(self):
+        last = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            if self.load_max or self.site_url:
+                if self.overloaded():
+                    self.factor = max(MIN_FACTOR, self.factor / 2)
+                    self.backoffs += 1
+                else:
+                    self.factor = min(1.0, self.factor + 0.1)
+            now = time.monotonic()
+            self.update(now - last)
+            last = now
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name="governor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        """Return the seconds waited for tokens by kind and the number of backoffs"""
+        stats = {kind: round(bucket.waited, 3) for kind, bucket in self.buckets.items()}
+        stats["backoffs"] = self.backoffs
+        return stats
+
+    def command(self, command):
+        """Return command prefixed by nice and ionice to run with the priority of the child processes"""
+        prefix = []
+        if self.ionice and shutil.which("ionice"):
+            name, _, level = self.ionice.partition(":")
+            prefix += ["ionice", "-c", str(IOPRIO_CLASSES[name])] + (["-n", level] if level else [])
+        if self.nice and shutil.which("nice"):
+            prefix += ["nice", "-n", str(self.nice)]
+        return prefix + list(command)
+
+    def child_setup(self):
+        """Give the current process the priority of the child processes, ie in the initializer of a pool"""
+        if self.nice:
+            os.nice(self.nice)
+        if self.ionice:
+            number = IOPRIO_SET.get(platform.machine())
+            if number is not None:
+                name, _, level = self.ionice.partition(":")
+                # IOPRIO_WHO_PROCESS, current process, class and level
+                ctypes.CDLL(None, use_errno=True).syscall(number, 1, 0, (IOPRIO_CLASSES[name] << 13) | int(level or 0))
+
+
+class Throttled:
+    """File object whose reads or writes take tokens of the bucket kind of the installed governor"""
+    def __init__(self, fileobj, kind):
+        self.fileobj = fileobj
+        self.kind = kind
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        throttle(self.kind, len(data))
+        return data
+
+    def write(self, data):
+        throttle(self.kind, len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+# Governor of the process, None when the backup is not governed
+_governor = None
+
+
+def install(governor):
+    """Make governor the governor of the process and start its monitor"""
+    global _governor
+    _governor = governor
+    governor.start()
+
+
+def uninstall():
+    """Stop the governor of the process, return it"""
+    global _governor
+    governor, _governor = _governor, None
+    if governor is not None:
+        governor.stop()
+    return governor
+
+
+def throttle(kind, count):
+    """Wait for count tokens of the bucket kind, ie before sending count bytes"""
+    governor = _governor
+    if governor is not None:
+        governor.buckets[kind].consume(count)
+
+
+async def athrottle(kind, count):
+    """throttle() for the coroutines of an event loop"""
+    governor = _governor
+    if governor is not None:
+        delay = governor.buckets[kind].reserve(count)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def command(command):
+    """Return command with the priority of the child processes, see Governor.command"""
+    if _governor is None:
+        return list(command)
+    return _governor.command(command)
+
+
+def child_setup():
+    """Initializer of the pools of worker processes, see Governor.child_setup"""
+    if _governor is not None:
+        _governor.child_setup()
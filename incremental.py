@@ -0,0 +1,382 @@
+import os
+import gzip
+import hashlib
+import json
+import stat
+import time
+import tarfile
+import compress
+import encrypt
+import governor
+import fileio
+
+# Incremental backup of the WordPress site folder
+#
+# Instead of a full tar archive, each backup writes a manifest in its DAYJ folder listing every
+# file of WP_PATH with its size, mtime, inode and the sha256 of its content.
+# The content of the files is stored once in content-addressed objects : each object is the
+# compressed and encrypted content of one file, appended to a pack file.
+# Packs live outside the DAYJ folders (LOCALBKPATH/packs and FTP_PATH/packs), a new pack is
+# written by each backup with only the files that are new or changed since the previous one.
+# Unchanged files keep pointing to the object written by an earlier backup, so a manifest
+# always describes a full tree and restoring DAYJ-N only needs its manifest and the packs it references.
+# Packs not referenced anymore by any manifest are deleted after the rotation.
+# The objects of the media files are stored with the fastest setting of the codec, see compress.classify.
+
+MANIFEST = "wordpress.site.manifest.gz"
+MANIFEST_VERSION = 1
+PACK_DIR = "packs"
+PACK_SUFFIX = ".pack"
+READ_SIZE = 1024 * 1024
+
+
+def walk(root):
+    """Yield (path, lstat) for root and everything below it
+       Entries are sorted by path components, the order used in the manifests.
+    """
+    st = os.lstat(root)
+    yield root, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    with os.scandir(root) as it:
+        names = sorted(entry.name for entry in it)
+    for name in names:
+        path = os.path.join(root, name)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield from walk(path)
+        else:
+            yield path, st
+
+
+def _key(path):
+    return path.split("/")
+
+
+def read_manifest(path):
+    """Yield the entries of a manifest, the first line of the file is the header"""
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != MANIFEST_VERSION:
+            raise ValueError("Unsupported manifest version")
+        for line in f:
+            yield json.loads(line)
+
+
+class _Previous:
+    """Lookup of entries of the previous manifest, in the order of walk()"""
+    def __init__(self, path):
+        self.entries = read_manifest(path) if path and os.path.exists(path) else iter(())
+        self.current = next(self.entries, None)
+
+    def find(self, path):
+        key = _key(path)
+        while self.current is not None and _key(self.current["path"]) < key:
+            self.current = next(self.entries, None)
+        if self.current is not None and self.current["path"] == path:
+            return self.current
+        return None
+
+
+def _object_codec(codec):
+    # Objects are compressed one by one, starting a pool of processes for each is not worth it
+    if codec == "pgzip":
+        return "gzip"
+    return codec
+
+
+class PackWriter:
+    """Append compressed and encrypted objects to a pack file
+       - media: True to compress the media like the others, see compress.classify
+       The pack file is only created when the first object is added.
+       classes gives the objects compressed (the discarded ones too), bytes_in, bytes_out and seconds
+       of compression of each class.
+    """
+    def __init__(self, path, key, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, media=False):
+        self.path = path
+        self.key = key
+        self.codec = _object_codec(codec)
+        self.level = level
+        self.media = media
+        self.file = None
+        self.bytes_in = 0
+        self.classes = {name: {"objects": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0} for name in compress.CLASSES}
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, "wb")
+        return self.file.tell()
+
+    def _compressor(self, kind):
+        if kind == "media" and not self.media:
+            return compress.get_compressor(self.codec, compress.RAW_LEVELS[self.codec])
+        return compress.get_compressor(self.codec, self.level)
+
+    def _count(self, kind, bytes_in, length, seconds):
+        stats = self.classes[kind]
+        stats["objects"] += 1
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += length
+        stats["seconds"] += seconds
+
+    def add(self, filepath):
+        """Add the content of filepath as a new object, return (sha256, offset, length)"""
+        offset = self._open()
+        writer = encrypt.EncryptWriter(self.file, self.key)
+        digest = hashlib.sha256()
+        compressor = None
+        size = 0
+        seconds = 0.0
+        with open(filepath, "rb") as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if compressor is None:
+                    kind = compress.classify(filepath, os.fstat(f.fileno()).st_size, data)
+                    compressor = self._compressor(kind)
+                if not data:
+                    break
+                governor.throttle("disk", len(data))
+                digest.update(data)
+                size += len(data)
+                start = time.perf_counter()
+                output = compressor.compress(data)
+                seconds += time.perf_counter() - start
+                writer.write(output)
+        writer.write(compressor.flush())
+        writer.close()
+        self.bytes_in += size
+        self._count(kind, size, self.file.tell() - offset, seconds)
+        return digest.hexdigest(), offset, self.file.tell() - offset
+
+    def add_data(self, data):
+        """Add data as a new object, return (offset, length)"""
+        offset = self._open()
+        writer = encrypt.EncryptWriter(self.file, self.key)
+        kind = "media" if compress.is_media(data[:compress.SAMPLE_SIZE]) else "text"
+        compressor = self._compressor(kind)
+        self.bytes_in += len(data)
+        start = time.perf_counter()
+        output = compressor.compress(data) + compressor.flush()
+        seconds = time.perf_counter() - start
+        writer.write(output)
+        writer.close()
+        self._count(kind, len(data), self.file.tell() - offset, seconds)
+        return offset, self.file.tell() - offset
+
+    def discard(self, offset):
+        """Remove the objects written from offset, used when the object already exists"""
+        self.file.seek(offset)
+        self.file.truncate()
+
+    def close(self):
+        """Close the pack file, return True if at least one object has been written"""
+        if self.file is None:
+            return False
+        size = self.file.tell()
+        self.file.close()
+        if size == 0:
+            os.remove(self.path)
+            return False
+        return True
+
+
+def new_pack_id():
+    return time.strftime('%Y%m%d%H%M%S')
+
+
+def backup_site(wp_path, manifest_path, previous_manifest, pack_path, key, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, entries=None, media=False):
+    """Write the manifest of wp_path and store new or changed files in a new pack
+       - wp_path: folder to backup
+       - manifest_path: manifest to write
+       - previous_manifest: manifest of the previous backup, None for the first backup
+       - pack_path: pack file receiving the new objects, its name without suffix is the pack id
+       - key: AES key used for encryption of the objects
+       - codec, level: compression of the objects, see compress.get_compressor
+       - entries: (path, lstat) of wp_path in the order of walk(), ie scanner.Scanner.entries(), walk(wp_path) by default
+       - media: True to compress the media files like the others, see PackWriter
+       return a dict with the counters of the backup, "pack" is False if no object has been written,
+       "classes" the stats of the objects of each class
+    """
+    pack_id = os.path.basename(pack_path)[:-len(PACK_SUFFIX)]
+    pack = PackWriter(pack_path, key, codec, level, media)
+    previous = _Previous(previous_manifest)
+    written = {}
+    counters = {"files": 0, "changed": 0, "bytes_stored": 0}
+    tmp_path = manifest_path + ".tmp"
+    with gzip.open(tmp_path, "wt") as out:
+        out.write(json.dumps({"version": MANIFEST_VERSION, "date": time.strftime('%Y%m%d'), "pack": pack_id}) + "\n")
+        if entries is None:
+            entries = walk(wp_path)
+        for path, st in entries:
+            name = path.lstrip("/")
+            entry = {"path": name, "mode": stat.S_IMODE(st.st_mode), "uid": st.st_uid, "gid": st.st_gid, "mtime": st.st_mtime_ns}
+            if stat.S_ISDIR(st.st_mode):
+                entry["type"] = "d"
+            elif stat.S_ISLNK(st.st_mode):
+                entry["type"] = "l"
+                entry["link"] = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                entry["type"] = "f"
+                entry["size"] = st.st_size
+                entry["inode"] = st.st_ino
+                counters["files"] += 1
+                old = previous.find(name)
+                if old is not None and old.get("type") == "f" and (old["size"], old["mtime"], old["inode"]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    # Unchanged file, keep the object of the previous backup
+                    location = (old["hash"], old["pack"], old["offset"], old["length"])
+                else:
+                    digest, offset, length = pack.add(path)
+                    if old is not None and old.get("hash") == digest:
+                        # Metadata changed but content did not
+                        pack.discard(offset)
+                        location = (digest, old["pack"], old["offset"], old["length"])
+                    elif digest in written:
+                        # Same content already stored by this backup
+                        pack.discard(offset)
+                        location = written[digest]
+                    else:
+                        location = (digest, pack_id, offset, length)
+                        written[digest] = location
+                        counters["changed"] += 1
+                        counters["bytes_stored"] += length
+                entry["hash"], entry["pack"], entry["offset"], entry["length"] = location
+            else:
+                # Sockets, fifos and devices are not backed up
+                continue
+            out.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, manifest_path)
+    counters["pack"] = pack.close()
+    counters["classes"] = pack.classes
+    return counters
+
+
+def selected(name, paths):
+    """Return True if name is one of paths or below one of them, paths None selects everything"""
+    if paths is None:
+        return True
+    return any(name == path or name.startswith(path + "/") for path in paths)
+
+
+def extract_selected(open_stream, dest, paths, bufsize=compress.READ_SIZE):
+    """Extract the members of a tar stream selected by paths, see selected(), in the folder dest
+       - open_stream: function without argument returning a context manager giving the tar stream
+       A selected hard link whose target is not selected is extracted as a copy of its target, read by
+       a second pass over the stream since the target is before the link and a stream is not read backwards.
+    """
+    links = {}
+    def members(tar):
+        for member in tar:
+            if not selected(member.name, paths):
+                continue
+            if member.islnk() and not selected(member.linkname, paths):
+                links.setdefault(member.linkname, []).append(member.name)
+                continue
+            yield member
+    with open_stream() as fileobj:
+        tar = tarfile.open(fileobj=fileobj, mode="r|", bufsize=bufsize)
+        tar.extractall(dest, members=members(tar))
+        tar.close()
+    if not links:
+        return
+    with open_stream() as fileobj:
+        tar = tarfile.open(fileobj=fileobj, mode="r|", bufsize=bufsize)
+        for member in tar:
+            if member.name in links:
+                first, *others = links.pop(member.name)
+                member.name = first
+                tar.extract(member, dest)
+                # The other links of the target stay links of its copy
+                for name in others:
+                    os.link(os.path.join(dest, first), os.path.join(dest, name))
+                if not links:
+                    break
+        tar.close()
+
+
+def referenced_packs(manifest_paths, paths=None):
+    """Return the set of pack ids referenced by the existing manifests of manifest_paths
+       - paths: optional, only the files of the manifests selected by these paths, see selected()
+    """
+    packs = set()
+    for path in manifest_paths:
+        if not os.path.exists(path):
+            continue
+        for entry in read_manifest(path):
+            if entry["type"] == "f" and selected(entry["path"], paths):
+                packs.add(entry["pack"])
+    return packs
+
+
+def prune_packs(pack_dir, keep):
+    """Delete the local packs of pack_dir whose id is not in keep, return the deleted file names"""
+    deleted = []
+    for name in sorted(os.listdir(pack_dir)):
+        if name.endswith(PACK_SUFFIX) and name[:-len(PACK_SUFFIX)] not in keep:
+            os.remove(os.path.join(pack_dir, name))
+            deleted.append(name)
+    return deleted
+
+
+def restore_site(manifest_path, pack_dir, key, dest="/", paths=None):
+    """Rebuild the full tree described by a manifest
+       - manifest_path: clear manifest of the backup to restore
+       - pack_dir: local folder containing all the packs referenced by the manifest
+       - key: AES key used for encryption of the objects
+       - dest: folder where the tree is restored, paths of the manifest are relative to it
+       - paths: optional, only restore these paths of the manifest and everything below them
+    """
+    packs = {}
+    directories = []
+    try:
+        for entry in read_manifest(manifest_path):
+            if not selected(entry["path"], paths):
+                continue
+            path = os.path.join(dest, entry["path"])
+            if entry["type"] == "d":
+                os.makedirs(path, exist_ok=True)
+                directories.append(entry)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+            if entry["type"] == "l":
+                os.symlink(entry["link"], path)
+                _set_owner(path, entry)
+                continue
+            if entry["pack"] not in packs:
+                # The objects are decrypted from a memory map of the pack, see fileio.py
+                packs[entry["pack"]] = fileio.open_mapped(os.path.join(pack_dir, entry["pack"] + PACK_SUFFIX))
+            pack = packs[entry["pack"]]
+            pack.seek(entry["offset"])
+            reader = compress.DecompressReader(encrypt.DecryptReader(pack, key, check_end=False))
+            digest = hashlib.sha256()
+            with open(path, "wb") as f:
+                while True:
+                    data = reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    f.write(data)
+            if digest.hexdigest() != entry["hash"]:
+                raise ValueError("Content of " + path + " does not match the manifest")
+            _set_metadata(path, entry)
+    finally:
+        for pack in packs.values():
+            pack.close()
+    # Directories last, restoring files changes their mtime
+    for entry in reversed(directories):
+        _set_metadata(os.path.join(dest, entry["path"]), entry)
+
+
+def _set_owner(path, entry):
+    if os.geteuid() == 0:
+        os.lchown(path, entry["uid"], entry["gid"])
+
+
+def _set_metadata(path, entry):
+    _set_owner(path, entry)
+    os.chmod(path, entry["mode"])
+    os.utime(path, ns=(entry["mtime"], entry["mtime"]))
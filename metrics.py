@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import threading
+import resource
+import contextlib
+import tools
+
+# Instrumentation of the backup and restore runs
+#
+# A Run is split in stages (dump, scan, archive, encrypt, upload ...) measured by Run.stage(),
+# a context manager giving the Stage being measured :
+#   - wall time and CPU time, the CPU time of the process (all its threads) and of its children
+#     once they have exited (mysqldump, pgzip and parallel dump workers), see getrusage
+#   - bytes in and bytes out, given by the caller, from which the throughput (MB/s) and the
+#     compression ratio (bytes in / bytes out) are derived
+#   - FTP commands sent during the stage, see tools.ftp_commands (pipelined commands share their round-trip)
+# A stage entered several times (ie once per file encrypted) adds up.
+# Stages may run concurrently (see scheduler.py) : their wall times then overlap and add up to more
+# than the wall time of the run, and the CPU time of a stage includes the one of the stages running with it.
+# The peak RSS of the process and of its largest child is recorded for the run.
+#
+# Once the run is done, the report is written as JSON next to date.txt (backup-report.json), optionally
+# as a Prometheus textfile for the textfile collector of node_exporter, and summary() gives the table
+# added to the completion email.
+
+REPORT_SUFFIX = "-report.json"
+TEXTFILE_SUFFIX = ".prom"
+METRIC_PREFIX = "backup_wp_"
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    """Return the peak resident set size in bytes of the process or of its largest child"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux
+    return max(own, children) * 1024
+
+
+class Stage:
+    """Measures of a stage of a run
+       - name: name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ftp_commands = 0
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def add(self, bytes_in=0, bytes_out=0):
+        """Count bytes read and written by the stage"""
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def mb_per_s(self):
+        """Throughput of the stage, of its input or of its output when the input is not known"""
+        size = self.bytes_in or self.bytes_out
+        return size / self.seconds / 1e6 if self.seconds else 0.0
+
+    def ratio(self):
+        """Compression ratio of the stage, None if it has no input or no output"""
+        if self.bytes_in and self.bytes_out:
+            return self.bytes_in / self.bytes_out
+        return None
+
+    def report(self):
+        return {
+            "name": self.name,
+            "seconds": round(self.seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "mb_per_s": round(self.mb_per_s(), 2),
+            "ratio": round(self.ratio(), 3) if self.ratio() else None,
+            "ftp_commands": self.ftp_commands,
+            "failed": self.failed,
+        }
+
+
+class Run:
+    """Stages of a backup or restore run
+       - name: name of the run, backup or restore
+       - info: values added as is to the report, ie the backup mode or the codec
+    """
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.start_cpu = _cpu_seconds()
+        self.start_commands = tools.ftp_commands()
+        self.seconds = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the block as the stage name, yield the Stage to count its bytes"""
+        with self.lock:
+            stage = self.stages.setdefault(name, Stage(name))
+        start = time.perf_counter()
+        start_cpu = _cpu_seconds()
+        start_commands = tools.ftp_commands()
+        try:
+            yield stage
+        except BaseException:
+            stage.failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = _cpu_seconds() - start_cpu
+            ftp_commands = tools.ftp_commands() - start_commands
+            with self.lock:
+                stage.seconds += seconds
+                stage.cpu_seconds += cpu_seconds
+                stage.ftp_commands += ftp_commands
+
+    def finish(self):
+        """End of the run, the stages measured after it are not in the totals"""
+        self.seconds = time.perf_counter() - self.start
+        self.cpu_seconds = _cpu_seconds() - self.start_cpu
+        self.ftp_commands = tools.ftp_commands() - self.start_commands
+        self.peak_rss = peak_rss()
+
+    def report(self):
+        """Return the report of the run as a dict, see write_json"""
+        if self.seconds is None:
+            self.finish()
+        return dict(self.info,
+            run=self.name,
+            started=time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            seconds=round(self.seconds, 3),
+            cpu_seconds=round(self.cpu_seconds, 3),
+            peak_rss_bytes=self.peak_rss,
+            ftp_commands=self.ftp_commands,
+            stages=[stage.report() for stage in self.stages.values()])
+
+    def write_json(self, folder):
+        """Write the report in folder/<name>-report.json, return its path"""
+        path = os.path.join(folder, self.name + REPORT_SUFFIX)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def write_textfile(self, folder):
+        """Write the metrics in folder/backup_wp_<name>.prom for the textfile collector of node_exporter
+           The runs of a batch backup (with a site in their info) are written in backup_wp_<name>_<site>.prom,
+           with the label site. The file is replaced atomically, as the collector may read it at any time.
+           return its path
+        """
+        report = self.report()
+        labels = 'run="%s"' % self.name
+        filename = METRIC_PREFIX + self.name
+        if self.info.get("site"):
+            labels += ',site="%s"' % self.info["site"]
+            filename += "_" + self.info["site"]
+        lines = []
+        def metric(name, help, samples):
+            lines.append("# HELP %s%s %s" % (METRIC_PREFIX, name, help))
+            lines.append("# TYPE %s%s gauge" % (METRIC_PREFIX, name))
+            for sample_labels, value in samples:
+                lines.append("%s%s{%s} %s" % (METRIC_PREFIX, name, sample_labels, repr(float(value))))
+        metric("last_success_timestamp_seconds", "End of the last successful run", [(labels, self.started + self.seconds)])
+        metric("duration_seconds", "Wall time of the last run", [(labels, report["seconds"])])
+        metric("cpu_seconds", "CPU time of the last run", [(labels, report["cpu_seconds"])])
+        metric("peak_rss_bytes", "Peak resident set size of the last run", [(labels, report["peak_rss_bytes"])])
+        metric("ftp_commands", "FTP commands sent by the last run", [(labels, report["ftp_commands"])])
+        stages = [(labels + ',stage="%s"' % stage["name"], stage) for stage in report["stages"]]
+        metric("stage_seconds", "Wall time of the stages of the last run", [(name, stage["seconds"]) for name, stage in stages])
+        metric("stage_cpu_seconds", "CPU time of the stages of the last run", [(name, stage["cpu_seconds"]) for name, stage in stages])
+        metric("stage_bytes_in", "Bytes read by the stages of the last run", [(name, stage["bytes_in"]) for name, stage in stages])
+        metric("stage_bytes_out", "Bytes written by the stages of the last run", [(name, stage["bytes_out"]) for name, stage in stages])
+        metric("stage_ftp_commands", "FTP commands sent by the stages of the last run", [(name, stage["ftp_commands"]) for name, stage in stages])
+        metric("stage_compression_ratio", "Compression ratio of the stages of the last run", [(name, stage["ratio"]) for name, stage in stages if stage["ratio"]])
+        path = os.path.join(folder, filename + TEXTFILE_SUFFIX)
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def summary(self):
+        """Return the table of the stages as text, for the completion email"""
+        report = self.report()
+        lines = ["%-12s %9s %9s %10s %10s %8s %6s %6s" % ("stage", "wall s", "cpu s", "in MB", "out MB", "MB/s", "ratio", "ftp")]
+        for stage in report["stages"]:
+            lines.append("%-12s %9.2f %9.2f %10.1f %10.1f %8.1f %6s %6d" % (
+                stage["name"], stage["seconds"], stage["cpu_seconds"], stage["bytes_in"] / 1e6, stage["bytes_out"] / 1e6,
+                stage["mb_per_s"], "%.2f" % stage["ratio"] if stage["ratio"] else "-", stage["ftp_commands"]))
+        lines.append("%-12s %9.2f %9.2f %39s %6d" % ("total", report["seconds"], report["cpu_seconds"], "", report["ftp_commands"]))
+        lines.append("peak RSS %.1f MB" % (report["peak_rss_bytes"] / 1e6))
+        return "\n".join(lines)
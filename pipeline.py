@@ -0,0 +1,438 @@
+import os
+import ftplib
+import queue
+import subprocess
+import tarfile
+import threading
+import archive
+import compress
+import encrypt
+import tools
+import governor
+
+# Streaming backup pipeline :
+#
+#   tar WP_PATH -> compress -> encrypt -> [tee to local file] -> ftp.storbinary
+#
+# Each stage runs in its own thread and the stages are connected by bounded queues,
+# so the whole archive never hits the local disk (unless a local copy is asked for)
+# and the memory used is bounded by QUEUE_DEPTH * BLOCK_SIZE per queue.
+#
+# The restore runs the same stages the other way round :
+#
+#   ftp.retrbinary (or local file) -> decrypt -> decompress -> tar extract | mysql stdin
+#
+# Nothing is written to the local disk before extraction, and the SQL import and the site
+# extraction are added to the same Pipeline so they run concurrently.
+
+BLOCK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 8
+# Put in a pipe by the tar stage before the media files, the compress stage stores what follows, see compress.classify
+RAW = "raw"
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipe:
+    """Bounded queue of data blocks between two stages of a pipeline
+       - abort: threading.Event shared by all the stages, set when one stage fails
+       - depth: maximum number of blocks waiting in the queue
+       bytes counts the data put in the pipe, a pipe has a single writer.
+    """
+    def __init__(self, abort, depth=QUEUE_DEPTH):
+        self.queue = queue.Queue(depth)
+        self.abort = abort
+        self.bytes = 0
+
+    def put(self, block):
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                self.queue.put(block, timeout=0.5)
+                if block is not None and block is not RAW:
+                    self.bytes += len(block)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                return self.queue.get(timeout=0.5)
+            except queue.Empty:
+                pass
+
+
+class PipeWriter:
+    """File-like object writing into a Pipe, close() signals the end of the stream"""
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def write(self, data):
+        if data:
+            self.pipe.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.pipe.put(None)
+
+
+class PipeReader:
+    """File-like object reading from a Pipe until the writer closes it
+       A block read whole is returned as it is, else the data read is copied once.
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.buffer = b""
+        self.position = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if self.position == len(self.buffer):
+                if self.eof:
+                    break
+                block = self.pipe.get()
+                if block is None:
+                    self.eof = True
+                else:
+                    self.buffer = block
+                    self.position = 0
+                continue
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.position + size)
+            parts.append(self.buffer[self.position:end] if self.position or end < len(self.buffer) else self.buffer)
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def close(self):
+        pass
+
+
+class TeeWriter:
+    """File-like object writing the same data to several file objects"""
+    def __init__(self, *fileobjs):
+        self.fileobjs = fileobjs
+
+    def write(self, data):
+        for f in self.fileobjs:
+            f.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class Pipeline:
+    """Run the stages of a pipeline in threads and wait for all of them
+       If one stage raises, the other stages are aborted and the first error is raised by wait().
+    """
+    def __init__(self):
+        self.abort = threading.Event()
+        self.threads = []
+        self.errors = []
+
+    def pipe(self):
+        return Pipe(self.abort)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as exc:
+            self.errors.append(exc)
+            self.abort.set()
+
+    def add(self, func, *args):
+        thread = threading.Thread(target=self._run, args=(func, args), daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def tar_stage(path, out, index=None, files=None, raw=False):
+    """Write a tar stream of path into the pipe out
+       - index: optional, archive.IndexWriter recording the members of the stream
+       - files: optional with index, dict receiving the number of files of each class
+       - raw: with index, True to write the media files at the end of the stream after RAW, see archive.write_tar
+    """
+    writer = PipeWriter(out)
+    if index is None:
+        # The files read from the disk are limited by the governor of the process, see governor.py
+        tar = tarfile.open(fileobj=governor.Throttled(writer, "disk"), mode="w|", bufsize=BLOCK_SIZE)
+        tar.add(path)
+        tar.close()
+    else:
+        counts = archive.write_tar(path, writer, index, (lambda: out.put(RAW)) if raw else None)
+        if files is not None:
+            files.update(counts)
+    writer.close()
+
+
+def compress_stage(inp, out, compressor):
+    """Compress the stream of pipe inp into the pipe out
+       - compressor: object returned by compress.get_compressor
+    """
+    while True:
+        block = inp.get()
+        if block is None:
+            break
+        if block is RAW:
+            data = compressor.raw()
+        else:
+            data = compressor.compress(block)
+        if data:
+            out.put(data)
+    out.put(compressor.flush())
+    out.put(None)
+
+
+def encrypt_stage(inp, out, key, tee_path=None):
+    """Encrypt the stream of pipe inp into the pipe out
+       - tee_path: optional, local file receiving a copy of the encrypted stream
+    """
+    writer = PipeWriter(out)
+    tee = None
+    if tee_path:
+        tee = open(tee_path, "wb")
+        writer = TeeWriter(writer, tee)
+    try:
+        encryptor = encrypt.EncryptWriter(writer, key)
+        while True:
+            block = inp.get()
+            if block is None:
+                break
+            encryptor.write(block)
+        encryptor.close()
+    finally:
+        if tee:
+            tee.close()
+    out.put(None)
+
+
+def stream_command(command, path, key, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, workers=0):
+    """Run command and store its standard output compressed and encrypted in path, in a single pass
+       - command: list of the program and its arguments, ie mysqldump, run with the priority of the
+         child processes of the governor of the process, see governor.py
+       - path: local file written, the same as compress + encrypt.encrypt_file would produce
+       - key: AES key used for encryption
+       - codec, level, workers: compression parameters, see compress.get_compressor
+       The command is blocked on its output while the queues are full.
+       Raise subprocess.CalledProcessError if the command fails, path is removed then.
+       return a dict with the size of the output of the command (bytes_in) and of path (bytes_out)
+    """
+    compressor = compress.get_compressor(codec, level, workers)
+    process = subprocess.Popen(governor.command(command), stdout=subprocess.PIPE)
+    pipeline = Pipeline()
+    output = pipeline.pipe()
+    compressed = pipeline.pipe()
+    encrypted = pipeline.pipe()
+    pipeline.add(file_stage, process.stdout, output)
+    pipeline.add(compress_stage, output, compressed, compressor)
+    pipeline.add(encrypt_stage, compressed, encrypted, key)
+    pipeline.add(write_stage, encrypted, path)
+    try:
+        pipeline.wait()
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        process.stdout.close()
+    if process.wait() != 0:
+        os.remove(path)
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return {"bytes_in": output.bytes, "bytes_out": encrypted.bytes}
+
+
+def stream_archive(ftp, path, ficftp, key, codec=compress.DEFAULT_CODEC, level=compress.DEFAULT_LEVEL, workers=0, tee_path=None, blocksize=BLOCK_SIZE, index_path=None, checksum=None, media=False):
+    """Archive path and upload it to the FTP server in a single pass
+       - ftp: object 'ftplib.FTP' on an open session
+       - path: local folder to archive
+       - ficftp: FTP path of the encrypted archive
+       - key: AES key used for encryption
+       - codec, level, workers: compression parameters, see compress.get_compressor
+       - tee_path: optional, local file where a copy of the encrypted archive is stored, it is written
+         as tee_path.tmp and only renamed once the archive is uploaded
+       - index_path: optional, local file where the index of the archive is written, see archive.py
+       - checksum: optional, verify.Checksum of the encrypted archive, updated while it is uploaded
+       - media: with index_path, True to compress the media files like the others, see archive.write_archive
+       The resulting file is the same as tar + compress + encrypt.encrypt_file would produce.
+       On failure the local copy is removed, the partial remote file is left to the caller : the session
+       may be in the middle of the transfer.
+       return a dict with the size of the tar stream (bytes_in) and of the encrypted archive (bytes_out),
+       and the stats of each class with index_path (classes)
+    """
+    # Created before the threads are started, pgzip forks its worker processes here
+    index = None
+    files = {}
+    if index_path:
+        compressor = compress.ClassCompressor(compress.get_block_compressor(codec, level, workers, archive.BLOCK_SIZE))
+        index = archive.IndexWriter(index_path)
+    else:
+        compressor = compress.get_compressor(codec, level, workers)
+    pipeline = Pipeline()
+    tarred = pipeline.pipe()
+    compressed = pipeline.pipe()
+    encrypted = pipeline.pipe()
+    pipeline.add(tar_stage, path, tarred, index, files, not media)
+    pipeline.add(compress_stage, tarred, compressed, compressor)
+    pipeline.add(encrypt_stage, compressed, encrypted, key, tee_path and tee_path + ".tmp")
+    upload = PipeReader(encrypted)
+    if checksum is not None:
+        upload = checksum.reader(upload)
+    pipeline.add(ftp.storbinary, "STOR " + ficftp, upload, blocksize)
+    try:
+        pipeline.wait()
+    except BaseException:
+        if index is not None:
+            index.discard()
+        if tee_path and os.path.exists(tee_path + ".tmp"):
+            os.remove(tee_path + ".tmp")
+        raise
+    if tee_path:
+        os.replace(tee_path + ".tmp", tee_path)
+    stats = {"bytes_in": tarred.bytes, "bytes_out": encrypted.bytes}
+    if index is not None:
+        index.close(compressor.blocks)
+        stats["classes"] = archive.class_stats(files, compressor)
+    return stats
+
+
+def download_stage(ftp, ficftp, out, blocksize=BLOCK_SIZE):
+    """Write the content of the FTP file ficftp into the pipe out
+       Files uploaded in parts by ftppool are read part after part.
+    """
+    writer = PipeWriter(out)
+    ftp.voidcmd("TYPE I")
+    try:
+        ftp.size(ficftp)
+        names = [ficftp]
+    except ftplib.error_perm:
+        names = tools.findparts(ftp, ficftp)
+        if not names:
+            raise
+    for name in names:
+        ftp.retrbinary("RETR " + name, writer.write, blocksize)
+    writer.close()
+
+
+def file_stage(fileobj, out):
+    """Write the content of the binary file object fileobj into the pipe out"""
+    writer = PipeWriter(out)
+    while True:
+        data = fileobj.read(BLOCK_SIZE)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def read_stage(path, out):
+    """Write the content of the local file path into the pipe out"""
+    with open(path, "rb") as f:
+        file_stage(f, out)
+
+
+def write_stage(inp, path):
+    """Write the stream of pipe inp in the local file path"""
+    with open(path, "wb") as f:
+        while True:
+            block = inp.get()
+            if block is None:
+                break
+            f.write(block)
+
+
+def decrypt_stage(inp, out, key):
+    """Decrypt the stream of pipe inp into the pipe out"""
+    reader = encrypt.DecryptReader(PipeReader(inp), key)
+    writer = PipeWriter(out)
+    while True:
+        data = reader.read(BLOCK_SIZE)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def decompress_stage(inp, out):
+    """Decompress the stream of pipe inp into the pipe out, the codec is detected automatically"""
+    reader = compress.DecompressReader(PipeReader(inp))
+    writer = PipeWriter(out)
+    while True:
+        data = reader.read(BLOCK_SIZE)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def extract_stage(inp, dest):
+    """Extract the tar stream of pipe inp in the folder dest"""
+    tar = tarfile.open(fileobj=PipeReader(inp), mode="r|", bufsize=BLOCK_SIZE)
+    tar.extractall(dest)
+    tar.close()
+
+
+def command_stage(inp, command):
+    """Feed the stream of pipe inp to the standard input of command
+       Raise subprocess.CalledProcessError if the command fails.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        while True:
+            block = inp.get()
+            if block is None:
+                break
+            process.stdin.write(block)
+        process.stdin.close()
+    except BrokenPipeError:
+        # The command exited before reading all its input, its exit status tells why
+        pass
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def restore_source(pipeline, key, ftp=None, ficftp=None, path=None):
+    """Add the stages reading and decoding an encrypted and compressed backup file to pipeline
+       - pipeline: Pipeline receiving the stages
+       - key: AES key used for encryption
+       - ftp, ficftp: session and name of the file to download from the FTP server, or
+       - path: local encrypted file
+       return the pipe of the clear data
+    """
+    encrypted = pipeline.pipe()
+    decrypted = pipeline.pipe()
+    clear = pipeline.pipe()
+    if ftp is not None:
+        pipeline.add(download_stage, ftp, ficftp, encrypted)
+    else:
+        pipeline.add(read_stage, path, encrypted)
+    pipeline.add(decrypt_stage, encrypted, decrypted, key)
+    pipeline.add(decompress_stage, decrypted, clear)
+    return clear
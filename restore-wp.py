@@ -22,28 +22,60 @@
 # Import required python libraries
 
 import os
+import sys
 import time
-import pipes
-import configparser
+import subprocess
 import tarfile
+import ftplib
+import contextlib
 import tools
 import argparse
 import encrypt
+import compress
+import incremental
+import ftprotation
+import retention
+import ftppool
+import pipeline
+import dbdump
+import chunkstore
+import archive
+import binlog
+import metrics
 
 
 # By Default, this script will read configuration from file /etc/backup-wp.conf
-#
-# Todo : Add the option -f to read parameters from a specified filename in the command line parameter
+# The option -f reads the parameters from another file
 '''
 1) Copy files from remote location ie FTP or S3 to /data/backup/RESTORE-DATE
 2) Decrypt files
 3) Import SQL backup in MySQL
-4) Untar Site backup
+4) With --until, replay the binary logs captured by binlog-wp.py up to that time
+5) Untar Site backup
 '''
-CONFIG_FILE = "/etc/backup-wp.conf"
+# create parser
+parser = argparse.ArgumentParser()
 
-config = configparser.ConfigParser()
-config.read(CONFIG_FILE)
+# add arguments to the parser
+parser.add_argument("-d","--day",type=int,help="index of the backup to be restored, 0 for the last one, 1 for the one before ..., the daily, weekly and monthly backups kept being counted together (see retention.py). 0 by default, the last backup taken before the time of --until with --until")
+parser.add_argument("-l","--local",action='store_true', help="Restore from local backup folders only")
+parser.add_argument("-s","--stream",action='store_true', help="Decrypt, decompress and restore the backup files while they are read, without temporary files")
+parser.add_argument("-p","--path",action='append', help="Only restore this file or folder of the site (relative to WP_PATH or absolute), the database is not restored. Can be repeated")
+parser.add_argument("-u","--until",help="Restore the database as it was at this time, ie '2026-10-18 12:15:00', by replaying the binary logs captured by binlog-wp.py after the dump")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+parser.add_argument("--site",help="Site to restore, when the configuration file describes several sites")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+
+# parse the arguments
+args = parser.parse_args()
+
+CONFIG_FILE = args.config
+
+# The sections <site>:<SECTION> of the site override the sections SECTION, see tools.read_config
+try:
+    config = tools.read_config(CONFIG_FILE,args.site)
+except ValueError as error:
+    parser.error(str(error))
 
 WP_PATH = config.get('WP','WP_PATH')
 DB_HOST = config.get('DB','DB_HOST')
@@ -54,44 +86,76 @@ SMTP_FROM = config.get('SMTP','SMTP_FROM')
 SMTP_TO = config.get('SMTP','SMTP_TO')
 
 BACKUP_PATH = config.get('BACKUP','LOCALBKPATH')
-BACKUP_RETENTION = config.get('BACKUP','BACKUP_RETENTION')
 
 ENCRYPTION_KEYPATH = config.get('ENCRYPT','KEYPATH')
 
-# create parser
-parser = argparse.ArgumentParser()
+# Number of worker processes loading a parallel dump, see dbdump.py, 0 means one per core
+DB_DUMP_JOBS = config.getint('DB','DUMP_JOBS',fallback=0)
 
-# add arguments to the parser
-parser.add_argument("-d","--day",type=int,default=0,help="index of day in the past to be restored. Possible value from 0 to BACKUP_RETENTION - 1")
-parser.add_argument("-l","--local",action='store_true', help="Restore from local backup folders only")
-parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+# Number of worker processes extracting an indexed site archive, see archive.py, 0 means one per core
+RESTORE_JOBS = config.getint('BACKUP','RESTORE_JOBS',fallback=0)
 
-# parse the arguments
-args = parser.parse_args()
+# Command reading the binary logs replayed with --until, see binlog.py
+MYSQLBINLOG = config.get('BINLOG','MYSQLBINLOG',fallback='mysqlbinlog')
+
+# Timings and sizes of the stages are written in restore-report.json in the restore folder, see metrics.py
+METRICS_TEXTFILE_DIR = config.get('METRICS','TEXTFILE_DIR',fallback=None)
 
 DAYTORESTORE=args.day
 VERBOSE = args.verbose
 LOCALRESTORE = args.local
+STREAM_RESTORE = args.stream
+
+# Point-in-time restore of the database, see binlog.py
+if args.until:
+    try:
+        UNTIL = binlog.parse_until(args.until)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.path:
+        parser.error("--until restores the database, it can not be used with --path")
+    # The binary logs are replayed once the dump is imported
+    STREAM_RESTORE = False
+else:
+    UNTIL = None
+
+# Names of the members of the site archive to restore, None to restore everything
+if args.path:
+    RESTORE_PATHS = [os.path.normpath(os.path.join(WP_PATH, path)).lstrip("/") for path in args.path]
+    # Only the selected parts of the backup are read, there is nothing to stream
+    STREAM_RESTORE = False
+else:
+    RESTORE_PATHS = None
 
 if LOCALRESTORE:
     BACKUP_DEST = 'LOCAL'
 else:
     BACKUP_DEST = 'FTP'
 
+run = metrics.Run("restore",day=DAYTORESTORE,source=BACKUP_DEST,stream=STREAM_RESTORE,paths=RESTORE_PATHS,until=args.until)
+
 if BACKUP_DEST == 'FTP':
     FTP_SERVER = config.get('BACKUP','FTP_SERVER')
     FTP_USER = config.get('BACKUP','FTP_USER')
     FTP_PASSWD = config.get('BACKUP','FTP_PASSWD')
     FTP_PATH = config.get('BACKUP','FTP_PATH')
+    FTP_CONNECTIONS = config.getint('BACKUP','FTP_CONNECTIONS',fallback=1)
+    FTP_PORT = config.getint('BACKUP','FTP_PORT',fallback=21)
+    # ftplib or asyncio, see asyncftp.py
+    FTP_BACKEND = config.get('BACKUP','FTP_BACKEND',fallback='ftplib')
 else: # BACKUP_DEST == 'LOCAL' ''
     pass
 
 
 if BACKUP_DEST == 'LOCAL':
-    if DAYTORESTORE:
-        TODAYRESTOREPATH = BACKUP_PATH + '/' + "DAYJ-" + str(DAYTORESTORE)
-    else:
-        TODAYRESTOREPATH = BACKUP_PATH + '/' + "DAYJ"
+    # The local folder of DAYJ-N is given by the catalog of the snapshots, see retention.py
+    CATALOG = retention.Catalog(BACKUP_PATH)
+    if DAYTORESTORE is None and UNTIL:
+        DAYTORESTORE = binlog.backup_day([snapshot["date"] for snapshot in CATALOG.snapshots],UNTIL)
+    DAYTORESTORE = DAYTORESTORE or 0
+    TODAYRESTOREPATH = CATALOG.path(DAYTORESTORE)
+    if TODAYRESTOREPATH is None:
+        sys.exit("There is no local backup " + ftprotation.legacy_dir(DAYTORESTORE) + " in " + BACKUP_PATH)
 
 else:
     # Getting current DateTime to create the separate backup folder like "20210921".
@@ -111,66 +175,404 @@ else:
 
 # Part1 : Retrieve backup files
 
-MysqlBackupFilename="wordpress.sql.gz.bin"
+MysqlBackupFilename=DB_NAME + ".sql.gz.bin"
 WordPressBackupFilename="wordpress.site.tar.gz.bin"
+SiteManifestFilename=incremental.MANIFEST + ".bin"
+SiteRecipeFilename=chunkstore.RECIPE + ".bin"
+# Site archives written in blocks have an index of their members, see archive.py
+SiteIndexFilename=archive.INDEX + ".bin"
+# Backups made with DUMP=parallel have a dump of the tables in chunks instead of a single SQL dump
+ParallelDumpFilename=DB_NAME + dbdump.DUMP_SUFFIX + ".bin"
+
+fdKey = open(ENCRYPTION_KEYPATH,'rb')
+ENCRYPTION_KEY = fdKey.read()
+
+# Backups made with MODE=incremental have a site manifest instead of a site archive
+# and backups made with MODE=dedup have the recipe of the chunks of the site archive, see chunkstore.py
+if BACKUP_DEST == 'FTP':
+    PACK_PATH = TODAYRESTOREPATH + "/" + incremental.PACK_DIR
+    CHUNK_PATH = TODAYRESTOREPATH + "/" + chunkstore.CHUNK_DIR
+else:
+    PACK_PATH = BACKUP_PATH + "/" + incremental.PACK_DIR
+    CHUNK_PATH = BACKUP_PATH + "/" + chunkstore.CHUNK_DIR
 
 if BACKUP_DEST == 'FTP':
     print ("")
     print ("Starting Download from FTP Server")
 
-    if DAYTORESTORE == 0:
-        RESTORE_FOLDER = "DAYJ"
+    # Both FTP backends give sessions with the methods of ftplib.FTP and pools with the ones of ftppool.FTPPool
+    connectftp, pool_class = ftppool.backend(FTP_BACKEND)
+    ftpserver=connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD,port=FTP_PORT)
+    ftpserver.cwd(FTP_PATH)
+    # The physical folder of DAYJ-N is given by the rotation state, see ftprotation.py
+    try:
+        ROTATION = ftprotation.load_state(ftpserver)
+    except ValueError as error:
+        sys.exit(str(error))
+    if DAYTORESTORE is None and UNTIL:
+        DAYTORESTORE = binlog.backup_day([slot["date"] for slot in ROTATION["slots"]] if ROTATION else [],UNTIL)
+    DAYTORESTORE = DAYTORESTORE or 0
+    RESTORE_FOLDER = ftprotation.slot_dir(ROTATION,DAYTORESTORE)
+    if RESTORE_FOLDER is None:
+        sys.exit("There is no backup " + ftprotation.legacy_dir(DAYTORESTORE) + " on the FTP server")
+    if UNTIL:
+        # The segments of the binary logs are uploaded in the folder of the backup of the day of their capture
+        SEGMENTS = {}
+        for index in range(len(ROTATION["slots"]) if ROTATION else config.getint('BACKUP','BACKUP_RETENTION')):
+            folder = ftprotation.slot_dir(ROTATION,index)
+            for name in ftprotation.listdir(ftpserver,folder):
+                if binlog.parse_segment(name):
+                    SEGMENTS.setdefault(name,folder)
+    ftpserver.cwd(RESTORE_FOLDER)
+
+    # Large files may have been uploaded in parts, see ftppool.py
+    remote_files = set(tools.partof(file) for file in ftpserver.nlst())
+    INCREMENTAL = SiteManifestFilename in remote_files
+    DEDUP = SiteRecipeFilename in remote_files
+    INDEXED = not INCREMENTAL and not DEDUP and SiteIndexFilename in remote_files
+    PARALLEL_DUMP = ParallelDumpFilename in remote_files
+    if PARALLEL_DUMP:
+        MysqlBackupFilename = ParallelDumpFilename
+    if INCREMENTAL:
+        files_to_restore = [MysqlBackupFilename,SiteManifestFilename]
+    elif DEDUP:
+        files_to_restore = [MysqlBackupFilename,SiteRecipeFilename]
+    elif INDEXED:
+        files_to_restore = [MysqlBackupFilename,SiteIndexFilename,WordPressBackupFilename]
+    else:
+        files_to_restore = [MysqlBackupFilename,WordPressBackupFilename]
+    if RESTORE_PATHS:
+        files_to_restore.remove(MysqlBackupFilename)
+    if STREAM_RESTORE:
+        # Archives are read directly from the server in Part 3, only the manifest or the recipe and the packs are downloaded
+        # A parallel dump is loaded by several processes, it needs to be a local file
+        files_to_download = [file for file in files_to_restore if file in (SiteManifestFilename,SiteRecipeFilename,ParallelDumpFilename)]
+    elif RESTORE_PATHS and INDEXED:
+        # Only the ranges of the archive holding the selected members are downloaded below
+        files_to_download = [SiteIndexFilename]
     else:
-        RESTORE_FOLDER = "DAYJ-" + str(DAYTORESTORE)
-    ftpserver=tools.connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD)
-    ftpserver.cwd(FTP_PATH + "/" + RESTORE_FOLDER)
+        files_to_download = files_to_restore
 
-    for file in [MysqlBackupFilename,WordPressBackupFilename]:
-        print("Transfering " + file)
-        result=tools.downloadftp(ftpserver,file,TODAYRESTOREPATH)
+    def connect_ftp():
+        ftp = connectftp(FTP_SERVER,FTP_USER,FTP_PASSWD,port=FTP_PORT)
+        ftp.cwd(FTP_PATH + "/" + RESTORE_FOLDER)
+        return ftp
+
+    # Files are transferred over a pool of FTP_CONNECTIONS sessions, see ftppool.py
+    ftp_pool = pool_class(connect_ftp,FTP_CONNECTIONS,first=ftpserver)
 
-    tools.closeftp(ftpserver)
+    for file in files_to_download:
+        print("Transfering " + file)
+    with run.stage("download") as stage:
+        ftp_stats = ftp_pool.download_files(files_to_download,TODAYRESTOREPATH)
+        stage.add(ftp_stats["bytes"],ftp_stats["bytes"])
+
+    if INCREMENTAL:
+        # Download the packs holding the content of the files of the manifest
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + SiteManifestFilename,ENCRYPTION_KEY)
+        try:
+            os.stat(PACK_PATH)
+        except:
+            os.mkdir(PACK_PATH)
+        packs = ["../" + incremental.PACK_DIR + "/" + pack + incremental.PACK_SUFFIX for pack in sorted(incremental.referenced_packs([TODAYRESTOREPATH + "/" + incremental.MANIFEST],RESTORE_PATHS))]
+        for file in packs:
+            print("Transfering " + file)
+        with run.stage("download") as stage:
+            pack_stats = ftp_pool.download_files(packs,PACK_PATH)
+            stage.add(pack_stats["bytes"],pack_stats["bytes"])
+        ftp_stats["bytes"] += pack_stats["bytes"]
+        ftp_stats["seconds"] += pack_stats["seconds"]
+
+    if DEDUP:
+        # Download the packs holding the chunks of the recipe
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + SiteRecipeFilename,ENCRYPTION_KEY)
+        try:
+            os.stat(CHUNK_PATH)
+        except:
+            os.mkdir(CHUNK_PATH)
+        packs = ["../" + chunkstore.CHUNK_DIR + "/" + pack + incremental.PACK_SUFFIX for pack in sorted(chunkstore.recipe_packs(TODAYRESTOREPATH + "/" + chunkstore.RECIPE))]
+        for file in packs:
+            print("Transfering " + file)
+        with run.stage("download") as stage:
+            pack_stats = ftp_pool.download_files(packs,CHUNK_PATH)
+            stage.add(pack_stats["bytes"],pack_stats["bytes"])
+        ftp_stats["bytes"] += pack_stats["bytes"]
+        ftp_stats["seconds"] += pack_stats["seconds"]
+
+    if RESTORE_PATHS and INDEXED:
+        # Download the segments of the archive holding the selected members, see archive.py
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + SiteIndexFilename,ENCRYPTION_KEY)
+        site_index = archive.Index(TODAYRESTOREPATH + "/" + archive.INDEX)
+        groups = archive.plan(site_index,RESTORE_PATHS)[0]
+        # The segment size of the encrypted archive is given by its header
+        ftp_pool.download_ranges(WordPressBackupFilename,[(0,encrypt.HEADER.size)],TODAYRESTOREPATH)
+        with open(TODAYRESTOREPATH + "/" + WordPressBackupFilename,"rb") as site_archive:
+            segment_size = encrypt.read_header(site_archive)[1]
+        ranges = archive.encrypted_ranges(archive.Layout(site_index.blocks,segment_size),groups,ftp_pool.remote_size(WordPressBackupFilename))
+        print("Transfering %d bytes of %s in %d ranges" % (sum(length for offset, length in ranges),WordPressBackupFilename,len(ranges)))
+        with run.stage("download") as stage:
+            range_stats = ftp_pool.download_ranges(WordPressBackupFilename,ranges,TODAYRESTOREPATH)
+            stage.add(range_stats["bytes"],range_stats["bytes"])
+        ftp_stats["bytes"] += range_stats["bytes"]
+        ftp_stats["seconds"] += range_stats["seconds"]
+
+    if STREAM_RESTORE:
+        # The SQL dump and the site archive are read concurrently, each over its own session
+        stream_sessions = [ftpserver]
+        if not INCREMENTAL and not DEDUP:
+            stream_sessions.append(connect_ftp())
+    elif not UNTIL:
+        # With --until, the sessions download the segments of the binary logs once the dump is decrypted
+        ftp_pool.close()
+        tools.closeftp(ftpserver)
+
+    if ftp_stats["seconds"]:
+        print("Transferred %d bytes at %.1f MB/s" % (ftp_stats["bytes"],ftp_stats["bytes"] / ftp_stats["seconds"] / 1e6))
 
     print ("")
     print ("Copy from FTP Server completed")
+else:
+    if UNTIL:
+        # Local copies of the segments of the binary logs, see binlog-wp.py
+        SEGMENTS = {name: BACKUP_PATH + "/binlog/" + binlog.SEGMENT_DIR for name in os.listdir(BACKUP_PATH + "/binlog/" + binlog.SEGMENT_DIR)} if os.path.isdir(BACKUP_PATH + "/binlog/" + binlog.SEGMENT_DIR) else {}
+    INCREMENTAL = os.path.exists(TODAYRESTOREPATH + "/" + SiteManifestFilename)
+    DEDUP = os.path.exists(TODAYRESTOREPATH + "/" + SiteRecipeFilename)
+    INDEXED = not INCREMENTAL and not DEDUP and os.path.exists(TODAYRESTOREPATH + "/" + SiteIndexFilename)
+    PARALLEL_DUMP = os.path.exists(TODAYRESTOREPATH + "/" + ParallelDumpFilename)
+    if PARALLEL_DUMP:
+        MysqlBackupFilename = ParallelDumpFilename
+    if INCREMENTAL:
+        files_to_restore = [MysqlBackupFilename,SiteManifestFilename]
+    elif DEDUP:
+        files_to_restore = [MysqlBackupFilename,SiteRecipeFilename]
+    elif INDEXED:
+        files_to_restore = [MysqlBackupFilename,SiteIndexFilename,WordPressBackupFilename]
+    else:
+        files_to_restore = [MysqlBackupFilename,WordPressBackupFilename]
+    if RESTORE_PATHS:
+        files_to_restore.remove(MysqlBackupFilename)
 
 
 # Part 2 : Decrypt files
-fdKey = open(ENCRYPTION_KEYPATH,'rb')
-ENCRYPTION_KEY = fdKey.read()
-
-for file in [MysqlBackupFilename,WordPressBackupFilename]:
-    print("Decrypting " + file)
-    result=encrypt.decrypt_file(TODAYRESTOREPATH + "/" + file,ENCRYPTION_KEY)
-
-# Part3 : Database Restore.
-print ("")
-print ("Starting Import of MySQL Dump")
+if STREAM_RESTORE:
+    # Only the manifest, the recipe and a parallel dump are needed in clear before the restore,
+    # the manifest and the recipe are already decrypted when downloaded from FTP
+    if INCREMENTAL and BACKUP_DEST == 'LOCAL':
+        print("Decrypting " + SiteManifestFilename)
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + SiteManifestFilename,ENCRYPTION_KEY)
+    if DEDUP and BACKUP_DEST == 'LOCAL':
+        print("Decrypting " + SiteRecipeFilename)
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + SiteRecipeFilename,ENCRYPTION_KEY)
+    if PARALLEL_DUMP:
+        print("Decrypting " + ParallelDumpFilename)
+        encrypt.decrypt_file(TODAYRESTOREPATH + "/" + ParallelDumpFilename,ENCRYPTION_KEY)
+else:
+    for file in files_to_restore:
+        if INDEXED and file == WordPressBackupFilename:
+            # An indexed archive is read encrypted, by blocks, see archive.py
+            continue
+        if INDEXED and file == SiteIndexFilename and RESTORE_PATHS and BACKUP_DEST == 'FTP':
+            # Already decrypted to select the ranges to download
+            continue
+        print("Decrypting " + file)
+        with run.stage("decrypt") as stage:
+            result=encrypt.decrypt_file(TODAYRESTOREPATH + "/" + file,ENCRYPTION_KEY)
+            stage.add(os.path.getsize(TODAYRESTOREPATH + "/" + file),os.path.getsize(TODAYRESTOREPATH + "/" + file[:-len(".bin")]))
+
+importcmd = ["mysql","-h",DB_HOST,DB_NAME]
+parallel_dump = TODAYRESTOREPATH + "/" + DB_NAME + dbdump.DUMP_SUFFIX
+
+if UNTIL:
+    # Part2b : Binary logs from the position of the dump to the time to restore, see binlog.py
+    # They are checked before the database is touched
+    if PARALLEL_DUMP:
+        DUMP_POSITION = dbdump.read_metadata(parallel_dump)["binlog"]
+    else:
+        with open(TODAYRESTOREPATH + "/" + DB_NAME + ".sql.gz","rb") as dump:
+            DUMP_POSITION = binlog.dump_position(dump)
+    if DUMP_POSITION is None:
+        sys.exit("The backup of " + ftprotation.legacy_dir(DAYTORESTORE) + " has no binary log position, it was made without BINLOG section")
+    BINLOG_PATH = TODAYRESTOREPATH + "/binlog"
+    try:
+        os.stat(BINLOG_PATH)
+    except:
+        os.mkdir(BINLOG_PATH)
+    try:
+        binlog_plan = binlog.plan(SEGMENTS,DUMP_POSITION,UNTIL)
+    except ValueError as error:
+        sys.exit(str(error) + ", an older backup can be restored with -d " + str(DAYTORESTORE + 1))
+    segment_names = [name for log, names in binlog_plan for name in names]
+    print ("")
+    print("Binary logs %s to %s, %d segments from position %d" % (binlog_plan[0][0],binlog_plan[-1][0],len(segment_names),DUMP_POSITION["position"]))
+    if BACKUP_DEST == 'FTP':
+        segment_files = ["../" + SEGMENTS[name] + "/" + name for name in segment_names]
+        with run.stage("download") as stage:
+            binlog_stats = ftp_pool.download_files(segment_files,BINLOG_PATH)
+            stage.add(binlog_stats["bytes"],binlog_stats["bytes"])
+        ftp_pool.close()
+        tools.closeftp(ftpserver)
+        SEGMENT_PATH = BINLOG_PATH
+    else:
+        SEGMENT_PATH = BACKUP_PATH + "/binlog/" + binlog.SEGMENT_DIR
+    try:
+        with run.stage("binlog"):
+            BINLOG_FILES = binlog.rebuild(binlog_plan,lambda name: open(SEGMENT_PATH + "/" + name,"rb"),ENCRYPTION_KEY,BINLOG_PATH)
+    except ValueError as error:
+        sys.exit(str(error) + ", the database can not be restored until " + args.until)
 
-importcmd = "zcat " + pipes.quote(TODAYRESTOREPATH) + "/" + DB_NAME + ".sql.gz | mysql -h " + DB_HOST + " " + DB_NAME
+if STREAM_RESTORE:
+    # Part3 : Database and WP Site Restore, concurrently and without temporary files, see pipeline.py
+    print ("")
+    print ("Starting Import of MySQL Dump and Restore of Wordpress Site folder")
+
+    if PARALLEL_DUMP:
+        # The worker processes are forked before the threads of the pipeline are started
+        load_pool = dbdump.load_pool({"host": DB_HOST, "database": DB_NAME},parallel_dump,DB_DUMP_JOBS)
+    restore = pipeline.Pipeline()
+    if PARALLEL_DUMP:
+        restore.add(dbdump.load,{"host": DB_HOST, "database": DB_NAME},parallel_dump,DB_DUMP_JOBS,load_pool)
+    else:
+        if BACKUP_DEST == 'FTP':
+            sql = pipeline.restore_source(restore,ENCRYPTION_KEY,ftp=stream_sessions[0],ficftp=MysqlBackupFilename)
+        else:
+            sql = pipeline.restore_source(restore,ENCRYPTION_KEY,path=TODAYRESTOREPATH + "/" + MysqlBackupFilename)
+        restore.add(pipeline.command_stage,sql,importcmd)
+    if INCREMENTAL:
+        restore.add(incremental.restore_site,TODAYRESTOREPATH + "/" + incremental.MANIFEST,PACK_PATH,ENCRYPTION_KEY,"/")
+    elif DEDUP:
+        restore.add(chunkstore.restore_tree,TODAYRESTOREPATH + "/" + chunkstore.RECIPE,CHUNK_PATH,ENCRYPTION_KEY,"/")
+    else:
+        if BACKUP_DEST == 'FTP':
+            site = pipeline.restore_source(restore,ENCRYPTION_KEY,ftp=stream_sessions[1],ficftp=WordPressBackupFilename)
+        else:
+            site = pipeline.restore_source(restore,ENCRYPTION_KEY,path=TODAYRESTOREPATH + "/" + WordPressBackupFilename)
+        restore.add(pipeline.extract_stage,site,"/")
+    try:
+        with run.stage("restore"):
+            restore.wait()
+    except subprocess.CalledProcessError:
+        sys.exit("Error during import of MySQL Dump")
+    except (ValueError,OSError,EOFError,tarfile.TarError,ftplib.Error) as error:
+        # Decryption failed (authentication tag), truncated or corrupted file, transfer failed
+        sys.exit("Error during restore of the backup files: " + str(error))
+    finally:
+        if BACKUP_DEST == 'FTP':
+            ftp_pool.close()
+            for session in stream_sessions:
+                tools.closeftp(session)
 
-os.system(importcmd)
+    print ("")
+    print ("Restore of MySQL Dump and Wordpress Site folder completed")
+elif RESTORE_PATHS:
+    # Part3 : Restore of the selected paths of the WP Site, the database is not restored
+    print ("")
+    print ("Starting Restore of " + ", ".join("/" + path for path in RESTORE_PATHS))
+    with run.stage("site"):
+        if INCREMENTAL:
+            incremental.restore_site(TODAYRESTOREPATH + "/" + incremental.MANIFEST,PACK_PATH,ENCRYPTION_KEY,"/",RESTORE_PATHS)
+        elif DEDUP:
+            chunkstore.restore_tree(TODAYRESTOREPATH + "/" + chunkstore.RECIPE,CHUNK_PATH,ENCRYPTION_KEY,"/",RESTORE_PATHS)
+        elif INDEXED:
+            # Only the blocks holding the selected members are decrypted and decompressed
+            archive.extract(TODAYRESTOREPATH + "/" + WordPressBackupFilename,ENCRYPTION_KEY,TODAYRESTOREPATH + "/" + archive.INDEX,"/",RESTORE_PATHS,RESTORE_JOBS)
+        else:
+            @contextlib.contextmanager
+            def site_stream():
+                with open(TODAYRESTOREPATH + "/" + "wordpress.site.tar.gz","rb") as site_archive:
+                    yield compress.DecompressReader(site_archive)
+            incremental.extract_selected(site_stream,"/",RESTORE_PATHS)
 
+    print ("")
+    print ("Restore of " + ", ".join("/" + path for path in RESTORE_PATHS) + " completed")
+else:
+    # Part3 : Database Restore.
+    print ("")
+    print ("Starting Import of MySQL Dump")
+
+    with run.stage("database"):
+        if PARALLEL_DUMP:
+            # Tables are loaded in parallel and their indexes added after the data
+            dbdump.load({"host": DB_HOST, "database": DB_NAME},parallel_dump,DB_DUMP_JOBS)
+        else:
+            # The compression codec of the dump is detected automatically
+            mysql = subprocess.Popen(importcmd,stdin=subprocess.PIPE)
+            try:
+                with open(TODAYRESTOREPATH + "/" + DB_NAME + ".sql.gz","rb") as dump:
+                    reader = compress.DecompressReader(dump)
+                    while True:
+                        data = reader.read(compress.READ_SIZE)
+                        if not data:
+                            break
+                        mysql.stdin.write(data)
+                mysql.stdin.close()
+                imported = mysql.wait() == 0
+            except BrokenPipeError:
+                # mysql exited before the end of the dump
+                imported = False
+            except (ValueError,OSError):
+                # Truncated or corrupted dump, mysql is stopped instead of reading the end of the partial dump
+                mysql.kill()
+                imported = False
+            if not imported:
+                try:
+                    mysql.stdin.close()
+                except BrokenPipeError:
+                    pass
+                mysql.wait()
+                # The binary logs are not replayed and the site is not restored onto a partial database
+                sys.exit("Error during import of MySQL Dump")
 
-print ("")
-print ("Dump of MySQL imported")
+    print ("")
+    print ("Dump of MySQL imported")
+
+    if UNTIL:
+        # Part3b : Events of the database from the position of the dump until the time to restore
+        print ("")
+        print ("Starting Replay of the binary logs until " + time.strftime(binlog.UNTIL_FORMAT,time.localtime(UNTIL)))
+        with run.stage("replay"):
+            try:
+                binlog.replay(BINLOG_FILES,DUMP_POSITION,UNTIL,DB_HOST,DB_NAME,MYSQLBINLOG)
+            except subprocess.CalledProcessError:
+                sys.exit("Error during replay of the binary logs, the database is restored as of the dump only")
+        print ("")
+        print ("Binary logs replayed")
+
+    # Part3 : WP Site Restore.
 
-# Part3 : WP Site Restore.
+    print ("")
+    print ("Starting Restore of Wordpress Site folder")
+    with run.stage("site"):
+        if INCREMENTAL:
+            # Rebuild the full tree from the manifest and the packs it references
+            incremental.restore_site(TODAYRESTOREPATH + "/" + incremental.MANIFEST,PACK_PATH,ENCRYPTION_KEY,"/")
+        elif DEDUP:
+            # Extract the archive rebuilt from the chunks of the recipe
+            chunkstore.restore_tree(TODAYRESTOREPATH + "/" + chunkstore.RECIPE,CHUNK_PATH,ENCRYPTION_KEY,"/")
+        elif INDEXED:
+            # Groups of members are extracted in parallel from the encrypted archive, see archive.py
+            archive.extract(TODAYRESTOREPATH + "/" + WordPressBackupFilename,ENCRYPTION_KEY,TODAYRESTOREPATH + "/" + archive.INDEX,"/",None,RESTORE_JOBS)
+        else:
+            #declare filename
+            wp_archive= TODAYRESTOREPATH + "/" + "wordpress.site.tar.gz"
+
+            #open file in read mode
+            with open(wp_archive,"rb") as fileobj:
+                tar = tarfile.open(fileobj=compress.DecompressReader(fileobj),mode="r|")
+                tar.extractall("/")
+                tar.close()
 
-print ("")
-print ("Starting Restore of Wordpress Site folder")
-#declare filename
-wp_archive= TODAYRESTOREPATH + "/" + "wordpress.site.tar.gz"
+    print ("")
+    print ("Restore of  Wordpress Site folder completed")
 
-#open file in read mode
-tar = tarfile.open(wp_archive,"r:gz")
-tar.extractall("/")
-tar.close()
 
+# Report of the run, see metrics.py
+run.info["day"] = DAYTORESTORE
+run.finish()
+run.write_json(TODAYRESTOREPATH)
+if METRICS_TEXTFILE_DIR:
+    run.write_textfile(METRICS_TEXTFILE_DIR)
 print ("")
-print ("Restore of  Wordpress Site folder completed")
-
+print (run.summary())
 
 print ("")
 print ("Restore script completed")
-
@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import time
+import shutil
+import datetime
+
+# Grandfather-father-son retention of the backups
+#
+# Each backup is a snapshot identified by the time it was started (ie 20261018-020000) and kept by one
+# or more tiers : the daily tier keeps the BACKUP_RETENTION newest snapshots, the weekly and monthly tiers
+# the first snapshot of each of their WEEKLY_RETENTION last weeks and MONTHLY_RETENTION last months.
+# The tiers of every snapshot are computed again at each rotation by plan(), from the catalog alone :
+# a snapshot is promoted when a tier starts keeping it, and deleted once no tier keeps it anymore.
+#
+# Locally, the catalog is LOCALBKPATH/catalog.json and each tier keeping a snapshot has its own folder,
+# daily-<id>, weekly-<id>, monthly-<id>. A promotion links the files of the snapshot in the folder of
+# its new tier (hard links, nothing is copied) and a tier dropping a snapshot deletes its folder, the files
+# staying on disk as long as another tier links them. LOCALBKPATH/DAYJ is a symbolic link to the newest one.
+# On the FTP server a snapshot has a single folder and the catalog is the rotation state, see ftprotation.py.
+# Either way a rotation renames nothing and only deletes the snapshots which expire, whatever the retention.
+#
+# DAYJ-N is still the N-th newest snapshot for restore-wp.py -d and verify-wp.py -d, whatever its tiers.
+# The folders DAYJ, DAYJ-1 ... of the previous versions are adopted as daily snapshots by adopt().
+
+CATALOG = "catalog.json"
+CATALOG_VERSION = 1
+CURRENT = "DAYJ"
+TIERS = ("daily", "weekly", "monthly")
+LEGACY_DIR = re.compile(r"^DAYJ(?:-(\d+))?$")
+
+
+def new_id(now=None):
+    """Return the ID of a snapshot started at now, the current time by default"""
+    return time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+
+
+def period(tier, date):
+    """Return the day, ISO week or month of the date YYYYMMDD for the tier"""
+    if tier == "daily":
+        return date
+    if tier == "weekly":
+        year, week, weekday = datetime.date(int(date[:4]), int(date[4:6]), int(date[6:8])).isocalendar()
+        return "%04d-W%02d" % (year, week)
+    return date[:6]
+
+
+def plan(snapshots, policy):
+    """Return the tiers keeping each snapshot, a dict ID -> list of tiers, empty for the expired ones
+       - snapshots: entries of the catalog, newest first, the first one is the snapshot being written
+       - policy: number of snapshots kept by each tier, ie {"daily": 7, "weekly": 4, "monthly": 12}
+       The snapshot being written is only kept by the daily tier, it is promoted by the next
+       rotation once complete. Snapshots without a date (adopted from an unknown day) are only daily.
+    """
+    tiers = {snapshot["id"]: [] for snapshot in snapshots}
+    for snapshot in snapshots[:policy.get("daily", 1)]:
+        tiers[snapshot["id"]].append("daily")
+    for tier in TIERS[1:]:
+        firsts = {}
+        for snapshot in snapshots[1:]:
+            if snapshot["date"]:
+                # Newest first : the last snapshot seen of a period is its first one
+                firsts[period(tier, snapshot["date"])] = snapshot
+        for key in sorted(firsts, reverse=True)[:policy.get(tier, 0)]:
+            tiers[firsts[key]["id"]].append(tier)
+    return tiers
+
+
+def tier_path(root_path, tier, snapshot_id):
+    """Return the local folder of the snapshot snapshot_id in the tier"""
+    return root_path + "/" + tier + "-" + snapshot_id
+
+
+def _link_tree(source, dest):
+    """Link every file of the folder source in the new folder dest, the sub-folders being created"""
+    for folder, dirs, names in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(folder, source))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            os.link(os.path.join(folder, name), os.path.join(target, name))
+
+
+class Catalog:
+    """Snapshots of the local backup folder
+       - root_path: LOCALBKPATH
+       Without catalog file, the folders DAYJ, DAYJ-1 ... of the previous versions are listed as
+       snapshots, they are only moved by adopt().
+    """
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.catalog_path = root_path + "/" + CATALOG
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path) as f:
+                catalog = json.load(f)
+            if catalog.get("version") != CATALOG_VERSION:
+                raise ValueError("Unsupported catalog version")
+            self.snapshots = catalog["snapshots"]
+            self.legacy = False
+        else:
+            self.snapshots = self._legacy()
+            self.legacy = True
+
+    def _legacy(self):
+        folders = {}
+        if os.path.isdir(self.root_path):
+            for name in os.listdir(self.root_path):
+                match = LEGACY_DIR.match(name)
+                path = self.root_path + "/" + name
+                # Empty folders were created in advance for the rotation, they hold no backup
+                if match and os.path.isdir(path) and not os.path.islink(path) and os.listdir(path):
+                    folders[int(match.group(1) or 0)] = name
+        snapshots = []
+        for index in sorted(folders):
+            date = ""
+            if os.path.exists(self.root_path + "/" + folders[index] + "/date.txt"):
+                with open(self.root_path + "/" + folders[index] + "/date.txt") as datefile:
+                    date = datefile.readline().strip()
+            snapshot_id = date + "-000000" if date else folders[index]
+            if any(snapshot["id"] == snapshot_id for snapshot in snapshots):
+                snapshot_id = folders[index]
+            snapshots.append({"id": snapshot_id, "date": date, "tiers": ["daily"], "dir": folders[index]})
+        return snapshots
+
+    def save(self):
+        with open(self.catalog_path + ".tmp", "w") as f:
+            json.dump({"version": CATALOG_VERSION, "snapshots": self.snapshots}, f, indent=1)
+        os.replace(self.catalog_path + ".tmp", self.catalog_path)
+        self.legacy = False
+
+    def adopt(self):
+        """Move the folders DAYJ, DAYJ-1 ... of the previous versions to daily snapshots and write the catalog"""
+        os.makedirs(self.root_path, exist_ok=True)
+        for snapshot in self.snapshots:
+            if "dir" in snapshot:
+                os.rename(self.root_path + "/" + snapshot.pop("dir"), tier_path(self.root_path, "daily", snapshot["id"]))
+        # The empty folders of the rotation are not used anymore
+        for name in os.listdir(self.root_path):
+            if LEGACY_DIR.match(name) and os.path.isdir(self.root_path + "/" + name) and not os.path.islink(self.root_path + "/" + name):
+                os.rmdir(self.root_path + "/" + name)
+        self.save()
+        self._link_current()
+
+    def folder(self, snapshot):
+        """Return the local folder of the snapshot, the one of its shortest tier"""
+        if "dir" in snapshot:
+            return self.root_path + "/" + snapshot["dir"]
+        return tier_path(self.root_path, next(tier for tier in TIERS if tier in snapshot["tiers"]), snapshot["id"])
+
+    def path(self, index):
+        """Return the local folder of DAYJ-index, the index-th newest snapshot, None if there is none"""
+        if index >= len(self.snapshots):
+            return None
+        return self.folder(self.snapshots[index])
+
+    def paths(self):
+        """Return the local folders of all the snapshots"""
+        return [self.folder(snapshot) for snapshot in self.snapshots]
+
+    def add(self, snapshot_id, date):
+        """Create the daily snapshot snapshot_id of the date YYYYMMDD, as DAYJ"""
+        self.snapshots.insert(0, {"id": snapshot_id, "date": date, "tiers": ["daily"]})
+        os.makedirs(self.folder(self.snapshots[0]), exist_ok=True)
+        self.save()
+        self._link_current()
+
+    def apply(self, policy, release=None):
+        """Promote and prune the snapshots according to the policy, see plan()
+           - policy: number of snapshots kept by each tier
+           - release: optional, called with the folder of each expired snapshot before it is deleted
+           return the (ID, tier) of the promotions and the IDs of the expired snapshots
+        """
+        tiers = plan(self.snapshots, policy)
+        promoted = []
+        for snapshot in self.snapshots:
+            source = self.folder(snapshot)
+            for tier in tiers[snapshot["id"]]:
+                if tier not in snapshot["tiers"]:
+                    _link_tree(source, tier_path(self.root_path, tier, snapshot["id"]))
+                    promoted.append((snapshot["id"], tier))
+        expired = []
+        for snapshot in self.snapshots:
+            if not tiers[snapshot["id"]] and release is not None:
+                release(self.folder(snapshot))
+            for tier in snapshot["tiers"]:
+                if tier not in tiers[snapshot["id"]]:
+                    shutil.rmtree(tier_path(self.root_path, tier, snapshot["id"]), ignore_errors=True)
+            if not tiers[snapshot["id"]]:
+                expired.append(snapshot["id"])
+            snapshot["tiers"] = tiers[snapshot["id"]]
+        self.snapshots = [snapshot for snapshot in self.snapshots if snapshot["tiers"]]
+        self.save()
+        return promoted, expired
+
+    def _link_current(self):
+        link = self.root_path + "/" + CURRENT
+        if os.path.lexists(link + ".tmp"):
+            os.remove(link + ".tmp")
+        if self.snapshots:
+            os.symlink(os.path.basename(self.path(0)), link + ".tmp")
+            os.replace(link + ".tmp", link)
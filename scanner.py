@@ -0,0 +1,189 @@
+import os
+import stat
+import queue
+import sqlite3
+import threading
+import collections
+
+# Change detection of the WordPress site folder
+#
+# The tree is listed with os.scandir by a pool of threads, each worker taking a directory from a
+# shared queue, putting its subdirectories back in the queue and sending the stat of its entries
+# in batches to the caller, which writes them in the table scan of a sqlite database.
+# The table files of the same database is the stat cache : the state of the tree at the last backup.
+# Entries are keyed by path, and an entry is changed when its mode, owner, inode, size or mtime differ.
+# The changes are computed by sqlite (a join of both tables), and once the backup is done the scan
+# replaces the cache. Only directories waiting to be listed and batches in flight are held in memory,
+# so trees of millions of files are scanned with a constant memory.
+#
+# Keys are the encoded paths with "/" replaced by "\0" : sqlite compares BLOBs with memcmp, so rows
+# come back sorted by path components, the order of incremental.walk() and of the manifests.
+
+CACHE = "scan.sqlite"
+WORKERS = 4
+BATCH = 1000
+
+Stat = collections.namedtuple("Stat", "st_mode st_uid st_gid st_ino st_size st_mtime_ns")
+
+COLUMNS = "key BLOB PRIMARY KEY, mode INTEGER, uid INTEGER, gid INTEGER, ino INTEGER, size INTEGER, mtime INTEGER"
+CHANGED = "(scan.mode, scan.uid, scan.gid, scan.ino, scan.size, scan.mtime) IS NOT (files.mode, files.uid, files.gid, files.ino, files.size, files.mtime)"
+
+
+def _key(path):
+    return os.fsencode(path).replace(b"/", b"\0")
+
+
+def _path(key):
+    return os.fsdecode(key.replace(b"\0", b"/"))
+
+
+def _row(path, st):
+    return (_key(path), st.st_mode, st.st_uid, st.st_gid, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _worker(directories, results, abort):
+    while True:
+        path = directories.get()
+        if path is None:
+            directories.task_done()
+            return
+        try:
+            if abort.is_set():
+                continue
+            rows = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        directories.put(entry.path)
+                    rows.append(_row(entry.path, st))
+                    if len(rows) >= BATCH:
+                        results.put(rows)
+                        rows = []
+            results.put(rows)
+        except FileNotFoundError:
+            # Directory deleted during the scan
+            pass
+        except OSError as exc:
+            abort.set()
+            results.put(exc)
+        finally:
+            directories.task_done()
+
+
+def scan_tree(root, workers=WORKERS):
+    """Yield batches of rows (key, mode, uid, gid, ino, size, mtime) for root and everything below it
+       - root: folder to scan
+       - workers: number of threads listing the directories
+       Rows are not sorted, raise the first OSError met by a worker.
+    """
+    st = os.lstat(root)
+    yield [_row(root, st)]
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    directories = queue.Queue()
+    results = queue.Queue(maxsize=4 * workers)
+    abort = threading.Event()
+    directories.put(root)
+    threads = [threading.Thread(target=_worker, args=(directories, results, abort), daemon=True) for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    def done():
+        directories.join()
+        results.put(None)
+    threading.Thread(target=done, daemon=True).start()
+    error = None
+    rows = []
+    try:
+        while True:
+            rows = results.get()
+            if rows is None:
+                break
+            if isinstance(rows, OSError):
+                error = error or rows
+            elif rows and error is None:
+                yield rows
+    finally:
+        abort.set()
+        # Drain the results so that blocked workers can finish, then stop them
+        while rows is not None:
+            rows = results.get()
+        for thread in threads:
+            directories.put(None)
+        for thread in threads:
+            thread.join()
+    if error is not None:
+        raise error
+
+
+class Scanner:
+    """Stat cache of a tree and changes since the last backup
+       - path: sqlite database of the cache, created if needed
+       The cache may be used by successive tasks of a scheduler, one thread at a time.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (" + COLUMNS + ") WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'tag'").fetchone()
+        # Tag given by the last commit, ie the date of the backup described by the cache
+        self.tag = row[0] if row else None
+        self.counters = None
+
+    def scan(self, root, workers=WORKERS):
+        """Scan the tree root and compare it with the cache
+           return a dict with the counters of the scan : entries, added, changed and deleted
+        """
+        root = os.path.normpath(root)
+        self.db.execute("DROP TABLE IF EXISTS scan")
+        self.db.execute("CREATE TABLE scan (" + COLUMNS + ") WITHOUT ROWID")
+        self.db.execute("BEGIN")
+        try:
+            for rows in scan_tree(root, workers):
+                self.db.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.counters = {
+            "entries": self.db.execute("SELECT COUNT(*) FROM scan").fetchone()[0],
+            "added": self.db.execute("SELECT COUNT(*) FROM scan LEFT JOIN files USING (key) WHERE files.key IS NULL").fetchone()[0],
+            "changed": self.db.execute("SELECT COUNT(*) FROM scan JOIN files USING (key) WHERE " + CHANGED).fetchone()[0],
+            "deleted": self.db.execute("SELECT COUNT(*) FROM files LEFT JOIN scan USING (key) WHERE scan.key IS NULL").fetchone()[0],
+        }
+        return self.counters
+
+    def unchanged(self):
+        """Return True if the last scan found no change since the cache"""
+        return self.counters["added"] + self.counters["changed"] + self.counters["deleted"] == 0
+
+    def changes(self):
+        """Yield (status, path) for the changes found by the last scan, status is one of
+           "A" (added), "M" (modified) or "D" (deleted), sorted by path for each status
+        """
+        for key, added in self.db.execute("SELECT key, files.key IS NULL FROM scan LEFT JOIN files USING (key) WHERE files.key IS NULL OR " + CHANGED + " ORDER BY key"):
+            yield ("A" if added else "M"), _path(key)
+        for key, in self.db.execute("SELECT key FROM files LEFT JOIN scan USING (key) WHERE scan.key IS NULL ORDER BY key"):
+            yield "D", _path(key)
+
+    def entries(self):
+        """Yield (path, stat) for the entries of the last scan in the order of incremental.walk()"""
+        for row in self.db.execute("SELECT key, mode, uid, gid, ino, size, mtime FROM scan ORDER BY key"):
+            yield _path(row[0]), Stat(*row[1:])
+
+    def commit(self, tag):
+        """The backup of the last scan is done, the scan becomes the cache
+           - tag: saved with the cache, ie the date of the backup
+        """
+        self.db.execute("BEGIN")
+        self.db.execute("DROP TABLE files")
+        self.db.execute("ALTER TABLE scan RENAME TO files")
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tag', ?)", (tag,))
+        self.db.execute("COMMIT")
+        self.tag = tag
+
+    def close(self):
+        self.db.close()
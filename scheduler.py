@@ -0,0 +1,173 @@
+import os
+import time
+import concurrent.futures
+
+# Dependency-aware scheduler of the stages of a run
+#
+# A task is a function with the names of the tasks it depends on and the resources it holds while
+# it runs. A task starts as soon as its dependencies are done and its resources are free, so
+# independent stages (the dump of the database and the archive of the site, the local rotation and
+# the FTP connection ...) overlap and the run takes the time of its critical path, the longest
+# chain of dependent tasks, instead of the sum of its tasks.
+#
+# Resources are counted slots, ie "cpu" (cores), "io" (local disk) and "ftp" (sessions of the pool).
+# A task asking for more slots than there are gets them all.
+# Tasks run in threads : the stages spend their time in C code releasing the GIL (compression,
+# encryption, sockets) or in child processes (mysqldump, pgzip). No process is forked by the scheduler,
+# forking a process whose threads hold sockets and locks may deadlock the child.
+#
+# Tasks may belong to groups, ie the sites of a batch backup sharing the same slots. When several tasks
+# are ready, the next one is taken from the group with the fewest running tasks, then the group which
+# used the least time so far, so a huge site does not starve the others.
+#
+# The first failure of a group stops its scheduling : its running tasks are waited for and its other
+# tasks are not started, the other groups go on. StageError is raised once all the groups are done,
+# with the message of the first failed task, and failures gives the failure of each group.
+
+RESOURCES = {"cpu": os.cpu_count() or 1, "io": 2, "ftp": 1}
+
+
+class StageError(Exception):
+    """Failure of a task
+       - message: description of the failure, ie for the email sent when a backup fails
+       - task: name of the failed task, set by the scheduler
+       Tasks may raise it themselves to give a more precise message than the one of the task.
+    """
+    def __init__(self, message, task=None):
+        super().__init__(message)
+        self.message = message
+        self.task = task
+
+
+class Task:
+    """A task of a Scheduler, see Scheduler.add"""
+    def __init__(self, name, func, args, deps, resources, message, group):
+        self.name = name
+        self.group = group
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.resources = resources
+        self.message = message
+        self.result = None
+        self.start = None
+        self.end = None
+
+
+class Scheduler:
+    """Run tasks concurrently in the order of their dependencies within resource limits
+       - resources: number of slots of each resource, RESOURCES by default
+       - threads: maximum number of tasks running at the same time, 0 for no limit but the resources
+    """
+    def __init__(self, resources=None, threads=0):
+        self.capacity = dict(RESOURCES)
+        self.capacity.update(resources or {})
+        self.free = dict(self.capacity)
+        self.threads = threads
+        self.tasks = {}
+        self.failures = {}
+        self.start = None
+
+    def add(self, name, func, *args, deps=(), resources=None, message=None, group=None):
+        """Add the task name running func(*args) once the tasks deps are done, return the Task
+           - resources: dict of the slots held by the task, ie {"cpu": 1, "io": 1}
+           - message: description of a failure of the task, "Error during <name>" by default
+           - group: optional, group of the task for the fair scheduling and the failures
+           Dependencies on tasks which are never added are ignored, so optional stages can be left out.
+        """
+        if name in self.tasks:
+            raise ValueError("Task " + name + " already added")
+        task = Task(name, func, args, deps, resources or {}, message or "Error during " + name, group)
+        self.tasks[name] = task
+        return task
+
+    def _slots(self, task):
+        return {name: min(count, self.capacity.get(name, count)) for name, count in task.resources.items()}
+
+    def _ready(self, task, done):
+        if any(dep in self.tasks and dep not in done for dep in task.deps):
+            return False
+        return all(self.free.get(name, count) >= count for name, count in self._slots(task).items())
+
+    def _call(self, task):
+        task.start = time.perf_counter()
+        try:
+            return task.func(*task.args)
+        finally:
+            task.end = time.perf_counter()
+
+    def _next(self, pending, done, running, busy):
+        ready = [task for task in pending if self._ready(task, done)]
+        if not ready:
+            return None
+        active = {}
+        for task in running.values():
+            active[task.group] = active.get(task.group, 0) + 1
+        return min(ready, key=lambda task: (active.get(task.group, 0), busy.get(task.group, 0.0)))
+
+    def run(self):
+        """Run all the tasks, return the dict of their results by name
+           raise StageError when a task failed, once the tasks of the other groups are done
+        """
+        self.start = time.perf_counter()
+        pending = list(self.tasks.values())
+        done = set()
+        running = {}
+        busy = {}
+        failure = None
+        workers = self.threads or len(self.tasks) or 1
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            while pending or running:
+                while not self.threads or len(running) < self.threads:
+                    task = self._next(pending, done, running, busy)
+                    if task is None:
+                        break
+                    for name, count in self._slots(task).items():
+                        self.free[name] = self.free.get(name, count) - count
+                    pending.remove(task)
+                    running[executor.submit(self._call, task)] = task
+                if not running:
+                    raise ValueError("Tasks " + ", ".join(task.name for task in pending) + " wait for each other")
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    for name, count in self._slots(task).items():
+                        self.free[name] += count
+                    busy[task.group] = busy.get(task.group, 0.0) + task.end - task.start
+                    try:
+                        task.result = future.result()
+                    except Exception as error:
+                        if not isinstance(error, StageError):
+                            stage_error = StageError(task.message, task.name)
+                            stage_error.__cause__ = error
+                            error = stage_error
+                        elif error.task is None:
+                            error.task = task.name
+                        self.failures.setdefault(task.group, error)
+                        failure = failure or error
+                        # The other tasks of the group are not started
+                        pending = [other for other in pending if other.group != task.group]
+                    else:
+                        done.add(task.name)
+        if failure is not None:
+            raise failure
+        return {name: task.result for name, task in self.tasks.items()}
+
+    def timeline(self):
+        """Return (name, start, end) of the tasks which ran, in seconds from the start of the run"""
+        return sorted((task.name, task.start - self.start, task.end - self.start) for task in self.tasks.values() if task.end is not None)
+
+    def critical_path(self):
+        """Return the names of the chain of tasks which ended last, each one waiting for the previous one"""
+        ran = [task for task in self.tasks.values() if task.end is not None]
+        if not ran:
+            return []
+        task = max(ran, key=lambda task: task.end)
+        path = [task.name]
+        while True:
+            deps = [self.tasks[dep] for dep in task.deps if dep in self.tasks and self.tasks[dep].end is not None]
+            if not deps:
+                break
+            task = max(deps, key=lambda dep: dep.end)
+            path.append(task.name)
+        return path[::-1]
@@ -1,6 +1,14 @@
 import os
+import json
+import time
+import ssl
 import ftplib
+import hashlib
 import smtplib
+import threading
+import configparser
+import governor
+import fileio
 from email.message import EmailMessage
 from Crypto.Random import get_random_bytes
 
@@ -20,44 +28,419 @@ def sendmail(mailfrom="address@example.com",mailto="imaneamirat08@gmail.com",mes
     s.send_message(msg)
     s.quit()
 
-def connectftp(ftpserver = "172.16.30.32" , username = 'anonymous', password = 'anonymous@', passive = False):
+def site_names(config):
+    """Return the names of the sites described by the sections <site>:<SECTION> of config"""
+    names = []
+    for section in config.sections():
+        site, _, name = section.partition(":")
+        if name and site not in names:
+            names.append(site)
+    return names
+
+def read_config(path, site=None):
+    """Return the 'configparser.ConfigParser' of the configuration file path
+       - site: optional, name of a site of the file, its sections <site>:<SECTION> override the sections SECTION
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    if site:
+        if site not in site_names(config):
+            raise ValueError("No site " + site + " in " + path)
+        for section in config.sections():
+            if section.startswith(site + ":"):
+                name = section[len(site) + 1:]
+                if not config.has_section(name):
+                    config.add_section(name)
+                for option in config.options(section):
+                    config.set(name, option, config.get(section, option, raw=True))
+    return config
+
+# Number of commands sent to the FTP servers by all the sessions, see metrics.py
+# Each command is a round-trip with the server, unless it is pipelined with others (see pipeline())
+_ftp_commands = 0
+_ftp_commands_lock = threading.Lock()
+
+def ftp_commands():
+    """Return the number of FTP commands sent since the start of the process"""
+    return _ftp_commands
+
+def count_ftp_commands(count=1):
+    """Add count to the number of FTP commands sent, for the sessions not based on SessionReuseFTP_TLS"""
+    global _ftp_commands
+    with _ftp_commands_lock:
+        _ftp_commands += count
+
+class SessionReuseFTP_TLS(ftplib.FTP_TLS):
+    """FTP_TLS resuming the TLS session of the control connection on the data connections
+       It saves a full TLS handshake per transfer and is required by servers enforcing
+       session reuse (ie vsftpd require_ssl_reuse=YES)
+    """
+    def putcmd(self, line):
+        count_ftp_commands()
+        ftplib.FTP_TLS.putcmd(self, line)
+
+    def pipeline(self, commands, check=True):
+        """Send the commands in a single write and return their replies, see pipeline()"""
+        if any('\r' in command or '\n' in command for command in commands):
+            raise ValueError('an illegal newline character should not be contained')
+        count_ftp_commands(len(commands))
+        self.sock.sendall("".join(command + ftplib.CRLF for command in commands).encode(self.encoding))
+        return _replies(self, commands, check)
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        # The upload rate is limited by the governor of the process, see governor.py
+        return ftplib.FTP_TLS.storbinary(self, cmd, governor.Throttled(fp, "upload"), blocksize, callback, rest)
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        def write(data):
+            governor.throttle("download", len(data))
+            callback(data)
+        return ftplib.FTP_TLS.retrbinary(self, cmd, write, blocksize, rest)
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+def connectftp(ftpserver = "172.16.30.32" , username = 'anonymous', password = 'anonymous@', passive = False, port = 21):
     """connect to ftp server and open a session
        - ftpserver: IP address of the ftp server
        - username: login of the ftp user ('anonymous' by défaut)
        - password: password of the ftp user ('anonymous@' by défaut)
        - passive: activate or disable ftp passive mode (False par défaut)
+       - port: port of the ftp server (21 by default)
        return the object 'ftplib.FTP' after connection and opening of a session
     """
-    ftp = ftplib.FTP_TLS()
-    ftp.connect(ftpserver)
+    ftp = SessionReuseFTP_TLS()
+    ftp.connect(ftpserver, port)
     ftp.login(username, password)
     ftp.set_pasv(passive)
     ftp.prot_p()
     return ftp
 
-def uploadftp(ftp, ficdsk,ftpPath):
+PIPELINE_DEPTH = 200
+
+def _replies(ftp, commands, check):
+    replies = []
+    for command in commands:
+        try:
+            replies.append(ftp.getresp())
+        except ftplib.Error as error:
+            replies.append(str(error))
+    if check:
+        for reply in replies:
+            check_reply(reply)
+    return replies
+
+def check_reply(reply):
+    """Raise the ftplib exception of an error reply, ie returned by pipeline(check=False)"""
+    if reply[:1] == "4":
+        raise ftplib.error_temp(reply)
+    if reply[:1] == "5":
+        raise ftplib.error_perm(reply)
+    return reply
+
+def pipeline(ftp, commands, check=True):
+    """Send FTP commands without waiting for the reply of each one, return their replies
+       - ftp: object 'ftplib.FTP' on an open session, or a session of asyncftp.py
+       - commands: commands which do not depend on the reply of each other, ie DELE of several files
+       - check: raise the error of the first failed command once all the replies are read, so the
+         session stays usable, else the replies of the failed commands are returned like the others
+       The commands take a single round-trip instead of one each. At most PIPELINE_DEPTH commands
+       are sent at once, so the replies waiting to be read do not fill the buffers of the connection.
+    """
+    replies = []
+    for index in range(0, len(commands), PIPELINE_DEPTH):
+        batch = commands[index:index + PIPELINE_DEPTH]
+        if hasattr(ftp, "pipeline"):
+            replies += ftp.pipeline(batch, False)
+        else:
+            for command in batch:
+                ftp.putcmd(command)
+            replies += _replies(ftp, batch, False)
+    if check:
+        for reply in replies:
+            check_reply(reply)
+    return replies
+
+# Resumable transfers
+#
+# A checkpoint file (local file + ".ckpt") records the transfer in progress : a header line
+# with the remote name, size, mtime and block size, then one line per block transferred with
+# the sha256 of the block. After an interruption, the transfer restarts from the bytes confirmed
+# by the server (SIZE) for an upload, or from the local partial file for a download, rounded
+# down to a block recorded in the checkpoint. Only the last recorded block is read again to check
+# that the data already transferred did not change, instead of the whole file.
+
+CHECKPOINT_SUFFIX = ".ckpt"
+CHECKPOINT_BLOCK = 4 * 1024 * 1024
+RETRIES = 5
+RETRY_DELAY = 2
+
+class Checkpoint:
+    """Checkpoint of a transfer, see above
+       - path: local file transferred
+       - header: dict identifying the transfer (remote name, size, mtime)
+    """
+    def __init__(self, path, header):
+        self.path = path + CHECKPOINT_SUFFIX
+        self.header = dict(header, block=CHECKPOINT_BLOCK)
+        self.blocks = []
+        try:
+            with open(self.path) as f:
+                if json.loads(f.readline()) == self.header:
+                    self.blocks = [line.strip() for line in f if len(line.strip()) == 64]
+        except (OSError, ValueError):
+            pass
+        self.file = None
+        self.digest = None
+        self.filled = 0
+
+    def resume_offset(self, limit, fileobj):
+        """Return the offset where the transfer restarts
+           - limit: number of bytes available (confirmed by the server or in the local partial file)
+           - fileobj: local file opened for reading, used to check the last recorded block
+        """
+        count = min(len(self.blocks), limit // CHECKPOINT_BLOCK)
+        if count:
+            fileobj.seek((count - 1) * CHECKPOINT_BLOCK)
+            if hashlib.sha256(fileobj.read(CHECKPOINT_BLOCK)).hexdigest() != self.blocks[count - 1]:
+                count = 0
+        del self.blocks[count:]
+        return count * CHECKPOINT_BLOCK
+
+    def start(self):
+        """Rewrite the checkpoint with the blocks kept by resume_offset, then record new blocks"""
+        self.file = open(self.path, "w")
+        self.file.write(json.dumps(self.header) + "\n")
+        for block in self.blocks:
+            self.file.write(block + "\n")
+        self.file.flush()
+        self.digest = hashlib.sha256()
+        self.filled = 0
+
+    def update(self, data):
+        """Record data transferred after the resume offset"""
+        view = memoryview(data)
+        while view:
+            size = min(len(view), CHECKPOINT_BLOCK - self.filled)
+            self.digest.update(view[:size])
+            self.filled += size
+            view = view[size:]
+            if self.filled == CHECKPOINT_BLOCK:
+                self.blocks.append(self.digest.hexdigest())
+                self.file.write(self.blocks[-1] + "\n")
+                self.file.flush()
+                self.digest = hashlib.sha256()
+                self.filled = 0
+
+    def done(self):
+        """Transfer completed, delete the checkpoint"""
+        self.file.close()
+        os.remove(self.path)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class _CheckpointReader:
+    """Read a local file and record what is read in a checkpoint"""
+    def __init__(self, fileobj, checkpoint):
+        self.fileobj = fileobj
+        self.checkpoint = checkpoint
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.checkpoint.update(data)
+        return data
+
+def _remote_size(ftp, ficftp):
+    ftp.voidcmd("TYPE I")
+    try:
+        return ftp.size(ficftp)
+    except ftplib.error_perm:
+        return None
+
+def _remote_mtime(ftp, ficftp):
+    try:
+        return ftp.voidcmd("MDTM " + ficftp)[4:].strip()
+    except ftplib.error_perm:
+        return None
+
+def uploadftp(ftp, ficdsk,ftpPath, resume=False, blocksize=fileio.BLOCK_SIZE):
     '''
     Upload the file ficdsk from local folder to the current ftp folder
         - ftp: object 'ftplib.FTP' on an open session
         - ficdsk: local name of the file to upload
         - ficPath: FTP path where to store the file
+        - resume: keep a checkpoint and resume an interrupted upload of the same file
+        - blocksize: size of the blocks sent on the data connection
+        The blocks are sent from a memory map of the file, without copy, see fileio.py
     '''
     repdsk, ficdsk2 = os.path.split(ficdsk)
     ficftp = ftpPath + "/" + ficdsk2
-    with open(ficdsk, "rb") as f:
-        ftp.storbinary("STOR " + ficftp, f)
+    if not resume:
+        with fileio.open_mapped(ficdsk) as f:
+            ftp.storbinary("STOR " + ficftp, f, blocksize)
+        return
+    st = os.stat(ficdsk)
+    checkpoint = Checkpoint(ficdsk, {"remote": ficftp, "size": st.st_size, "mtime": st.st_mtime_ns})
+    try:
+        with fileio.open_mapped(ficdsk) as f:
+            remote = 0
+            offset = 0
+            if checkpoint.blocks:
+                remote = _remote_size(ftp, ficftp) or 0
+                if remote > st.st_size:
+                    remote = 0
+                offset = checkpoint.resume_offset(remote, f)
+            checkpoint.start()
+            f.seek(offset)
+            reader = _CheckpointReader(f, checkpoint)
+            if offset:
+                try:
+                    ftp.storbinary("STOR " + ficftp, reader, blocksize, rest=offset)
+                except ftplib.error_perm:
+                    # REST before STOR refused, append from the end of the remote file instead
+                    checkpoint.start()
+                    f.seek(offset)
+                    while f.tell() < remote:
+                        reader.read(min(CHECKPOINT_BLOCK, remote - f.tell()))
+                    ftp.storbinary("APPE " + ficftp, reader, blocksize)
+            else:
+                ftp.storbinary("STOR " + ficftp, reader, blocksize)
+        if _remote_size(ftp, ficftp) != st.st_size:
+            raise ftplib.error_temp("Size of " + ficftp + " on the server does not match " + ficdsk)
+        checkpoint.done()
+    finally:
+        checkpoint.close()
 
-def downloadftp(ftp, ficftp, repdsk='.', ficdsk=None):
+def retrinto(ftp, cmd, write, rest=None):
+    """Retrieve a file in binary mode like ftp.retrbinary, receiving the data in a single buffer
+       - ftp: object 'ftplib.FTP' from an open session
+       - cmd: RETR command
+       - write: called with each block received, as a memoryview overwritten by the next block
+       - rest: optional, offset to start the transfer at
+       return the final reply of the server
+    """
+    if not hasattr(ftp, "transfercmd"):
+        # Sessions of asyncftp.py receive their blocks on their own
+        return ftp.retrbinary(cmd, write, fileio.BLOCK_SIZE, rest)
+    view = memoryview(bytearray(fileio.BLOCK_SIZE))
+    ftp.voidcmd("TYPE I")
+    with ftp.transfercmd(cmd, rest) as conn:
+        while True:
+            count = conn.recv_into(view)
+            if not count:
+                break
+            governor.throttle("download", count)
+            write(view[:count])
+        if isinstance(conn, ssl.SSLSocket):
+            conn.unwrap()
+    return ftp.voidresp()
+
+def downloadftp(ftp, ficftp, repdsk='.', ficdsk=None, resume=False):
     """Download the file ficftp from ftpserver and put it in the local folder repdsk
        - ftp: object 'ftplib.FTP' from an open session
        - ficftp: name of the file to download
        - repdsk: local folder where you want to store the file
        - ficdsk: optional, if you want to rename the file locally
+       - resume: keep a checkpoint and resume an interrupted download of the same file
+       The blocks are received in a single buffer of fileio.BLOCK_SIZE bytes, see retrinto().
     """
     if ficdsk==None:
         ficdsk=ficftp
-    with open(os.path.join(repdsk, ficdsk), 'wb') as f:
-        ftp.retrbinary('RETR ' + ficftp, f.write)
+    path = os.path.join(repdsk, ficdsk)
+    size = _remote_size(ftp, ficftp) if resume else None
+    if size is None:
+        # Large files may have been uploaded in parts by ftppool, they are not resumed
+        with open(path, 'wb') as f:
+            try:
+                retrinto(ftp, 'RETR ' + ficftp, f.write)
+            except ftplib.error_perm:
+                parts = findparts(ftp, ficftp)
+                if not parts:
+                    raise
+                f.seek(0)
+                f.truncate()
+                for part in parts:
+                    retrinto(ftp, 'RETR ' + part, f.write)
+        return
+    checkpoint = Checkpoint(path, {"remote": ficftp, "size": size, "mtime": _remote_mtime(ftp, ficftp)})
+    try:
+        with open(path, "ab+") as f:
+            offset = 0
+            if checkpoint.blocks:
+                offset = checkpoint.resume_offset(f.seek(0, os.SEEK_END), f)
+            f.truncate(offset)
+            f.seek(offset)
+            checkpoint.start()
+            def write(data):
+                f.write(data)
+                checkpoint.update(data)
+            retrinto(ftp, 'RETR ' + ficftp, write, rest=offset or None)
+            if f.tell() != size:
+                raise ftplib.error_temp("Size of " + path + " does not match " + ficftp + " on the server")
+        checkpoint.done()
+    finally:
+        checkpoint.close()
+
+def retryftp(action, connect, retries=RETRIES, delay=RETRY_DELAY):
+    """Run action(ftp) and retry it on a new session with an exponential backoff if it fails
+       - action: function taking an 'ftplib.FTP' session, should resume what was already done
+       - connect: function without argument returning a new 'ftplib.FTP' session
+       - retries: number of retries before giving up
+       - delay: delay before the first retry in seconds, doubled at each retry
+       return the session used by the last attempt and the result of action
+    """
+    attempt = 0
+    ftp = connect()
+    while True:
+        try:
+            return ftp, action(ftp)
+        except ftplib.all_errors:
+            if attempt >= retries:
+                raise
+            try:
+                ftp.close()
+            except Exception:
+                pass
+            time.sleep(delay * 2 ** attempt)
+            attempt += 1
+            ftp = connect()
+
+def partnames(ficftp, count):
+    """Return the names of the parts of the file ficftp uploaded in count segments"""
+    return [ficftp + ".part-%05d-of-%05d" % (index + 1, count) for index in range(count)]
+
+def findparts(ftp, ficftp):
+    """Return the names of the parts of the file ficftp on the server, in order
+       - ftp: object 'ftplib.FTP' from an open session
+       - ficftp: name of the file
+       return [] if the file has not been uploaded in parts, raise ftplib.error_perm if parts are missing
+    """
+    folder, name = ficftp.rpartition("/")[::2]
+    if folder:
+        names = [file.rsplit("/", 1)[-1] for file in ftp.nlst(folder)]
+    else:
+        names = [file.rsplit("/", 1)[-1] for file in ftp.nlst()]
+    parts = sorted(file for file in names if file.startswith(name + ".part-"))
+    if not parts:
+        return []
+    count = int(parts[0].rsplit("-of-", 1)[1])
+    if parts != partnames(name, count):
+        raise ftplib.error_perm("550 Missing parts of " + ficftp)
+    if folder:
+        return [folder + "/" + part for part in parts]
+    return parts
+
+def partof(file):
+    """Return the name of the file a part belongs to, or file itself if it is not a part"""
+    name, sep, suffix = file.rpartition(".part-")
+    if sep and "-of-" in suffix:
+        return name
+    return file
 
 def closeftp(ftp):
     """Close FTP connection
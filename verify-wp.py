@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+###########################################################
+#
+# This python script is used to verify the Wordpress backups
+# without restoring them : every backup file of the retention folders
+# is read once and decrypted, decompressed and compared with the index,
+# the manifest or the checksums written by the backup.
+# With -c, the checksums computed by the FTP server are compared
+# with the ones of the backup, without transferring the files.
+# Nothing is written in WP_PATH nor in the database
+#
+##########################################################
+
+# Import required python libraries
+
+import sys
+import tools
+import argparse
+import ftppool
+import ftprotation
+import backupjob
+import metrics
+import verify
+
+
+# By Default, this script will read configuration from file /etc/backup-wp.conf
+# The option -f reads the parameters from another file
+'''
+1) Read the checksums of the backup of each retention folder
+2) Read and check every file of the folders concurrently, or compare the checksums of the server with -c
+3) Read and check the packs referenced by the folders, each one once
+4) Report the failures, by email too
+'''
+# create parser
+parser = argparse.ArgumentParser()
+
+# add arguments to the parser
+parser.add_argument("-d","--day",type=int,action="append",help="index of the backup to be verified, 0 for the last one, the daily, weekly and monthly backups being counted together. Can be repeated, all the backups kept by default")
+parser.add_argument("-l","--local",action="store_true",help="Verify the local backup folders instead of the FTP server")
+parser.add_argument("-c","--checksums",action="store_true",help="Compare the checksums computed by the FTP server instead of reading the files, when the server supports HASH or XCRC")
+parser.add_argument("-j","--jobs",type=int,default=0,help="Number of files verified at the same time, one per retention folder verified by default")
+parser.add_argument("-f","--config",default="/etc/backup-wp.conf",help="Configuration file, /etc/backup-wp.conf by default")
+parser.add_argument("--site",help="Site to verify, when the configuration file describes several sites")
+parser.add_argument("-v","--verbose",type=int,default=0,choices=[0,1,2],help="0 disable verbose, 1 minimal verbose, 2 debug mode")
+
+# parse the arguments
+args = parser.parse_args()
+
+try:
+    SETTINGS = backupjob.Settings(args.config,args.site)
+except ValueError as error:
+    parser.error(str(error))
+
+# The daily, weekly and monthly tiers keep at most SETTINGS.snapshots backups, see retention.py
+DAYS = sorted(set(args.day)) if args.day else list(range(SETTINGS.snapshots))
+if any(day < 0 or day >= SETTINGS.snapshots for day in DAYS):
+    parser.error("Days to verify are from 0 to " + str(SETTINGS.snapshots - 1))
+JOBS = args.jobs or len(DAYS)
+VERBOSE = args.verbose
+
+with open(SETTINGS.keypath,'rb') as fdKey:
+    ENCRYPTION_KEY = fdKey.read()
+
+run = metrics.Run("verify",days=DAYS,source="LOCAL" if args.local else "FTP",checksums=args.checksums)
+
+if args.local:
+    source = verify.LocalSource(SETTINGS.root_path)
+    ftp_pool = None
+else:
+    # Each file is read over its own session of a pool of JOBS sessions, see ftppool.py
+    connectftp, pool_class = ftppool.backend(SETTINGS.ftp_backend)
+
+    def connect_ftp():
+        ftp = connectftp(SETTINGS.ftp_server,SETTINGS.ftp_user,SETTINGS.ftp_passwd,port=SETTINGS.ftp_port)
+        ftp.cwd(SETTINGS.ftp_root_path)
+        return ftp
+    ftp_pool = pool_class(connect_ftp,JOBS)
+    source = verify.FTPSource(ftp_pool)
+
+if VERBOSE >= 1:
+    print("")
+    print("Starting verification of " + ", ".join(ftprotation.legacy_dir(day) for day in DAYS))
+
+verifier = verify.Verifier(source,ENCRYPTION_KEY,JOBS,args.checksums)
+try:
+    with run.stage("verify") as stage:
+        results = verifier.verify(DAYS)
+        stage.add(sum(result["bytes"] for result in results if result["method"] == "stream"))
+finally:
+    if ftp_pool is not None:
+        ftp_pool.close()
+
+failures = [result for result in results if result["status"] != "ok"]
+lines = []
+for day in DAYS + [None]:
+    day_results = [result for result in results if result["day"] == day]
+    if not day_results:
+        if day is not None:
+            lines.append("%-8s no backup" % ftprotation.legacy_dir(day))
+        continue
+    failed = [result for result in day_results if result["status"] != "ok"]
+    checked = sum(1 for result in day_results if result["method"] == "checksum")
+    lines.append("%-8s %4d files, %4d by checksum, %d failed" % (ftprotation.legacy_dir(day) if day is not None else "packs", len(day_results), checked, len(failed)))
+    for result in day_results if VERBOSE == 2 else failed:
+        lines.append("  %-6s %-8s %s%s" % (result["status"], result["method"], result["file"], " : " + result["error"] if result["error"] else ""))
+
+run.info.update(files=len(results),failed=len(failures),checked_bytes=sum(result["bytes"] for result in results if result["method"] == "checksum"))
+run.finish()
+run.write_json(SETTINGS.root_path)
+if SETTINGS.textfile_dir:
+    run.write_textfile(SETTINGS.textfile_dir)
+
+MESSAGE = "\n".join(lines) + "\n\n" + run.summary()
+if VERBOSE >= 1 or failures:
+    print("")
+    print(MESSAGE)
+
+if failures:
+    tools.sendmail(mailfrom=SETTINGS.smtp_from,mailto=SETTINGS.smtp_to,message="Verification of the backups failed\n\n" + MESSAGE,subject="Verification of the Wordpress backups of " + SETTINGS.site, smtphost=SETTINGS.smtp_host)
+    sys.exit(1)
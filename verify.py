@@ -0,0 +1,660 @@
+import io
+import os
+import gzip
+import json
+import zlib
+import hashlib
+import tarfile
+import threading
+import contextlib
+import concurrent.futures
+import tools
+import encrypt
+import compress
+import archive
+import incremental
+import chunkstore
+import dbdump
+import binlog
+import ftppool
+import ftprotation
+import retention
+import pipeline
+
+# Verification of the backups without restoring them, see verify-wp.py
+#
+# Each backup writes in its DAYJ folder the checksums (size, sha256 and crc32) of the encrypted
+# files it uploads and of the packs its manifest or recipe references (checksums.json.bin, encrypted
+# like the other files). Files uploaded in parts by ftppool.py also have the checksums of their parts.
+#
+# Stream verification : every file of a retention folder is read once, from the FTP server or from
+# the local folder, and in the same pass :
+#   - its checksums are computed and compared with the ones of the backup
+#   - the tag of each encrypted segment is verified
+#   - the compressed stream is decompressed to its end
+#   - the members of the tar stream are compared with the index of the archive (the manifest of the
+#     members), the chunks of a parallel dump with its metadata, and every object of a pack with
+#     the sha256 of the manifests and recipes referencing it
+# Packs shared by several retention folders are only read once.
+#
+# Checksum verification (-c) : when the server computes checksums itself (HASH command, with
+# SHA-256 or CRC32, or the XSHA256 and XCRC commands), all the files of all the retention folders are
+# compared with the checksums of the backups without transferring their content. The commands of a
+# folder are pipelined in a single round-trip (see tools.pipeline). The files the server can not
+# check are stream verified.
+#
+# The files are verified concurrently over a pool of FTP sessions, by a pool of threads.
+
+SUMS = "checksums.json"
+SUMS_VERSION = 1
+READ_SIZE = pipeline.BLOCK_SIZE
+# Checksum commands of the servers by order of preference : feature, command and algorithm
+HASH_COMMANDS = (("HASH", "HASH", "SHA-256"), ("XSHA256", "XSHA256", "SHA-256"),
+                 ("HASH", "HASH", "CRC32"), ("XCRC", "XCRC", "CRC32"))
+HASH_FIELDS = {"SHA-256": "sha256", "CRC32": "crc32"}
+
+
+def _entry(size, sha256, crc32):
+    return {"size": size, "sha256": sha256.hexdigest(), "crc32": "%08x" % crc32}
+
+
+class Checksum:
+    """sha256 and crc32 of a stream, and of each one of its parts
+       - ends: offsets where the parts end, ie of a file uploaded in parts by ftppool.py, no part by default
+    """
+    def __init__(self, ends=()):
+        self.ends = list(ends)
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+        self.parts = []
+        self.part_sha256 = hashlib.sha256()
+        self.part_crc32 = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        view = memoryview(data)
+        position = self.size
+        while view and len(self.parts) < len(self.ends):
+            end = self.ends[len(self.parts)]
+            piece = view[:end - position]
+            self.part_sha256.update(piece)
+            self.part_crc32 = zlib.crc32(piece, self.part_crc32)
+            position += len(piece)
+            view = view[len(piece):]
+            if position == end:
+                self.parts.append(_entry(end - (self.ends[len(self.parts) - 1] if self.parts else 0), self.part_sha256, self.part_crc32))
+                self.part_sha256 = hashlib.sha256()
+                self.part_crc32 = 0
+        self.size += len(data)
+
+    def entry(self):
+        """Return the checksums as a dict : size, sha256, crc32 and the list of the ones of the parts if any"""
+        entry = _entry(self.size, self.sha256, self.crc32)
+        if self.ends:
+            entry["parts"] = self.parts
+        return entry
+
+    def reader(self, fileobj):
+        """Return a file-like object reading fileobj and updating the checksum with the data read"""
+        return _ChecksumReader(fileobj, self)
+
+
+class _ChecksumReader:
+    def __init__(self, fileobj, checksum):
+        self.fileobj = fileobj
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.checksum.update(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def file_checksum(path, connections=1):
+    """Return the checksums of the local file path, see Checksum.entry
+       - connections: size of the pool uploading the file, the checksums of its parts are added
+         when it is uploaded in parts, see ftppool.upload_ranges
+    """
+    ranges = ftppool.upload_ranges(os.path.getsize(path), connections)
+    checksum = Checksum([offset + length for offset, length in ranges] if len(ranges) > 1 else ())
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            checksum.update(data)
+    return checksum.entry()
+
+
+def checksums(files, connections=1, previous=None):
+    """Return the dict name -> checksums of the local files
+       - files: dict name in the backup folder -> local file
+       - connections: size of the pool uploading the files, see file_checksum
+       - previous: optional, checksums of an earlier backup reused for the files of the same name and
+         size, only for files never rewritten under the same name, ie the packs
+    """
+    result = {}
+    for name, path in files.items():
+        entry = (previous or {}).get(name)
+        if entry is None or entry["size"] != os.path.getsize(path) or ("parts" in entry) != (len(ftppool.upload_ranges(entry["size"], connections)) > 1):
+            entry = file_checksum(path, connections)
+        result[name] = entry
+    return result
+
+
+def write_sums(path, files, date):
+    """Write the checksums of the files of a backup in path
+       - files: dict name -> checksums, the names being relative to the backup folder, ie ../packs/<id>.pack
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump({"version": SUMS_VERSION, "date": date, "files": files}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def _parse_sums(text):
+    sums = json.loads(text)
+    if sums.get("version") != SUMS_VERSION:
+        raise ValueError("Unsupported checksums version")
+    return sums["files"]
+
+
+def load_sums(path):
+    """Return the checksums of the files of the clear checksum file path, None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return _parse_sums(f.read())
+
+
+# Single-pass verification of the backup files, each function reads the encrypted stream fileobj
+# to its end and raises ValueError when the content is not the one of the backup
+
+def _drain(reader):
+    while reader.read(READ_SIZE):
+        pass
+
+
+def _read_exactly(fileobj, size):
+    data = b""
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _check_end(fileobj):
+    if fileobj.read(1):
+        raise ValueError("Data after the end of the encrypted stream")
+
+
+def check_data(fileobj, key):
+    """Verify an encrypted file, ie date.txt.bin, return its clear content"""
+    data = encrypt.DecryptReader(fileobj, key).read()
+    _check_end(fileobj)
+    return data
+
+
+def check_compressed(fileobj, key):
+    """Verify an encrypted compressed stream, ie the SQL dump"""
+    _drain(compress.DecompressReader(encrypt.DecryptReader(fileobj, key)))
+    _check_end(fileobj)
+
+
+def check_index(fileobj, key):
+    """Verify the index of a site archive, return its members [name, offset, length, kind]"""
+    members = []
+    with gzip.GzipFile(fileobj=encrypt.DecryptReader(fileobj, key)) as index:
+        header = json.loads(index.readline())
+        if header.get("version") != archive.INDEX_VERSION:
+            raise ValueError("Unsupported index version")
+        for line in index:
+            item = json.loads(line)
+            if isinstance(item, list):
+                members.append(item)
+    _check_end(fileobj)
+    return members
+
+
+def check_archive(fileobj, key, members=None):
+    """Verify a site archive and compare its tar members with the ones of its index
+       - members: optional, members listed by the index, see check_index
+       return the number of members of the archive
+    """
+    clear = compress.DecompressReader(encrypt.DecryptReader(fileobj, key))
+    tar = tarfile.open(fileobj=clear, mode="r|", bufsize=READ_SIZE)
+    count = 0
+    for member in tar:
+        kind = "d" if member.isdir() else "h" if member.islnk() else "f"
+        if members is not None:
+            if count >= len(members):
+                raise ValueError("Member " + member.name + " of the archive is not in the index")
+            name, offset, length, expected = members[count]
+            if (member.name, member.offset, kind) != (name, offset, expected):
+                raise ValueError("Member " + member.name + " of the archive does not match the index entry " + name)
+        count += 1
+    tar.close()
+    # The end of the tar stream, the end of the compressed stream and the final segment
+    _drain(clear)
+    _check_end(fileobj)
+    if members is not None and count != len(members):
+        raise ValueError("%d members in the archive, %d in the index" % (count, len(members)))
+    return count
+
+
+def check_dump(fileobj, key):
+    """Verify a parallel dump, every chunk listed by its metadata must be in the dump, see dbdump.py"""
+    clear = encrypt.DecryptReader(fileobj, key)
+    tar = tarfile.open(fileobj=clear, mode="r|", bufsize=READ_SIZE)
+    metadata = None
+    chunks = set()
+    for member in tar:
+        if member.name == dbdump.METADATA:
+            metadata = json.load(tar.extractfile(member))
+        elif member.isfile():
+            _drain(compress.DecompressReader(tar.extractfile(member)))
+            chunks.add(member.name)
+    tar.close()
+    # The end of the tar stream and the final segment
+    _drain(clear)
+    _check_end(fileobj)
+    if metadata is None or metadata.get("version") != dbdump.DUMP_VERSION:
+        raise ValueError("Metadata of the dump is missing")
+    missing = set(chunk["member"] for table in metadata["tables"] for chunk in table["chunks"]) - chunks
+    if missing:
+        raise ValueError("Chunks missing in the dump : " + ", ".join(sorted(missing)))
+
+
+def _json_lines(fileobj, key, version):
+    with gzip.GzipFile(fileobj=encrypt.DecryptReader(fileobj, key)) as clear:
+        header = json.loads(clear.readline())
+        if header.get("version") != version:
+            raise ValueError("Unsupported version")
+        for line in clear:
+            yield json.loads(line)
+    _check_end(fileobj)
+
+
+def check_manifest(fileobj, key, objects):
+    """Verify the manifest of an incremental backup, add its objects to objects
+       - objects: dict path of a pack (packs/<id>.pack) -> {offset: (length, sha256)}, the objects the packs must hold
+    """
+    for entry in _json_lines(fileobj, key, incremental.MANIFEST_VERSION):
+        if entry["type"] == "f":
+            objects.setdefault(incremental.PACK_DIR + "/" + entry["pack"] + incremental.PACK_SUFFIX, {})[entry["offset"]] = (entry["length"], entry["hash"])
+
+
+def check_recipe(fileobj, key, objects):
+    """Verify the recipe of a deduplicated backup, add its chunks to objects, see check_manifest"""
+    for digest, pack, offset, length in _json_lines(fileobj, key, chunkstore.RECIPE_VERSION):
+        objects.setdefault(chunkstore.CHUNK_DIR + "/" + pack + incremental.PACK_SUFFIX, {})[offset] = (length, digest)
+
+
+class _Position:
+    """File-like object counting the bytes read from fileobj"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+
+def check_pack(fileobj, key, objects=None):
+    """Verify a pack object by object, see incremental.PackWriter
+       - objects: optional, {offset: (length, sha256)} of the objects referenced by the backups,
+         their clear content must have this sha256
+       return the number of objects of the pack
+    """
+    reader = _Position(fileobj)
+    found = set()
+    count = 0
+    while True:
+        offset = reader.position
+        header = _read_exactly(reader, encrypt.HEADER.size)
+        if not header:
+            break
+        encrypt.read_header(io.BytesIO(header))
+        digest = hashlib.sha256()
+        decrypted = encrypt.DecryptReader(reader, key, header=header, check_end=False)
+        clear = compress.DecompressReader(decrypted)
+        while True:
+            data = clear.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+        # The last segment of the container may not be read by the decompression
+        _drain(decrypted)
+        expected = (objects or {}).get(offset)
+        if expected is not None:
+            if expected != (reader.position - offset, digest.hexdigest()):
+                raise ValueError("Object at offset %d does not match the backups referencing it" % offset)
+            found.add(offset)
+        count += 1
+    missing = set(objects or ()) - found
+    if missing:
+        raise ValueError("%d objects referenced by the backups are missing, the first one at offset %d" % (len(missing), min(missing)))
+    return count
+
+
+# Sources of the backup files : the paths are relative to LOCALBKPATH or FTP_PATH,
+# ie daily-20261017-020000/date.txt.bin or SLOT-3/date.txt.bin, and packs/<id>.pack
+# The folder of a day missing from the retention is None
+
+class LocalSource:
+    """Backup files of the local folders
+       - root_path: LOCALBKPATH
+    """
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+    def folders(self, days):
+        """Return the folder of each day of days, given by the catalog of the snapshots, see retention.py"""
+        catalog = retention.Catalog(self.root_path)
+        return [os.path.basename(catalog.path(day)) if catalog.path(day) else None for day in days]
+
+    def listing(self, folder):
+        """Return the names of the files of folder"""
+        return sorted(os.listdir(os.path.join(self.root_path, folder)))
+
+    @contextlib.contextmanager
+    def open(self, path):
+        """Give a binary file object reading the file path"""
+        with open(os.path.join(self.root_path, path), "rb") as f:
+            yield f
+
+    def checksums(self, paths):
+        """Return the checksums of the files paths, None for the missing ones"""
+        return {path: file_checksum(os.path.join(self.root_path, path)) if os.path.exists(os.path.join(self.root_path, path)) else None for path in paths}
+
+
+class FTPSource:
+    """Backup files of the FTP server
+       - pool: pool of sessions in FTP_PATH, see ftppool.backend
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.features = None
+
+    def folders(self, days):
+        """Return the physical folder of each day of days, see ftprotation.py"""
+        session = self.pool.acquire()
+        try:
+            state = ftprotation.load_state(session.ftp)
+        finally:
+            self.pool.release(session)
+        return [ftprotation.slot_dir(state, day) for day in days]
+
+    def listing(self, folder):
+        """Return the names of the files of folder, the files uploaded in parts only once"""
+        session = self.pool.acquire()
+        try:
+            return sorted(set(tools.partof(name.rsplit("/", 1)[-1]) for name in session.ftp.nlst(folder)))
+        finally:
+            self.pool.release(session)
+
+    @contextlib.contextmanager
+    def open(self, path):
+        """Give a file object reading the FTP file path while it is downloaded, see pipeline.download_stage"""
+        session = self.pool.acquire()
+        download = pipeline.Pipeline()
+        data = download.pipe()
+        download.add(pipeline.download_stage, session.ftp, path, data)
+        try:
+            yield pipeline.PipeReader(data)
+            download.wait()
+        except BaseException:
+            # The session may be in the middle of a transfer, it is replaced by a new one
+            download.abort.set()
+            try:
+                download.wait()
+            finally:
+                self.pool.release(session, broken=True)
+            raise
+        self.pool.release(session)
+
+    def _hash_command(self):
+        """Return the feature, command and algorithm used to checksum files on the server, None if it has none"""
+        if self.features is None:
+            session = self.pool.acquire()
+            try:
+                reply = tools.pipeline(session.ftp, ["FEAT"], check=False)[0]
+            finally:
+                self.pool.release(session)
+            self.features = {}
+            for line in reply.splitlines()[1:-1]:
+                name, _, value = line.strip().partition(" ")
+                self.features[name.upper()] = [algorithm.rstrip("*").upper() for algorithm in value.split(";") if algorithm]
+        for feature, command, algorithm in HASH_COMMANDS:
+            if feature in self.features and (feature != "HASH" or algorithm in self.features[feature]):
+                return feature, command, algorithm
+        return None
+
+    def checksums(self, paths):
+        """Return the checksums computed by the server of the files paths, None for the missing ones
+           The files uploaded in parts have the checksums of their parts.
+           return None if the server can not compute checksums
+        """
+        hash_command = self._hash_command()
+        if hash_command is None:
+            return None
+        feature, command, algorithm = hash_command
+        pieces = self.pool.remote_pieces(paths)
+        names = [remote for found in pieces if found for remote, offset, size in found]
+        commands = [command + " " + name for name in names]
+        if feature == "HASH":
+            commands.insert(0, "OPTS HASH " + algorithm)
+        session = self.pool.acquire()
+        try:
+            replies = tools.pipeline(session.ftp, commands, check=False)
+        finally:
+            self.pool.release(session)
+        if feature == "HASH":
+            tools.check_reply(replies.pop(0))
+        values = dict(zip(names, (_hash_value(reply, feature, algorithm) for reply in replies)))
+        field = HASH_FIELDS[algorithm]
+        result = {}
+        for path, found in zip(paths, pieces):
+            if found is None:
+                result[path] = None
+                continue
+            parts = [{"size": size, field: values[remote]} for remote, offset, size in found]
+            if len(parts) == 1 and found[0][0] == path:
+                result[path] = parts[0]
+            else:
+                result[path] = {"size": sum(part["size"] for part in parts), "parts": parts}
+        return result
+
+
+def _hash_value(reply, feature, algorithm):
+    """Return the checksum of a reply to HASH, XSHA256 or XCRC, None for an error"""
+    if not reply.startswith("2"):
+        return None
+    if feature == "HASH":
+        # 213 <algorithm> <range> <value> <file>
+        fields = reply.split(" ", 4)
+        return fields[3].lower() if len(fields) > 3 else None
+    for token in reply[4:].split():
+        value = token[2:] if token.lower().startswith("0x") else token
+        try:
+            number = int(value, 16)
+        except ValueError:
+            continue
+        if algorithm == "CRC32" and len(value) <= 8:
+            return "%08x" % number
+        if algorithm == "SHA-256" and len(value) == 64:
+            return value.lower()
+    return None
+
+
+def _pairs(expected, found):
+    if "parts" in found:
+        return list(zip(expected.get("parts") or (), found["parts"]))
+    return [(expected, found)]
+
+
+def comparable(expected, found):
+    """Return True if the checksums found can be compared with the ones of the backup expected,
+       or if the file is missing
+    """
+    if found is None:
+        return True
+    if "parts" in found and len(expected.get("parts") or ()) != len(found["parts"]):
+        return False
+    return all(any(got.get(field) is not None and field in want for field in ("sha256", "crc32")) for want, got in _pairs(expected, found))
+
+
+def compare(expected, found):
+    """Return None if the checksums found match the ones of the backup expected, else the difference
+       The fields found in both are compared, part by part for the files uploaded in parts.
+    """
+    if found is None:
+        return "missing"
+    if "parts" in found and len(expected.get("parts") or ()) != len(found["parts"]):
+        return "%d parts instead of %d" % (len(found["parts"]), len(expected.get("parts") or ()))
+    pairs = _pairs(expected, found)
+    for index, (want, got) in enumerate(pairs):
+        for field in ("size", "sha256", "crc32"):
+            if got.get(field) is not None and field in want and got[field] != want[field]:
+                where = " of part %d" % (index + 1) if len(pairs) > 1 else ""
+                return "%s%s is %s instead of %s" % (field, where, got[field], want[field])
+    return None
+
+
+class Verifier:
+    """Verification of the retention folders of a backup, see above
+       - source: LocalSource or FTPSource of the backup files
+       - key: AES key used for encryption
+       - jobs: number of files verified at the same time
+       - checksums_only: compare the checksums computed by the server with the ones of the backups
+         instead of reading the files, when the server can, see FTPSource.checksums
+    """
+    def __init__(self, source, key, jobs=1, checksums_only=False):
+        self.source = source
+        self.key = key
+        self.jobs = max(1, jobs)
+        self.checksums_only = checksums_only
+        self.lock = threading.Lock()
+        self.results = []
+
+    def _result(self, day, path, method, error=None, size=0):
+        with self.lock:
+            self.results.append({"day": day, "file": path, "method": method, "status": "failed" if error else "ok", "error": error, "bytes": size})
+
+    def _stream(self, day, paths, sums, objects):
+        """Verify the files paths by reading them, one after the other, the index of an archive before the archive
+           - sums: checksums of the backup by path, None if it has none
+           - objects: objects the packs must hold, see check_manifest
+        """
+        members = None
+        for path in paths:
+            name = os.path.basename(path)
+            checksum = Checksum()
+            try:
+                with self.source.open(path) as fileobj:
+                    reader = checksum.reader(fileobj)
+                    if name == archive.INDEX + ".bin":
+                        members = check_index(reader, self.key)
+                    elif name.startswith("wordpress.site.tar"):
+                        check_archive(reader, self.key, members)
+                    elif name.endswith(dbdump.DUMP_SUFFIX + ".bin"):
+                        check_dump(reader, self.key)
+                    elif name.endswith(".sql.gz.bin") or name.endswith(binlog.SEGMENT_SUFFIX + ".bin"):
+                        check_compressed(reader, self.key)
+                    elif name == incremental.MANIFEST + ".bin":
+                        check_manifest(reader, self.key, objects)
+                    elif name == chunkstore.RECIPE + ".bin":
+                        check_recipe(reader, self.key, objects)
+                    elif name.endswith(incremental.PACK_SUFFIX):
+                        check_pack(reader, self.key, objects.get(path))
+                    else:
+                        check_data(reader, self.key)
+                error = None
+                if sums and path in sums:
+                    error = compare(sums[path], checksum.entry())
+                    if error:
+                        error = "valid content but not the one of the backup, " + error
+            except Exception as exc:
+                error = str(exc) or exc.__class__.__name__
+            self._result(day, path, "stream", error, checksum.size)
+
+    def _checksums(self, day, sums, paths):
+        """Compare the checksums of the server with sums, return the paths which can not be compared"""
+        found = self.source.checksums(paths) if paths else None
+        if found is None:
+            return paths
+        left = []
+        for path in paths:
+            if not comparable(sums[path], found[path]):
+                left.append(path)
+                continue
+            self._result(day, path, "checksum", compare(sums[path], found[path]), sums[path]["size"])
+        return left
+
+    def _folder(self, day, folder, packs):
+        """Read the checksums of the backup of day and verify its files by checksum if asked
+           - packs: dict receiving the checksums of the packs of the backup by path
+           return the groups of files to verify by reading them, with the checksums of the backup
+        """
+        files = [folder + "/" + name for name in self.source.listing(folder) if name.endswith(".bin")]
+        sums = None
+        sums_path = folder + "/" + SUMS + ".bin"
+        if sums_path in files:
+            files.remove(sums_path)
+            checksum = Checksum()
+            try:
+                with self.source.open(sums_path) as fileobj:
+                    sums = {os.path.normpath(folder + "/" + name): entry for name, entry in _parse_sums(check_data(checksum.reader(fileobj), self.key)).items()}
+            except Exception as exc:
+                self._result(day, sums_path, "stream", str(exc) or exc.__class__.__name__, checksum.size)
+            else:
+                self._result(day, sums_path, "stream", None, checksum.size)
+        if sums is not None:
+            for path, entry in sums.items():
+                if path.endswith(incremental.PACK_SUFFIX):
+                    with self.lock:
+                        packs.setdefault(path, entry)
+                elif path not in files:
+                    self._result(day, path, "stream", "missing", 0)
+            if self.checksums_only:
+                left = self._checksums(day, sums, [path for path in files if path in sums])
+                files = [path for path in files if path in left or path not in sums]
+        site = sorted((path for path in files if os.path.basename(path) in (archive.INDEX + ".bin", "wordpress.site.tar.gz.bin")), key=lambda path: not path.endswith(archive.INDEX + ".bin"))
+        groups = [(day, site, sums)] if site else []
+        return groups + [(day, [path], sums) for path in files if path not in site]
+
+    def _run(self, tasks):
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            return [future.result() for future in [executor.submit(*task) for task in tasks]]
+
+    def _try_folder(self, day, folder, packs):
+        try:
+            return self._folder(day, folder, packs)
+        except Exception as exc:
+            self._result(day, folder, "stream", "can not read the folder, " + (str(exc) or exc.__class__.__name__))
+            return []
+
+    def verify(self, days):
+        """Verify the retention folders of days, return the results of their files
+           Each result is a dict with the day (None for the packs), the file, the method (stream or checksum),
+           the status (ok or failed), the error and the bytes read or checked.
+        """
+        packs = {}
+        objects = {}
+        groups = sum(self._run([(self._try_folder, day, folder, packs) for day, folder in zip(days, self.source.folders(days)) if folder is not None]), [])
+        # The manifests and the recipes give the objects the packs must hold
+        self._run([(self._stream, day, paths, sums, objects) for day, paths, sums in groups])
+        paths = sorted(set(packs) | set(objects))
+        if self.checksums_only:
+            left = self._checksums(None, packs, [path for path in paths if path in packs])
+            paths = [path for path in paths if path in left or path not in packs]
+        self._run([(self._stream, None, [path], packs, objects) for path in paths])
+        return self.results